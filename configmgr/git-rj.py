@@ -1,24 +1,31 @@
 #!/usr/bin/env python3
 
 import argparse
-import concurrent.futures
+import contextlib
+import fnmatch
+import functools
+import heapq
+import io
 import json
+import locale
 import os
 import platform
 import re
-import shutil
+import selectors
+import shlex
+import struct
 import subprocess  # Python 3.7 or later
 import sys
 import threading
 import time
 
-from pathlib import Path
-import xml.etree.ElementTree as ET
+from stat import S_IWRITE
 
 # Global Configuration
 VERSION = "1.0-alpha.20211020"
 GITDEBUGLEVEL = 0
 MAX_WORKERS = 8
+MAX_NETWORK_WORKERS = 64
 
 DEFAULT_BRANCH = "master"
 RELEASE_BRANCH = "release/"
@@ -37,101 +44,382 @@ class bcolors:
     ENDC = '\033[0m'
 
 
-class ProcessPipe(threading.Thread):
-    """Print output from processes"""
-    # https://gist.github.com/alfredodeza/dcea71d5c0234c54d9b1
+class Profiler:
+    """Record the git and other processes run, for the --profile option.
 
-    def __init__(self, prefix="", match=None):
-        threading.Thread.__init__(self)
-        self.daemon = False
-        self.fdRead, self.fdWrite = os.pipe()
-        self.pipeReader = os.fdopen(self.fdRead)
-        self.process = None
-        self.prefix = prefix
-        self.match = match
-        self.start()
+    Each process is recorded with its arguments, working directory, module,
+    worker thread, start and end time, exit code and output size. At the end, a
+    summary is printed per module and per command, and the records are written
+    as a Chrome trace file (for chrome://tracing or https://ui.perfetto.dev).
+    """
 
-    def fileno(self):
-        return self.fdWrite
+    DEFAULT_TRACE = "gitrj-trace.json"
 
-    def run(self):
-        try:
-            for line in iter(self.pipeReader.readline, ''):
-                pcol = ""
-                stripline = line.strip('\n')
-                if not self.match is None:
-                    for check, colour in self.match.items():
-                        if re.search(check, stripline):
-                            pcol = colour
-                            break
-
-                print("{}{}{}{}".format(self.prefix, pcol, stripline, bcolors.ENDC), flush=True)
-        except:
-            pass
+    _instance = None
 
-        try:
-            self.pipeReader.close()
-        except:
-            pass
+    def __init__(self, trace=DEFAULT_TRACE):
+        self.trace = trace
+        self.root = os.getcwd()
+        self.records = []
+        self._start = time.perf_counter()
+        self._lanes = []
+        self._lock = threading.Lock()
 
-    def close(self):
-        try:
-            os.close(self.fdWrite)
-        except:
-            pass
+    @ staticmethod
+    def enable(trace=DEFAULT_TRACE):
+        """Start recording processes"""
+        Profiler._instance = Profiler(trace)
 
-    def stop(self):
-        self._stop = True
-        self.close()
+    @ staticmethod
+    def start(args, cwd=None):
+        """Record the start of a process, returning the record to stop"""
+        profiler = Profiler._instance
+        if (profiler is None):
+            return None
 
-    def __del__(self):
-        try:
-            self.stop()
-        except:
-            pass
+        path = os.path.relpath(cwd if cwd is not None else ".", profiler.root)
+        record = {
+            "args": list(args) if not isinstance(args, str) else [args],
+            "cwd": cwd if cwd is not None else profiler.root,
+            "module": "base" if path == "." else path.replace(os.sep, "/"),
+            "thread": threading.current_thread().name,
+            "start": time.perf_counter() - profiler._start,
+            "end": None,
+            "returncode": None,
+            "size": 0,
+        }
+        with profiler._lock:
+            # Processes run from an asyncio event loop overlap on one thread,
+            # so the trace shows each running process in its own lane.
+            if (None in profiler._lanes):
+                lane = profiler._lanes.index(None)
+                profiler._lanes[lane] = record
+            else:
+                lane = len(profiler._lanes)
+                profiler._lanes.append(record)
+            record["lane"] = lane
+            profiler.records.append(record)
+        return record
+
+    @ staticmethod
+    def stop(record, returncode, size=0):
+        """Record the end of a process started with start()"""
+        profiler = Profiler._instance
+        if (profiler is None or record is None):
+            return
+
+        record["end"] = time.perf_counter() - profiler._start
+        record["returncode"] = returncode
+        record["size"] = size
+        with profiler._lock:
+            profiler._lanes[record["lane"]] = None
+
+    @ staticmethod
+    def _command(args):
+        if (len(args) == 0):
+            return ""
+        program = os.path.basename(args[0])
+        if (program != "git"):
+            return program.split()[0] if len(program) > 0 else program
+
+        # Skip the global options of git, e.g. 'git -c key=value status'
+        i = 1
+        while (i < len(args) and args[i].startswith("-")):
+            i += 2 if args[i] in ["-c", "-C"] else 1
+        return f"git {args[i]}" if i < len(args) else "git"
+
+    @ staticmethod
+    def _p95(durations):
+        durations = sorted(durations)
+        return durations[max(0, -(-len(durations) * 95 // 100) - 1)]
+
+    def _summary(self, title, key, records):
+        groups = {}
+        for record in records:
+            groups.setdefault(key(record), []).append(record["end"] - record["start"])
+
+        width = max([len(title)] + [len(name) for name in groups])
+        print(f"\033[35;1m{title:<{width}}  {'Count':>6}  {'Total':>9}  {'p95':>9}\033[0m", file=sys.stderr)
+        for name in sorted(groups, key=lambda name: -sum(groups[name])):
+            durations = groups[name]
+            print(f"{name:<{width}}  {len(durations):>6}  {sum(durations):>8.3f}s  {Profiler._p95(durations):>8.3f}s", file=sys.stderr)
+
+    def _write_trace(self):
+        events = []
+        lanes = set()
+        for record in self.records:
+            if (record["end"] is None):
+                # A session that was never closed.
+                continue
+            lanes.add(record["lane"])
+            events.append({
+                "name": " ".join(record["args"]),
+                "cat": record["module"],
+                "ph": "X",
+                "ts": round(record["start"] * 1000000),
+                "dur": round((record["end"] - record["start"]) * 1000000),
+                "pid": 1,
+                "tid": record["lane"],
+                "args": {
+                    "cwd": record["cwd"],
+                    "module": record["module"],
+                    "thread": record["thread"],
+                    "exitcode": record["returncode"],
+                    "output": record["size"],
+                }
+            })
+        for lane in sorted(lanes):
+            events.append({
+                "name": "thread_name", "ph": "M", "pid": 1, "tid": lane,
+                "args": {"name": f"Process {lane}"}
+            })
+        with open(self.trace, "w") as traceFile:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, traceFile)
+
+    @ staticmethod
+    def report():
+        """Print the summary and write the trace file
+
+        The summary goes to stderr, so that the output of the command (e.g.
+        with --format json) can still be parsed.
+        """
+        profiler = Profiler._instance
+        if (profiler is None):
+            return
+
+        elapsed = time.perf_counter() - profiler._start
+        records = [record for record in profiler.records if record["end"] is not None]
+        total = sum([record["end"] - record["start"] for record in records])
+        sys.stdout.flush()
+        print(file=sys.stderr)
+        print(f"\033[35;1mProfile:\033[0;35m {len(records)} processes, {total:.3f}s process time, {elapsed:.3f}s elapsed\033[0m", file=sys.stderr)
+        if (len(records) > 0):
+            profiler._summary("Module", lambda record: record["module"], records)
+            print(file=sys.stderr)
+            profiler._summary("Command", lambda record: Profiler._command(record["args"]), records)
 
         try:
-            del self.fdRead
-            del self.fdWrite
-        except:
-            pass
+            profiler._write_trace()
+            print(f"Trace written to {profiler.trace}", file=sys.stderr)
+        except OSError as ex:
+            print(f"Couldn't write trace to {profiler.trace}: {str(ex)}", file=sys.stderr)
+
+
+class Colourizer:
+    """Get the colour for a line, from a dictionary of regular expressions.
+
+    The colour is for the first expression in the dictionary that is found in
+    the line. All expressions are compiled into one alternation, so that a line
+    that doesn't match is checked with one search.
+    """
+
+    # Numbered back references and global flags can't be combined.
+    _RE_UNCOMBINABLE = re.compile(r"\\[1-9]|\(\?[aiLmsux]+\)")
+
+    def __init__(self, match):
+        self.patterns = [(re.compile(check), colour) for check, colour in match.items()]
+        self.regex = None
+        if (not any(self._RE_UNCOMBINABLE.search(check) for check in match)):
+            try:
+                self.regex = re.compile("|".join(
+                    [f"(?P<m{index}>{check})" for index, check in enumerate(match)]))
+            except re.error:
+                pass
+
+    def colour(self, line):
+        """Get the colour for the line, or an empty string"""
+        if (self.regex is None):
+            for pattern, colour in self.patterns:
+                if (pattern.search(line)):
+                    return colour
+            return ""
+
+        found = self.regex.search(line)
+        if (found is None):
+            return ""
+
+        # The alternation finds the left-most match, but an earlier expression
+        # might match later in the line and takes priority.
+        index = int(found.lastgroup[1:])
+        for pattern, colour in self.patterns[:index]:
+            if (pattern.search(line)):
+                return colour
+        return self.patterns[index][1]
+
+
+class OutputWriter:
+    """Buffer lines written to standard output.
+
+    The lines are written together when enough lines are buffered, or after a
+    short time, instead of one write for each line.
+    """
+
+    FLUSH_INTERVAL = 0.05
+    FLUSH_LINES = 256
+
+    def __init__(self, stream=None):
+        self._stream = stream if stream is not None else sys.stdout
+        self._lines = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def write(self, line):
+        """Write the line, which must end with a newline"""
+        with self._lock:
+            self._lines.append(line)
+            if (len(self._lines) >= self.FLUSH_LINES):
+                self._flush()
+            elif (self._timer is None):
+                self._timer = threading.Timer(self.FLUSH_INTERVAL, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """Write all buffered lines"""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if (self._timer is not None):
+            self._timer.cancel()
+            self._timer = None
+        if (len(self._lines) > 0):
+            self._stream.write("".join(self._lines))
+            self._lines = []
+        self._stream.flush()
 
 
 class ProcessExe:
-    """Execute a command"""
+    """Execute a command, printing its output as it is received.
+
+    Each line of standard output is prefixed with "OUT| " and coloured by the
+    first regular expression in match that is found in the line. Each line of
+    standard error is prefixed with "ERR| ". Colours are only used if standard
+    output is a terminal.
+    """
+
+    # Characters that have a meaning to the shell. If a command has none of
+    # these, it's split into arguments and executed directly.
+    SHELL_CHARS = re.compile(r"[|&;<>()$`\\!*?\[\]{}~#\n]")
+
+    # The encoding of the output of the command.
+    _encoding = locale.getpreferredencoding(False)
 
     def __init__(self, cmd, cwd=None, check=True, match=None):
-        shell = False
-        if platform.system() == "Linux":
-            shell = True
+        self.returncode = -1
+        self._size = 0
+        self._colour = sys.stdout.isatty()
+        self._match = Colourizer(match) if match is not None and self._colour else None
+        self._writer = OutputWriter()
+
+        args = ProcessExe._args(cmd)
+        shell = isinstance(args, str) and platform.system() != "Windows"
 
-        pipeout = ProcessPipe("OUT| ", match=match)
-        pipeerr = ProcessPipe("ERR| ")
+        profile = Profiler.start(cmd, cwd)
         try:
             process = subprocess.Popen(
-                cmd, cwd=cwd,
-                stdout=pipeout, stderr=pipeerr,
-                universal_newlines=True, shell=shell
+                args, cwd=cwd,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=shell
             )
         except:
-            self.returncode = -1
-            pipeout.close()
-            pipeerr.close()
+            Profiler.stop(profile, self.returncode)
             raise
 
-        # We must wait as sometimes when the process.wait() returns, it's not quite finished (file outputs are not yet
-        # present), and the pipe for reading STDOUT and STDERR is not yet complete.
+        try:
+            if (platform.system() == "Windows"):
+                self._read_threads(process)
+            else:
+                self._read_selectors(process)
+        finally:
+            self._writer.flush()
         self.returncode = process.wait()
-        time.sleep(0.5)
-        pipeout.close()
-        pipeerr.close()
-        time.sleep(0.5)
+        Profiler.stop(profile, self.returncode, self._size)
 
         if (check and self.returncode != 0):
             raise subprocess.CalledProcessError(
                 returncode=process.returncode, cmd=cmd
             )
 
+    @ staticmethod
+    def _args(cmd):
+        """Get the arguments to execute, or the command string for the shell"""
+        if (not isinstance(cmd, str)):
+            return cmd
+        if (platform.system() == "Windows"):
+            # The command line is given to CreateProcess, as before.
+            return cmd
+        if (ProcessExe.SHELL_CHARS.search(cmd) is not None):
+            return cmd
+        try:
+            args = shlex.split(cmd)
+        except ValueError:
+            return cmd
+        if (len(args) == 0 or "=" in args[0]):
+            # Variable assignments are done by the shell.
+            return cmd
+        return args
+
+    def _print(self, prefix, data, match=None):
+        """Print the complete lines in data, returning the incomplete remainder"""
+        lines = data.split(b"\n")
+        for line in lines[:-1]:
+            self._size += len(line) + 1
+            # Like universal newlines, a carriage return also ends the line.
+            text = line.decode(ProcessExe._encoding, errors="replace")
+            for stripline in text.rstrip("\r").split("\r"):
+                if (not self._colour):
+                    self._writer.write(f"{prefix}{stripline}\n")
+                    continue
+
+                pcol = match.colour(stripline) if match is not None else ""
+                self._writer.write(f"{prefix}{pcol}{stripline}{bcolors.ENDC}\n")
+        return lines[-1]
+
+    def _flush(self, prefix, data, match=None):
+        """Print the last line, that didn't end with a newline"""
+        if (len(data) > 0):
+            self._print(prefix, data + b"\n", match)
+
+    def _read_selectors(self, process):
+        """Read both pipes from a single loop until both reach end of file"""
+        pipes = {
+            process.stdout: ["OUT| ", self._match, b""],
+            process.stderr: ["ERR| ", None, b""],
+        }
+        with selectors.DefaultSelector() as selector:
+            for pipe in pipes:
+                selector.register(pipe, selectors.EVENT_READ)
+            while (len(selector.get_map()) > 0):
+                for key, events in selector.select():
+                    pipe = pipes[key.fileobj]
+                    data = os.read(key.fd, 65536)
+                    if (len(data) == 0):
+                        selector.unregister(key.fileobj)
+                        self._flush(pipe[0], pipe[2], pipe[1])
+                        continue
+                    pipe[2] = self._print(pipe[0], pipe[2] + data, pipe[1])
+        process.stdout.close()
+        process.stderr.close()
+
+    def _read_pipe(self, pipe, prefix, match=None):
+        remainder = b""
+        for data in iter(lambda: pipe.read1(65536), b""):
+            remainder = self._print(prefix, remainder + data, match)
+        self._flush(prefix, remainder, match)
+        pipe.close()
+
+    def _read_threads(self, process):
+        """Read standard error on a thread, standard output on this thread.
+
+        Pipes can't be used with select() on Windows. The thread is joined
+        when standard error reaches end of file.
+        """
+        stderr = threading.Thread(
+            target=self._read_pipe, args=(process.stderr, "ERR| "))
+        stderr.start()
+        self._read_pipe(process.stdout, "OUT| ", self._match)
+        stderr.join()
+
     @ staticmethod
     def run(cmd, cwd=None, check=True, match=None):
         """Run the command"""
@@ -142,20 +430,24 @@ class ProcessExe:
 class GitExe:
     """Execute GIT commands"""
 
-    def __init__(self, args, cwd=None, check=True):
+    def __init__(self, args, cwd=None, check=True, process=None):
         self.args = ["git"]
         for arg in args:
             self.args.append(arg)
 
-        # Python 3.7
-        #   process = subprocess.run(
-        #       self.args, capture_output=True,
-        #       text=True, shell=True, cwd=cwd
-        #   )
-        process = subprocess.run(
-            self.args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            universal_newlines=True, shell=False, cwd=cwd
-        )
+        if (process is None):
+            # Python 3.7
+            #   process = subprocess.run(
+            #       self.args, capture_output=True,
+            #       text=True, shell=True, cwd=cwd
+            #   )
+            profile = Profiler.start(self.args, cwd)
+            process = subprocess.run(
+                self.args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True, shell=False, cwd=cwd
+            )
+            Profiler.stop(profile, process.returncode,
+                          len(process.stdout) + len(process.stderr))
         self.stdout = process.stdout.splitlines()
         self.stderr = process.stderr.splitlines()
         self.returncode = process.returncode
@@ -209,6 +501,99 @@ class GitExe:
         gitexe = GitExe(args, cwd, check)
         return gitexe
 
+    @ staticmethod
+    async def run_async(args, cwd=None, check=True):
+        """Run the command git <args> as a coroutine on the asyncio event loop"""
+        import asyncio
+        cmd = ["git"]
+        cmd.extend(args)
+        profile = Profiler.start(cmd, cwd)
+        process = await asyncio.create_subprocess_exec(
+            *cmd, cwd=cwd,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        Profiler.stop(profile, process.returncode, len(stdout) + len(stderr))
+
+        # Decode the same as 'universal_newlines=True' for subprocess.run
+        encoding = locale.getpreferredencoding(False)
+        result = subprocess.CompletedProcess(
+            cmd, process.returncode,
+            stdout.decode(encoding).replace("\r\n", "\n"),
+            stderr.decode(encoding).replace("\r\n", "\n"))
+        return GitExe(args, cwd, check, process=result)
+
+    @ staticmethod
+    async def to_thread(func, *args):
+        """Call the blocking function from a coroutine, in a thread of the event loop
+
+        Checks that read files or run git synchronously don't stall the other
+        modules of the "async" engine.
+        """
+        import asyncio
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, functools.partial(func, *args))
+
+    @ staticmethod
+    def stream(args, cwd=None, check=True, separator="\n"):
+        """Run the command git <args>, yielding each line of output as it is read.
+
+        The output is never held in memory, so callers process each line as git
+        writes it. If the caller stops reading, e.g. because it raised, the git
+        process is terminated. When the output is complete and check is True, a
+        CalledProcessError is raised if git failed. For output of git with the
+        option '-z', the separator is "\0".
+        """
+        import tempfile
+        cmd = ["git"]
+        cmd.extend(args)
+        if (GITDEBUGLEVEL > 0):
+            prcwd = os.path.relpath(cwd) if cwd is not None else "."
+            print("GITCMD: ", " ".join(cmd), end="")
+            print(" ({})".format(prcwd))
+
+        profile = Profiler.start(cmd, cwd)
+        size = 0
+        with tempfile.TemporaryFile() as stderr:
+            # Standard error goes to a file, so git can't block writing to it
+            # while we're reading standard output.
+            process = subprocess.Popen(
+                cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=stderr,
+                universal_newlines=True
+            )
+            try:
+                if (separator == "\n"):
+                    for line in process.stdout:
+                        size += len(line)
+                        yield line.rstrip("\n")
+                else:
+                    pending = ""
+                    for chunk in iter(lambda: process.stdout.read(65536), ""):
+                        size += len(chunk)
+                        records = (pending + chunk).split(separator)
+                        pending = records.pop()
+                        yield from records
+                    if (pending != ""):
+                        yield pending
+            finally:
+                process.stdout.close()
+                if (process.poll() is None):
+                    # The caller raised or stopped reading.
+                    process.terminate()
+                process.wait()
+                Profiler.stop(profile, process.returncode, size)
+
+            if (process.returncode != 0 and check):
+                stderr.seek(0)
+                errors = stderr.read().decode(locale.getpreferredencoding(False), errors="replace")
+                if (GITDEBUGLEVEL > 0):
+                    print("GITERR: {} ({})".format(" ".join(cmd), prcwd))
+                    print(f"GITERR: Result={process.returncode}")
+                # The output was already given to the caller.
+                raise subprocess.CalledProcessError(
+                    returncode=process.returncode, cmd=cmd, output="", stderr=errors
+                )
+
     @ classmethod
     def version(cls):
         """Get the current GIT version"""
@@ -217,6 +602,811 @@ class GitExe:
             cls._version = gitexe.stdout[0]
         return cls._version
 
+    _RE_VERSION = re.compile(r'(\d+)\.(\d+)(?:\.(\d+))?')
+
+    @ classmethod
+    def version_info(cls):
+        """Get the current GIT version as a tuple, e.g. (2, 39, 2)"""
+        m = cls._RE_VERSION.search(cls.version())
+        if (m is None):
+            return (0, 0, 0)
+        return (int(m.group(1)), int(m.group(2)), int(m.group(3) or 0))
+
+
+class GitCatFile:
+    """A persistent 'git cat-file --batch-check' session for a repository.
+
+    Names are written to the standard input of a long running git process and
+    the hashes read back from its output, so that many lookups on the same
+    repository don't each need a new process.
+    """
+
+    def __init__(self, cwd):
+        self.args = ["git", "cat-file", "--batch-check"]
+        self._cwd = cwd
+        self._process = None
+        self._profile = None
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def _start(self):
+        if (self._process is None):
+            if (self._failed):
+                raise GitError(f"Session '{' '.join(self.args)}' is not available")
+            if (GITDEBUGLEVEL > 0):
+                prcwd = os.path.relpath(self._cwd) if self._cwd is not None else "."
+                print("GITCMD: ", " ".join(self.args), end="")
+                print(" ({})".format(prcwd))
+            self._profile = Profiler.start(self.args, self._cwd)
+            try:
+                self._process = subprocess.Popen(
+                    self.args, cwd=self._cwd,
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL
+                )
+            except OSError as ex:
+                self._failed = True
+                Profiler.stop(self._profile, -1)
+                raise GitError(ex, errors=ex)
+        return self._process
+
+    def resolve(self, obj):
+        """Get the hash of the object given, or None if it doesn't exist"""
+        if ("\n" in obj):
+            return None
+
+        with self._lock:
+            process = self._start()
+            try:
+                process.stdin.write(obj.encode() + b"\n")
+                process.stdin.flush()
+                line = process.stdout.readline()
+            except OSError:
+                line = b""
+            if (len(line) == 0):
+                # The process exited, e.g. this isn't a repository.
+                self._failed = True
+                self._stop()
+                raise GitError(f"Session '{' '.join(self.args)}' terminated")
+
+        if (GITDEBUGLEVEL > 1):
+            print("BATCH|", obj, "=>", line.decode().rstrip())
+
+        # Either '<hash> <type> <size>', '<obj> missing' or '<obj> ambiguous'
+        fields = line.decode().split()
+        if (len(fields) != 3):
+            return None
+        return fields[0]
+
+    def _stop(self):
+        process = self._process
+        self._process = None
+        if (process is None):
+            return
+        try:
+            process.stdin.close()
+            process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        Profiler.stop(self._profile, process.returncode)
+
+    def close(self):
+        """Terminate the git process"""
+        with self._lock:
+            self._stop()
+
+
+class GitRefStore:
+    """Read HEAD and references directly from the files of a repository.
+
+    The git directory is found from the working tree, following the 'gitdir:'
+    file of submodules and worktrees. Loose references are read from 'refs/'
+    and the remainder from 'packed-refs', which is memory mapped and searched
+    by prefix if it's sorted.
+
+    If the repository uses a format that isn't understood (e.g. reftable),
+    supported() returns False and the caller should ask git instead.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._gitdir = None
+        self._commondir = None
+        self._supported = None
+
+    @ staticmethod
+    def find_gitdir(path):
+        """Get the git directory for the working tree path, or None"""
+        dotgit = os.path.join(path, ".git")
+        if (os.path.isdir(dotgit)):
+            return dotgit
+        if (os.path.isfile(dotgit)):
+            try:
+                with open(dotgit) as gitfile:
+                    line = gitfile.readline().strip()
+            except OSError:
+                return None
+            if (line.startswith("gitdir:")):
+                gitdir = os.path.join(path, line[7:].strip())
+                if (os.path.isdir(gitdir)):
+                    return os.path.normpath(gitdir)
+        return None
+
+    def gitdir(self):
+        """Get the git directory, which contains HEAD"""
+        if (self._gitdir is None):
+            self._gitdir = GitRefStore.find_gitdir(self._path)
+        return self._gitdir
+
+    def commondir(self):
+        """Get the common git directory, which contains the references"""
+        if (self._commondir is None):
+            gitdir = self.gitdir()
+            if (gitdir is None):
+                return None
+            commondir = gitdir
+            try:
+                with open(os.path.join(gitdir, "commondir")) as commonfile:
+                    commondir = os.path.normpath(
+                        os.path.join(gitdir, commonfile.readline().strip()))
+            except OSError:
+                pass
+            self._commondir = commondir
+        return self._commondir
+
+    def supported(self):
+        """Check if the references of this repository can be read"""
+        if (self._supported is None):
+            commondir = self.commondir()
+            self._supported = \
+                commondir is not None and \
+                os.path.isdir(os.path.join(commondir, "refs")) and \
+                not os.path.exists(os.path.join(commondir, "reftable")) and \
+                self._read_ref_file(os.path.join(self.gitdir(), "HEAD")) is not None
+        return self._supported
+
+    @ staticmethod
+    def _read_ref_file(path):
+        """Read a loose reference file.
+
+        Returns a tuple (hash, symref), where only one of the elements is not
+        None, or None if the file doesn't exist or isn't valid.
+        """
+        try:
+            with open(path, "rb") as reffile:
+                content = reffile.read(1024).strip()
+        except OSError:
+            return None
+
+        if (content.startswith(b"ref:")):
+            target = content[4:].strip().decode()
+            if (target == "refs/heads/.invalid"):
+                # HEAD of a reftable repository.
+                return None
+            return (None, target)
+        if (len(content) in (40, 64)):
+            return (content.decode(), None)
+        return None
+
+    def head(self):
+        """Get the HEAD as a tuple (hash, symref).
+
+        The hash is None if the branch is unborn. The symref is None if HEAD is
+        detached.
+        """
+        result = self._read_ref_file(os.path.join(self.gitdir(), "HEAD"))
+        if (result is None):
+            return (None, None)
+        if (result[1] is None):
+            return result
+        return (self.resolve(result[1]), result[1])
+
+    def resolve(self, refname):
+        """Get the hash for the full reference name, following symbolic refs"""
+        for _ in range(5):
+            result = self._read_ref_file(os.path.join(self.commondir(), refname))
+            if (result is None):
+                for packed in self._packed_refs(refname):
+                    if (packed[1] == refname):
+                        return packed[0]
+                return None
+            if (result[0] is not None):
+                return result[0]
+            refname = result[1]
+        return None
+
+    # Names that aren't looked up as references: those with characters that
+    # can't be in a reference (e.g. 'v1.0^{commit}'), full hashes, and pseudo
+    # references like FETCH_HEAD, which are left to git.
+    _RE_NOT_REFNAME = re.compile(r"[\x00-\x20~^:?*\[\\]|\.\.|@\{|^-|^[0-9a-f]{40}$|^[0-9a-f]{64}$|^[A-Z_]+$")
+
+    # The order git looks for a short name, see 'git help revisions'.
+    _DWIM_RULES = ["refs/tags/{}", "refs/heads/{}", "refs/remotes/{}", "refs/remotes/{}/HEAD"]
+
+    def lookup(self, name):
+        """Get the hash for a reference name, as git would resolve it.
+
+        A full name (e.g. 'refs/tags/v1.0') is read as is. A short name is
+        looked for in the tags, the local branches, then the remotes. Returns
+        None if it isn't found, or isn't a reference name, in which case git
+        should be asked.
+        """
+        if (name == "HEAD"):
+            return self.head()[0]
+        if (self._RE_NOT_REFNAME.search(name) is not None):
+            return None
+        rules = (["{}"] if name.startswith("refs/") else []) + ["refs/{}"] + self._DWIM_RULES
+        for rule in rules:
+            refhash = self.resolve(rule.format(name))
+            if (refhash is not None):
+                return refhash
+        return None
+
+    def _loose_refs(self, prefix):
+        """Get a dictionary of loose references under the prefix"""
+        refs = {}
+        commondir = self.commondir()
+
+        def _scan(directory, refbase):
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                return
+            for entry in entries:
+                refname = refbase + entry.name
+                if (entry.is_dir()):
+                    if (prefix.startswith(refname + "/") or (refname + "/").startswith(prefix)):
+                        _scan(entry.path, refname + "/")
+                elif (refname.startswith(prefix) and not entry.name.endswith(".lock")):
+                    result = self._read_ref_file(entry.path)
+                    if (result is not None):
+                        refs[refname] = result
+
+        _scan(os.path.join(commondir, "refs"), "refs/")
+        return refs
+
+    def _packed_refs(self, prefix):
+        """Get a list of (hash, refname) from packed-refs under the prefix"""
+        import mmap
+        packedpath = os.path.join(self.commondir(), "packed-refs")
+        try:
+            with open(packedpath, "rb") as packedfile:
+                if (os.fstat(packedfile.fileno()).st_size == 0):
+                    return []
+                with mmap.mmap(packedfile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return self._packed_scan(mm, prefix.encode())
+        except OSError:
+            return []
+
+    @ staticmethod
+    def _packed_scan(mm, prefix):
+        size = len(mm)
+        start = 0
+        packedsorted = False
+        if (mm[0:1] == b"#"):
+            eol = mm.find(b"\n")
+            start = size if eol < 0 else eol + 1
+            header = mm[0:start].split()
+            packedsorted = b"sorted" in header
+
+        if (packedsorted):
+            # Binary search for the first record not less than the prefix.
+            # Records start at the beginning of a line, peeled lines ('^')
+            # belong to the record before them.
+            lo = start
+            hi = size
+            while (lo < hi):
+                mid = (lo + hi) // 2
+                ls = mm.rfind(b"\n", lo, mid)
+                ls = lo if ls < 0 else ls + 1
+                if (mm[ls:ls + 1] == b"^"):
+                    ls = mm.rfind(b"\n", lo, ls - 1)
+                    ls = lo if ls < 0 else ls + 1
+                le = mm.find(b"\n", ls)
+                le = size if le < 0 else le
+                name = mm[ls:le].split(b" ", 1)[-1].rstrip(b"\r")
+                if (name < prefix):
+                    lo = le + 1
+                    if (mm[lo:lo + 1] == b"^"):
+                        le = mm.find(b"\n", lo)
+                        lo = size if le < 0 else le + 1
+                else:
+                    hi = ls
+            start = lo
+
+        refs = []
+        pos = start
+        while (pos < size):
+            eol = mm.find(b"\n", pos)
+            if (eol < 0):
+                eol = size
+            line = mm[pos:eol].rstrip(b"\r")
+            pos = eol + 1
+            if (len(line) == 0 or line[0:1] == b"^" or line[0:1] == b"#"):
+                continue
+            fields = line.split(b" ", 1)
+            if (len(fields) != 2):
+                continue
+            if (fields[1].startswith(prefix)):
+                refs.append((fields[0].decode(), fields[1].decode()))
+            elif (packedsorted and fields[1] > prefix):
+                break
+        return refs
+
+    def refs(self, prefixes=None):
+        """Get all references under the list of prefixes, e.g. 'refs/heads/'.
+
+        Returns a list of tuples (hash, refname) sorted by the refname.
+        Symbolic references are resolved. If prefixes is None, all references
+        under 'refs/' are returned.
+        """
+        if (prefixes is None):
+            prefixes = ["refs/"]
+
+        refs = {}
+        for prefix in prefixes:
+            for (refhash, refname) in self._packed_refs(prefix):
+                refs[refname] = refhash
+            for (refname, result) in self._loose_refs(prefix).items():
+                if (result[0] is not None):
+                    refs[refname] = result[0]
+                else:
+                    refhash = self.resolve(result[1])
+                    if (refhash is not None):
+                        refs[refname] = refhash
+                    else:
+                        refs.pop(refname, None)
+        return [(refs[refname], refname) for refname in sorted(refs)]
+
+
+class GitConfig:
+    """Read git configuration files without running git.
+
+    Section and key names are case insensitive and are stored in lower case,
+    subsection names are case sensitive. Files given by 'include.path' and
+    'includeIf.<condition>.path' are read at the position they're given, where
+    the conditions 'gitdir:', 'gitdir/i:' and 'onbranch:' are understood.
+
+    Parsed files are cached by their path, and are read again when the
+    modification time or size of the file changes.
+    """
+
+    MAX_INCLUDE_DEPTH = 10
+
+    _cache = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, path, gitdir=None, branch=None):
+        self._gitdir = gitdir
+        self._branch = branch
+        self.entries = []
+        self._load(os.path.abspath(path), 0)
+
+    @ staticmethod
+    def _normalize(name):
+        """Convert section and key names of 'section.subsection.key' to lower case"""
+        first = name.find(".")
+        last = name.rfind(".")
+        if (first < 0):
+            return name.lower()
+        return name[:first].lower() + name[first:last] + name[last:].lower()
+
+    def get(self, name, default=None):
+        """Get the last value for the configuration name"""
+        name = self._normalize(name)
+        for (key, value) in reversed(self.entries):
+            if (key == name):
+                return value if value is not None else "true"
+        return default
+
+    def get_all(self, name):
+        """Get a list of all values for the configuration name"""
+        name = self._normalize(name)
+        return [value if value is not None else "true"
+                for (key, value) in self.entries if key == name]
+
+    def subsections(self, section):
+        """Get a dictionary of subsection names to a dictionary of key values"""
+        prefix = section.lower() + "."
+        result = {}
+        for (key, value) in self.entries:
+            if (key.startswith(prefix)):
+                last = key.rfind(".")
+                if (last > len(prefix)):
+                    subsection = key[len(prefix):last]
+                    if (subsection not in result):
+                        result[subsection] = {}
+                    result[subsection][key[last + 1:]] = value if value is not None else "true"
+        return result
+
+    def _load(self, path, depth):
+        if (depth > self.MAX_INCLUDE_DEPTH):
+            raise GitError(f"Exceeded maximum include depth while including '{path}'")
+
+        entries = GitConfig.read_file(path)
+        if (entries is None):
+            # Missing include files are ignored
+            return
+
+        for (key, value) in entries:
+            self.entries.append((key, value))
+            if (value is None):
+                continue
+            if (key == "include.path"):
+                self._include(path, value, depth)
+            elif (key.startswith("includeif.") and key.endswith(".path")):
+                if (self._condition(path, key[10:-5])):
+                    self._include(path, value, depth)
+
+    def _include(self, path, include, depth):
+        include = os.path.expanduser(include)
+        if (not os.path.isabs(include)):
+            include = os.path.join(os.path.dirname(path), include)
+        self._load(os.path.normpath(include), depth + 1)
+
+    @ staticmethod
+    def _wildmatch(pattern, value, icase=False):
+        """Match a path with a glob where '**' matches across directories"""
+        regex = ""
+        i = 0
+        while (i < len(pattern)):
+            if (pattern.startswith("**/", i)):
+                regex += "(?:.*/)?"
+                i += 3
+            elif (pattern.startswith("**", i)):
+                regex += ".*"
+                i += 2
+            elif (pattern[i] == "*"):
+                regex += "[^/]*"
+                i += 1
+            elif (pattern[i] == "?"):
+                regex += "[^/]"
+                i += 1
+            else:
+                regex += re.escape(pattern[i])
+                i += 1
+        return re.fullmatch(regex, value, re.IGNORECASE if icase else 0) is not None
+
+    def _condition(self, path, condition):
+        if (condition.startswith("gitdir:") or condition.startswith("gitdir/i:")):
+            if (self._gitdir is None):
+                return False
+            icase = condition.startswith("gitdir/i:")
+            pattern = condition[9:] if icase else condition[7:]
+            if (pattern.startswith("~/")):
+                pattern = os.path.expanduser(pattern)
+            elif (pattern.startswith("./")):
+                pattern = os.path.join(os.path.dirname(path), pattern[2:])
+            pattern = pattern.replace("\\", "/")
+            if (not (pattern.startswith("/") or re.match(r"^[A-Za-z]:/", pattern))):
+                pattern = "**/" + pattern
+            if (pattern.endswith("/")):
+                pattern += "**"
+            gitdir = os.path.realpath(self._gitdir).replace("\\", "/")
+            return GitConfig._wildmatch(pattern, gitdir, icase)
+
+        if (condition.startswith("onbranch:")):
+            if (self._branch is None):
+                return False
+            pattern = condition[9:]
+            if (pattern.endswith("/")):
+                pattern += "**"
+            return GitConfig._wildmatch(pattern, self._branch)
+
+        return False
+
+    @ classmethod
+    def read_file(cls, path):
+        """Get the list of (name, value) entries of a single file.
+
+        Includes are not followed. The value is None for a key without an '='
+        (which is a boolean true). Returns None if the file doesn't exist.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with cls._cache_lock:
+            cached = cls._cache.get(path)
+        if (cached is not None and cached[0] == signature):
+            return cached[1]
+
+        try:
+            with open(path, "rb") as configfile:
+                (text, _, _) = cls._decode(configfile.read(), errors="replace")
+        except OSError:
+            return None
+
+        entries = cls._parse(text, path)
+        with cls._cache_lock:
+            cls._cache[path] = (signature, entries)
+        return entries
+
+    @ staticmethod
+    def _decode(data, errors="strict"):
+        """Decode the file contents to a tuple (text, bom, newline).
+
+        The text has the byte order mark removed and lines ending with "\n",
+        where newline is the line ending of the file.
+        """
+        text = data.decode("utf-8", errors=errors)
+        bom = text.startswith("\ufeff")
+        if (bom):
+            text = text[1:]
+        eol = text.find("\n")
+        newline = "\r\n" if eol > 0 and text[eol - 1] == "\r" else "\n"
+        return (text.replace("\r\n", "\n"), bom, newline)
+
+    @ staticmethod
+    def _parse(text, path, positions=None):
+        """Parse the configuration text from _decode(), like git does.
+
+        If positions is a list, a tuple (kind, name, start, end) is appended
+        for each section header and entry, where kind is "section" or "entry",
+        and start and end are the character offsets in the text.
+        """
+
+        entries = []
+        section = None
+        pos = 0
+        length = len(text)
+
+        def _error():
+            linenr = text.count("\n", 0, pos) + 1
+            return GitError(f"Bad config line {linenr} in file {path}")
+
+        def _skip_line(pos):
+            eol = text.find("\n", pos)
+            return length if eol < 0 else eol + 1
+
+        while (pos < length):
+            c = text[pos]
+            if (c.isspace()):
+                pos += 1
+            elif (c == "#" or c == ";"):
+                pos = _skip_line(pos)
+            elif (c == "["):
+                # [section], [section "subsection"] or [section.subsection]
+                header = pos
+                pos += 1
+                start = pos
+                while (pos < length and (text[pos].isalnum() or text[pos] in "-.")):
+                    pos += 1
+                name = text[start:pos].lower()
+                if (len(name) == 0 or pos >= length):
+                    raise _error()
+                if (text[pos] == "]"):
+                    pos += 1
+                    section = name
+                elif (text[pos] in " \t"):
+                    while (pos < length and text[pos] in " \t"):
+                        pos += 1
+                    if (pos >= length or text[pos] != '"'):
+                        raise _error()
+                    pos += 1
+                    subsection = ""
+                    while (pos < length and text[pos] != '"'):
+                        if (text[pos] == "\n"):
+                            raise _error()
+                        if (text[pos] == "\\"):
+                            pos += 1
+                            if (pos >= length or text[pos] == "\n"):
+                                raise _error()
+                        subsection += text[pos]
+                        pos += 1
+                    if (not text.startswith('"]', pos)):
+                        raise _error()
+                    pos += 2
+                    section = f"{name}.{subsection}"
+                else:
+                    raise _error()
+                if (positions is not None):
+                    positions.append(("section", section, header, pos))
+            elif (c.isalpha()):
+                if (section is None):
+                    raise _error()
+                start = pos
+                while (pos < length and (text[pos].isalnum() or text[pos] == "-")):
+                    pos += 1
+                key = text[start:pos].lower()
+                while (pos < length and text[pos] in " \t"):
+                    pos += 1
+                if (pos >= length or text[pos] == "\n"):
+                    entries.append((f"{section}.{key}", None))
+                    if (positions is not None):
+                        positions.append(("entry", f"{section}.{key}", start, min(pos + 1, length)))
+                    continue
+                if (text[pos] != "="):
+                    raise _error()
+                pos += 1
+
+                value = []
+                quote = False
+                comment = False
+                trim = None
+                while (pos < length):
+                    c = text[pos]
+                    pos += 1
+                    if (c == "\n"):
+                        if (quote):
+                            raise _error()
+                        break
+                    if (comment):
+                        continue
+                    if (c.isspace() and not quote):
+                        if (len(value) > 0):
+                            if (trim is None):
+                                trim = len(value)
+                            value.append(c)
+                        continue
+                    if (not quote and (c == ";" or c == "#")):
+                        comment = True
+                        continue
+                    trim = None
+                    if (c == "\\"):
+                        c = text[pos] if pos < length else ""
+                        pos += 1
+                        if (c == "\n"):
+                            continue
+                        elif (c == "t"):
+                            c = "\t"
+                        elif (c == "b"):
+                            c = "\b"
+                        elif (c == "n"):
+                            c = "\n"
+                        elif (c != "\\" and c != '"'):
+                            raise _error()
+                        value.append(c)
+                        continue
+                    if (c == '"'):
+                        quote = not quote
+                        continue
+                    value.append(c)
+                if (quote):
+                    raise _error()
+                if (trim is not None):
+                    value = value[:trim]
+                entries.append((f"{section}.{key}", "".join(value)))
+                if (positions is not None):
+                    positions.append(("entry", f"{section}.{key}", start, pos))
+            else:
+                raise _error()
+        return entries
+
+    @ staticmethod
+    def _quote(value):
+        """Quote a value for writing to a configuration file"""
+        escaped = value.replace("\\", "\\\\").replace('"', '\\"') \
+            .replace("\n", "\\n").replace("\t", "\\t").replace("\b", "\\b")
+        if (value != value.strip() or ";" in value or "#" in value):
+            return f'"{escaped}"'
+        return escaped
+
+    @ staticmethod
+    def _section_header(section):
+        dot = section.find(".")
+        if (dot < 0):
+            return f"[{section}]"
+        subsection = section[dot + 1:].replace("\\", "\\\\").replace('"', '\\"')
+        return f'[{section[:dot]} "{subsection}"]'
+
+    @ classmethod
+    def write_file(cls, path, values):
+        """Set all the values in the dictionary of names in a single update.
+
+        The file is updated like git does, by writing a '.lock' file which is
+        renamed over the original, keeping all other content of the file.
+        Existing entries are replaced in place, new entries are added to the
+        end of an existing section, or a new section at the end of the file.
+
+        Returns a tuple of two lists (changed, unhandled), the names that were
+        changed, and the names which weren't changed because they have
+        multiple values, or share a line with a section header, for which the
+        caller should use git instead.
+        """
+        try:
+            with open(path, "rb") as configfile:
+                (text, bom, newline) = cls._decode(configfile.read())
+        except FileNotFoundError:
+            (text, bom, newline) = ("", False, "\n")
+        except (OSError, UnicodeDecodeError) as ex:
+            raise GitError(ex, errors=ex)
+
+        positions = []
+        entries = cls._parse(text, path, positions)
+        current = {}
+        spanpositions = [position for position in positions if position[0] == "entry"]
+        for (entry, position) in zip(entries, spanpositions):
+            current.setdefault(entry[0], []).append((position[2], position[3], entry[1]))
+
+        # Work out the edits first, then apply them from the end of the file,
+        # so the offsets stay valid.
+        edits = []
+        appends = []
+        changed = []
+        unhandled = []
+        for (name, value) in values.items():
+            name = cls._normalize(name)
+            last = name.rfind(".")
+            section = name[:last]
+            key = name[last + 1:]
+            line = f"\t{key} = {cls._quote(value)}\n"
+
+            spans = current.get(name, [])
+            if (len(spans) > 1):
+                unhandled.append(name)
+                continue
+
+            if (len(spans) == 1):
+                (start, end, existing) = spans[0]
+                linestart = text.rfind("\n", 0, start) + 1
+                if (text[linestart:start].strip() != ""):
+                    # The entry shares the line with a section header.
+                    unhandled.append(name)
+                elif (existing != value):
+                    edits.append((linestart, end, line))
+                    changed.append(name)
+                continue
+
+            # Add to the end of the last section with this name
+            insert = None
+            insection = False
+            for (kind, pname, start, end) in positions:
+                if (kind == "section"):
+                    insection = pname == section
+                    if (insection):
+                        eol = text.find("\n", end)
+                        insert = len(text) if eol < 0 else eol + 1
+                elif (insection):
+                    insert = end
+            if (insert is None):
+                appends.append((section, line))
+            else:
+                if (insert > 0 and text[insert - 1] != "\n"):
+                    line = "\n" + line
+                edits.append((insert, insert, line))
+            changed.append(name)
+
+        if (len(changed) == 0):
+            return (changed, unhandled)
+
+        for (start, end, line) in sorted(edits, key=lambda edit: edit[0], reverse=True):
+            text = text[:start] + line + text[end:]
+        if (len(appends) > 0 and len(text) > 0 and not text.endswith("\n")):
+            text += "\n"
+        sections = {}
+        for (section, line) in appends:
+            sections.setdefault(section, []).append(line)
+        for (section, lines) in sections.items():
+            text += cls._section_header(section) + "\n" + "".join(lines)
+        if (newline != "\n"):
+            text = text.replace("\n", newline)
+        if (bom):
+            text = "\ufeff" + text
+
+        lockpath = path + ".lock"
+        try:
+            fd = os.open(lockpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            raise GitError(f"Unable to lock '{path}', the file '{lockpath}' exists")
+        except OSError as ex:
+            raise GitError(ex, errors=ex)
+        try:
+            with os.fdopen(fd, "wb") as lockfile:
+                lockfile.write(text.encode("utf-8"))
+            os.replace(lockpath, path)
+        except OSError as ex:
+            try:
+                os.remove(lockpath)
+            except OSError:
+                pass
+            raise GitError(ex, errors=ex)
+        return (changed, unhandled)
+
 
 class GitModule:
     """Perform operations on a GIT repository"""
@@ -230,13 +1420,60 @@ class GitModule:
         self._toplevel = None
         self._username = None
         self._useremail = None
+        self._catfile = None
+        self._refstore = None
 
         self.default_branch = DEFAULT_BRANCH
         self.url = None
+        self.parent = None
 
     def path(self):
         return self._relpath
 
+    def refstore(self):
+        """Get the reader for references directly from the repository files.
+
+        Returns None if the references can't be read directly, in which case
+        git should be used.
+        """
+        if (self._refstore is None):
+            self._refstore = GitRefStore(self.top_level())
+        if (not self._refstore.supported()):
+            return None
+        return self._refstore
+
+    def catfile(self):
+        """Get the persistent session for resolving references"""
+        if (self._catfile is None):
+            self._catfile = GitCatFile(self.top_level())
+        return self._catfile
+
+    def close(self):
+        """Close any persistent git sessions for this module"""
+        if (self._catfile is not None):
+            self._catfile.close()
+            self._catfile = None
+
+    def config(self):
+        """Get the local configuration of the repository, read without git.
+
+        Raises a GitError if the configuration can't be parsed.
+        """
+        if (self._refstore is None):
+            self._refstore = GitRefStore(self.top_level())
+        commondir = self._refstore.commondir()
+        if (commondir is None):
+            raise GitError(f"Not a git repository: {self._relpath}")
+
+        branch = None
+        if (self._refstore.supported()):
+            symref = self._refstore.head()[1]
+            if (symref is not None and symref.startswith("refs/heads/")):
+                branch = symref[11:]
+        return GitConfig(
+            os.path.join(commondir, "config"),
+            gitdir=self._refstore.gitdir(), branch=branch)
+
     def printable_path(self, length):
         """Tries to split and shorten a path string within the length given"""
         if (len(self._relpath) <= length):
@@ -278,6 +1515,10 @@ class GitModule:
 
     def top_level(self):
         """Get the top level folder path for this repository"""
+        if (self._toplevel is None and os.path.exists(os.path.join(self._path, ".git"))):
+            # A submodule, or the base, is the top level of its working tree.
+            self._toplevel = self._path
+
         if (self._toplevel is None):
             try:
                 git_top = GitExe.run(
@@ -325,80 +1566,165 @@ class GitModule:
         return self._useremail
 
     def set_git_user_name(self, username):
-        try:
-            GitExe.run(
-                ["config", "user.name", username],
-                cwd=self.top_level()
-            )
-        except subprocess.CalledProcessError as ex:
-            raise GitError(ex, errors=ex)
-        self._username = username
+        self.apply_config({"user.name": username})
 
     def set_git_user_email(self, useremail):
-        try:
-            GitExe.run(
-                ["config", "user.email", useremail],
-                cwd=self.top_level()
-            )
-        except subprocess.CalledProcessError as ex:
-            raise GitError(ex, errors=ex)
-        self._useremail = useremail
+        self.apply_config({"user.email": useremail})
 
     def set_config(self, rebase):
-        exception = None
+        self.apply_config(GitModule.init_config(rebase))
 
-        try:
-            if (platform.system() == "Windows"):
-                GitExe.run(
-                    ["config", "core.autocrlf", "true"],
-                    cwd=self.top_level()
-                )
-            else:
+    @ staticmethod
+    def init_config(rebase, username=None, useremail=None):
+        """Get the dictionary of configuration values for a repository"""
+        values = {}
+        if (platform.system() == "Windows"):
+            values["core.autocrlf"] = "true"
+        else:
+            values["core.autocrlf"] = "input"
+        values["pull.rebase"] = "true" if rebase else "false"
+        values["remote.origin.prune"] = "true"
+        values["push.default"] = "simple"
+        if (username is not None):
+            values["user.name"] = username
+        if (useremail is not None):
+            values["user.email"] = useremail
+        return values
+
+    def _config_path(self):
+        if (self._refstore is None):
+            self._refstore = GitRefStore(self.top_level())
+        commondir = self._refstore.commondir()
+        if (commondir is None):
+            raise GitError(f"Not a git repository: {self._relpath}")
+        return os.path.join(commondir, "config")
+
+    def apply_config(self, values):
+        """Write the dictionary of configuration values in a single update.
+
+        Returns the list of configuration names that were changed.
+        """
+        (changed, unhandled) = GitConfig.write_file(self._config_path(), values)
+        for name in unhandled:
+            # Entries with multiple values are left to git.
+            try:
                 GitExe.run(
-                    ["config", "core.autocrlf", "input"],
+                    ["config", "--replace-all", name, values[name]],
                     cwd=self.top_level()
                 )
-        except subprocess.CalledProcessError as ex:
-            if (exception is not None):
-                exception = ex
+            except subprocess.CalledProcessError as ex:
+                raise GitError(ex, errors=ex)
+            changed.append(name)
+
+        if ("user.name" in values):
+            self._username = values["user.name"]
+        if ("user.email" in values):
+            self._useremail = values["user.email"]
+        return changed
+
+    _CONFIG_TRUE = ["true", "yes", "on", "1"]
+    _CONFIG_FALSE = ["false", "no", "off", "0", ""]
 
+    def check_config(self, values):
+        """Compare the dictionary of configuration values with the repository.
+
+        Returns a dictionary of the names that differ, with a tuple of the
+        (current, expected) values. The current value is None if it isn't set.
+        """
+        config = self.config()
+        drift = {}
+        for (name, value) in values.items():
+            current = config.get(name)
+            if (current == value):
+                continue
+            if (current is not None):
+                if (value in self._CONFIG_TRUE and current.lower() in self._CONFIG_TRUE):
+                    continue
+                if (value in self._CONFIG_FALSE and current.lower() in self._CONFIG_FALSE):
+                    continue
+            drift[name] = (current, value)
+        return drift
+
+    def get_object_counts(self):
+        """Get the size of the object store from 'git count-objects -v'.
+
+        Returns a dictionary, e.g. 'count' and 'size' for loose objects, 'packs'
+        and 'size-pack' for packs, sizes in KiB.
+        """
         try:
-            if (rebase):
-                GitExe.run(
-                    ["config", "pull.rebase", "true"],
-                    cwd=self.top_level()
-                )
-            else:
-                GitExe.run(
-                    ["config", "pull.rebase", "false"],
-                    cwd=self.top_level()
-                )
+            git = GitExe.run(["count-objects", "-v"], cwd=self.top_level())
         except subprocess.CalledProcessError as ex:
-            if (exception is not None):
-                exception = ex
+            raise GitError(ex, errors=ex)
 
-        try:
-            GitExe.run(
-                ["config", "remote.origin.prune", "true"],
-                cwd=self.top_level()
-            )
-        except subprocess.CalledProcessError as ex:
-            if (exception is not None):
-                exception = ex
+        counts = {}
+        for line in git.stdout:
+            (key, sep, value) = line.partition(":")
+            try:
+                counts[key.strip()] = int(value.strip())
+            except ValueError:
+                pass
+        return counts
+
+    def get_index_size(self):
+        """Get the number of entries in the index, or None if unknown"""
+        refstore = self.refstore()
+        if (refstore is not None):
+            try:
+                hashsize = GitIndex.hash_size(self.config())
+                entries = GitIndex.entries(os.path.join(refstore.gitdir(), "index"), hashsize)
+                if (entries is not None):
+                    return len(entries)
+            except GitError:
+                pass
 
         try:
-            GitExe.run(
-                ["config", "push.default", "simple"],
-                cwd=self.top_level()
-            )
-        except subprocess.CalledProcessError as ex:
-            if (exception is not None):
-                exception = ex
+            return sum(1 for line in GitExe.stream(["ls-files"], cwd=self.top_level()))
+        except subprocess.CalledProcessError:
+            return None
 
-        if (exception is not None):
-            raise GitError(exception, errors=exception)
+    def maintenance(self):
+        """Write the commit-graph and multi-pack-index, pack loose objects and
+        incrementally repack.
+
+        Uses 'git maintenance run' if available, else the individual commands
+        that are supported by the version of git.
+        """
+        version = GitExe.version_info()
+        if (version >= (2, 29)):
+            # The multi-pack-index can't be written in the same run that
+            # creates the first pack from loose objects.
+            commands = [["maintenance", "run", "--task=commit-graph", "--task=loose-objects"],
+                        ["maintenance", "run", "--task=incremental-repack"],
+                        ["prune-packed", "-q"]]
+        else:
+            commands = []
+            if (version >= (2, 24)):
+                commands.append(["commit-graph", "write", "--reachable", "--split"])
+            elif (version >= (2, 19)):
+                commands.append(["commit-graph", "write", "--reachable"])
+            # Put the loose objects in a new pack, without touching other packs.
+            commands.append(["repack", "-d", "-q"])
+            commands.append(["prune-packed", "-q"])
+            if (version >= (2, 21)):
+                commands.append(["multi-pack-index", "write"])
+            if (version >= (2, 24)):
+                commands.append(["multi-pack-index", "expire"])
+
+        for cmd in commands:
+            try:
+                GitExe.run(cmd, cwd=self.top_level())
+            except subprocess.CalledProcessError as ex:
+                raise GitError(ex, errors=ex)
 
     def get_current_branch(self):
+        refstore = self.refstore()
+        if (refstore is not None):
+            symref = refstore.head()[1]
+            if (symref is None):
+                return None
+            if (symref.startswith("refs/heads/")):
+                return symref[11:]
+
         git = GitExe.run(
             ["symbolic-ref", "-q", "--short", "HEAD"],
             cwd=self.top_level(), check=False
@@ -408,6 +1734,17 @@ class GitModule:
         return None
 
     def get_current_hash(self):
+        refstore = self.refstore()
+        if (refstore is not None):
+            # This is None if executed in an empty repository.
+            return refstore.head()[0]
+
+        try:
+            # This is None if executed in an empty repository.
+            return self.catfile().resolve("HEAD")
+        except GitError:
+            pass
+
         try:
             git = GitExe.run(
                 ["rev-parse", 'HEAD'],
@@ -418,27 +1755,39 @@ class GitModule:
             # We can get here if executed in an empty repository.
             return None
 
-    def checkout_branch(self, branch=None, force=False):
+    def _checkout_args(self, branch, force, track=None, workers=None):
+        """Get the arguments to check out the branch, or None if nothing to do
+
+        If track is given, the local branch is created from the branch on that
+        remote. If workers is given, files are checked out in parallel with git
+        2.32 or later (0 is the number of CPUs).
+        """
         if (branch is None):
             if (self.default_branch is None):
-                return
+                return None
             branch = self.default_branch
 
-        try:
-            if (not force):
-                current_branch = self.get_current_branch()
-                if (current_branch is None or branch != current_branch):
-                    GitExe.run(
-                        ["checkout", branch],
-                        cwd=self.top_level()
-                    )
-            else:
-                GitExe.run(
-                    ["checkout", "-f", branch],
-                    cwd=self.top_level()
-                )
-        except subprocess.CalledProcessError as ex:
-            raise GitError(ex, errors=ex)
+        args = []
+        if (workers is not None and GitExe.version_info() >= (2, 32)):
+            args = ["-c", f"checkout.workers={workers}"]
+        target = [branch] if track is None else ["--track", f"{track}/{branch}"]
+
+        if (not force):
+            current_branch = self.get_current_branch()
+            if (current_branch is None or branch != current_branch):
+                return args + ["checkout"] + target
+            return None
+        return args + ["checkout", "-f"] + target
+
+    def checkout_branch(self, branch=None, force=False, track=None, workers=None):
+        args = self._checkout_args(branch, force, track, workers)
+        if (args is not None):
+            self._run(args)
+
+    async def checkout_branch_async(self, branch=None, force=False):
+        args = await GitExe.to_thread(self._checkout_args, branch, force)
+        if (args is not None):
+            await self._run_async(args)
 
     def get_ref_hash(self, gitref):
         """Get the hash for the given reference.
@@ -447,6 +1796,17 @@ class GitModule:
         """
         if (gitref is None):
             return None
+        refstore = self.refstore()
+        if (refstore is not None):
+            refhash = refstore.lookup(gitref)
+            if (refhash is not None):
+                return refhash
+
+        try:
+            return self.catfile().resolve(gitref)
+        except GitError:
+            pass
+
         try:
             git = GitExe.run(
                 ["rev-parse", "--verify", gitref],
@@ -456,7 +1816,56 @@ class GitModule:
         except subprocess.CalledProcessError:
             return None
 
-    _RE_SHOWREF = re.compile(r'^([0-9a-fA-F]+)\s+(\S+)$')
+    # Branches are only looked for locally and on the remotes, which avoids
+    # reading all the tags.
+    REF_NAMESPACES = ["refs/heads/", "refs/remotes/"]
+
+    def iter_ref_hashes(self, namespaces=None, merged=None):
+        """Get the references in the namespaces, as they're read.
+
+        Yields tuples in the form of (hash, ref), sorted by the ref. The default
+        namespaces are REF_NAMESPACES. If merged is given, only references
+        reachable from that commit are given.
+        """
+        if (namespaces is None):
+            namespaces = self.REF_NAMESPACES
+
+        refstore = self.refstore() if merged is None else None
+        if (refstore is not None):
+            yield from refstore.refs(namespaces)
+            return
+
+        args = ["for-each-ref", "--format=%(objectname) %(refname)"]
+        if (merged is not None):
+            args.append(f"--merged={merged}")
+        try:
+            for entry in GitExe.stream(args + namespaces, cwd=self.top_level()):
+                fields = entry.split(" ", 1)
+                if (len(fields) == 2):
+                    yield (fields[0], fields[1])
+        except subprocess.CalledProcessError as ex:
+            raise GitError(ex, errors=ex)
+
+    def iter_ref_dates(self, namespaces=None):
+        """Get the references in the namespaces with the date of their commit.
+
+        Yields tuples in the form of (hash, ref, time), where time is the
+        committer date in seconds since the epoch, or None if the reference
+        isn't a commit. The default namespaces are REF_NAMESPACES.
+        """
+        if (namespaces is None):
+            namespaces = self.REF_NAMESPACES
+
+        try:
+            for entry in GitExe.stream(
+                    ["for-each-ref", "--format=%(objectname) %(committerdate:unix) %(refname)"]
+                    + namespaces,
+                    cwd=self.top_level()):
+                fields = entry.split(" ", 2)
+                if (len(fields) == 3):
+                    yield (fields[0], fields[2], int(fields[1]) if fields[1].isdigit() else None)
+        except subprocess.CalledProcessError as ex:
+            raise GitError(ex, errors=ex)
 
     def get_ref_hashes(self, gitref=None):
         """Get all references for a branch/hash from heads and remotes.
@@ -466,20 +1875,16 @@ class GitModule:
         """
 
         try:
-            if (gitref is None):
-                git = GitExe.run(["show-ref"], cwd=self.top_level())
+            refs = self.iter_ref_hashes()
+            if (gitref is not None):
+                # Same matching as 'git show-ref <pattern>', the pattern must
+                # match the end of the reference name on complete components.
+                refs = [ref for ref in refs
+                        if ref[1] == gitref or ref[1].endswith(f"/{gitref}")]
             else:
-                git = GitExe.run(["show-ref", gitref], cwd=self.top_level())
-
-            refs = []
-            for entry in git.stdout:
-                m = self._RE_SHOWREF.match(entry)
-                if (m is not None):
-                    refhash = m.group(1)
-                    refname = m.group(2)
-                    refs.append((refhash, refname))
+                refs = list(refs)
             return refs if len(refs) > 0 else None
-        except subprocess.CalledProcessError:
+        except GitError:
             return None
 
     def get_branch_default_remote(self, branch):
@@ -487,6 +1892,11 @@ class GitModule:
         if (branch is None):
             return None
 
+        try:
+            return self.config().get(f"branch.{branch}.remote")
+        except GitError:
+            pass
+
         try:
             git = GitExe.run(
                 ["config", "--local", f"branch.{branch}.remote"],
@@ -497,14 +1907,28 @@ class GitModule:
             return None
 
     def get_tracking_branch_from_head(self):
-        try:
-            git_ref = GitExe.run(
-                ["symbolic-ref", "-q", "HEAD"],
-                cwd=self.top_level()
-            )
-            ref = git_ref.stdout[0]
-        except subprocess.CalledProcessError:
-            return None
+        refstore = self.refstore()
+        if (refstore is not None):
+            ref = refstore.head()[1]
+            if (ref is None):
+                return None
+        else:
+            try:
+                git_ref = GitExe.run(
+                    ["symbolic-ref", "-q", "HEAD"],
+                    cwd=self.top_level()
+                )
+                ref = git_ref.stdout[0]
+            except subprocess.CalledProcessError:
+                return None
+
+        if (ref.startswith("refs/heads/")):
+            try:
+                upstream = self._get_upstream(self.config(), ref[11:])
+                if (upstream is not None):
+                    return upstream if upstream != "" else None
+            except GitError:
+                pass
 
         try:
             git_remote_ref = GitExe.run(
@@ -517,16 +1941,54 @@ class GitModule:
         except subprocess.CalledProcessError:
             return None
 
-    def get_branches_remote_map(self):
+    @ staticmethod
+    def _get_upstream(config, branch):
+        """Get the short name of the upstream of the branch from the configuration.
+
+        Returns an empty string if there is no upstream, or None if it can't be
+        determined, in which case git should be asked.
+        """
+        remote = config.get(f"branch.{branch}.remote")
+        merge = config.get(f"branch.{branch}.merge")
+        if (remote is None or merge is None):
+            return ""
+
+        if (remote == "."):
+            upstream = merge
+        else:
+            # Map the merge reference through the fetch refspecs of the
+            # remote, e.g. '+refs/heads/*:refs/remotes/origin/*'
+            upstream = None
+            for refspec in config.get_all(f"remote.{remote}.fetch"):
+                refspec = refspec.lstrip("+")
+                if (":" not in refspec):
+                    continue
+                (src, dst) = refspec.split(":", 1)
+                if (src.endswith("*") and dst.endswith("*")):
+                    if (merge.startswith(src[:-1])):
+                        upstream = dst[:-1] + merge[len(src) - 1:]
+                        break
+                elif (src == merge):
+                    upstream = dst
+                    break
+            if (upstream is None):
+                return None
+
+        for prefix in ["refs/heads/", "refs/remotes/", "refs/tags/", "refs/"]:
+            if (upstream.startswith(prefix)):
+                return upstream[len(prefix):]
+        return upstream
+
+    def get_branches_remote_map(self, merged=None):
         """Get all branches for local and remotes.
 
         Returns a dictionary where the key is a remote, and the value is a set
-        of the references.
+        of the references. If merged is given, only the branches merged into
+        that commit are given.
         """
 
         remotes = {}
-        refs = self.get_ref_hashes()
-        for ref in refs:
+        for ref in self.iter_ref_hashes(merged=merged):
             if (ref[1].startswith("refs/heads/")):
                 remote = None
                 branch = ref[1][11:]
@@ -546,6 +2008,82 @@ class GitModule:
 
         return remotes
 
+    def resolve_branch(self, branches):
+        """Get the first of the branches that can be checked out, and the remote to track.
+
+        A local branch is checked out. Else a local branch is created from the
+        same branch on the default remote, or the only remote that has it.
+        Else, if it names a commit (e.g. a tag or a hash), it's checked out
+        with a detached HEAD. Returns (None, None) if none of the branches
+        exist.
+        """
+        refs = self.get_branches_remote_map()
+        for branch in branches:
+            if (branch is None):
+                continue
+            if (branch in refs.get(None, set())):
+                return (branch, None)
+            remotes = [remote for remote in refs if remote is not None and branch in refs[remote]]
+            if (DEFAULT_REMOTE in remotes):
+                return (branch, DEFAULT_REMOTE)
+            if (len(remotes) == 1):
+                return (branch, remotes[0])
+            # Tags and remote branches are read from the reference store. Only
+            # anything else (e.g. a hash) is asked of git.
+            refstore = self.refstore()
+            if (refstore is not None and refstore.lookup(branch) is not None):
+                return (branch, None)
+            if (self.get_ref_hash(f"{branch}^{{commit}}") is not None):
+                return (branch, None)
+        return (None, None)
+
+    def get_worktrees(self):
+        """Get the working trees of the repository.
+
+        Returns a list of tuples in the form of (path, branch), where branch is
+        None if the HEAD is detached.
+        """
+        worktrees = []
+        path = None
+        branch = None
+        try:
+            for line in GitExe.stream(["worktree", "list", "--porcelain"], cwd=self.top_level()):
+                if (line.startswith("worktree ")):
+                    if (path is not None):
+                        worktrees.append((path, branch))
+                    path = line[9:]
+                    branch = None
+                elif (line.startswith("branch refs/heads/")):
+                    branch = line[18:]
+        except subprocess.CalledProcessError as ex:
+            raise GitError(ex, errors=ex)
+        if (path is not None):
+            worktrees.append((path, branch))
+        return worktrees
+
+    def add_worktree(self, path, branch=None, track=None, detach=False):
+        """Add a working tree at the path, sharing the object store.
+
+        If track is given, the local branch is created from the branch on that
+        remote. If detach is True, or no branch is given, the HEAD is detached.
+        """
+        args = ["worktree", "add"]
+        if (track is not None):
+            args.extend(["--track", "-b", branch, path, f"{track}/{branch}"])
+        elif (detach or branch is None):
+            args.extend(["--detach", path])
+            if (branch is not None):
+                args.append(branch)
+        else:
+            args.extend([path, branch])
+        self._run(args)
+
+    def remove_worktree(self, path, force=False):
+        args = ["worktree", "remove"]
+        if (force):
+            args.append("--force")
+        self._run(args + [path])
+
     _RE_BRANCH_REMOTE_KEY = re.compile(r'^branch\.(\S+)\.remote=(\S+)$')
 
     def get_default_remotes_map(self):
@@ -555,230 +2093,1903 @@ class GitModule:
         default remote.
         """
 
-        git_config = GitExe.run(
-            ["config", "--local", "--list"],
-            cwd=self.top_level()
-        )
-        branches = {}
-        for line in git_config.stdout:
-            m = self._RE_BRANCH_REMOTE_KEY.match(line)
-            if (m is not None):
-                branch = m.group(1)
-                remote = m.group(2)
-                branches[branch] = remote
-        return branches
+        try:
+            config = self.config()
+        except GitError:
+            config = None
+
+        if (config is not None):
+            branches = {}
+            for (branch, keys) in config.subsections("branch").items():
+                if ("remote" in keys):
+                    branches[branch] = keys["remote"]
+            return branches
+
+        git_config = GitExe.run(
+            ["config", "--local", "--list"],
+            cwd=self.top_level()
+        )
+        branches = {}
+        for line in git_config.stdout:
+            m = self._RE_BRANCH_REMOTE_KEY.match(line)
+            if (m is not None):
+                branch = m.group(1)
+                remote = m.group(2)
+                branches[branch] = remote
+        return branches
+
+    def get_is_dirty(self):
+        git_dirty = GitExe.run(
+            ["diff-index", "--quiet", "HEAD", "--", "."],
+            cwd=self.top_level(), check=False
+        )
+        if (git_dirty.returncode != 0):
+            return True
+        return False
+
+    def get_status(self):
+        """Get the status of the repository with a single git command.
+
+        Returns a GitStatus object. The hash is None for an empty repository,
+        the branch is None if the HEAD is detached. The ahead and behind
+        counts are None if there is no upstream, or it doesn't exist.
+        """
+
+        try:
+            git = GitExe.run(
+                ["status", "--porcelain=v2", "--branch", "--untracked-files=no"],
+                cwd=self.top_level()
+            )
+        except subprocess.CalledProcessError as ex:
+            raise GitError(ex, errors=ex)
+
+        status = GitStatus()
+        for line in git.stdout:
+            if (line.startswith("# branch.oid ")):
+                oid = line[13:]
+                status.hash = oid if oid != "(initial)" else None
+            elif (line.startswith("# branch.head ")):
+                head = line[14:]
+                status.branch = head if head != "(detached)" else None
+            elif (line.startswith("# branch.upstream ")):
+                status.upstream = line[18:]
+            elif (line.startswith("# branch.ab ")):
+                ab = line[12:].split()
+                status.ahead = int(ab[0][1:])
+                status.behind = int(ab[1][1:])
+            elif (not line.startswith("#") and not line.startswith("?") and not line.startswith("!")):
+                # Ordinary, renamed or unmerged changes to tracked files.
+                status.dirty = True
+        return status
+
+    def get_count_ahead_behind(self, current, base):
+        """Count commits on each side of 'current...base'.
+
+        Returns a tuple (ahead, behind), where ahead is the number of commits
+        in current not in base, and behind is the number of commits in base
+        not in current. Returns None if this can't be calculated.
+        """
+        if (current is None or base is None):
+            return None
+
+        try:
+            git = GitExe.run(
+                ["rev-list", "--left-right", "--count", f"{current}...{base}"],
+                cwd=self.top_level()
+            )
+            counts = git.stdout[0].split()
+            return (int(counts[0]), int(counts[1]))
+        except (subprocess.CalledProcessError, IndexError, ValueError):
+            return None
+
+    _RE_TRACK = re.compile(r'^(?:ahead (\d+))?(?:, )?(?:behind (\d+))?$')
+
+    def get_branches_status(self, base=None):
+        """Get the status of all local branches with a single 'git for-each-ref'.
+
+        Returns a list of GitBranchStatus. The ahead and behind counts to the
+        upstream are None if there's no upstream. The counts to the base commit
+        come from the 'ahead-behind' format of git 2.41 or later, else they
+        are counted with one 'git rev-list --left-right --count' per branch.
+        """
+        fields = ["%(refname)", "%(objectname)", "%(HEAD)", "%(upstream:short)",
+                  "%(upstream:track,nobracket)"]
+        aheadbehind = base is not None and GitExe.version_info() >= (2, 41)
+        if (aheadbehind):
+            fields.append(f"%(ahead-behind:{base})")
+
+        branches = []
+        try:
+            for line in GitExe.stream(
+                    ["for-each-ref", "--format=" + "%00".join(fields), "refs/heads/"],
+                    cwd=self.top_level()):
+                values = line.split("\0")
+                if (len(values) != len(fields)):
+                    continue
+                branch = GitBranchStatus()
+                branch.branch = values[0][11:]
+                branch.hash = values[1]
+                branch.current = values[2] == "*"
+                if (values[3] != ""):
+                    branch.upstream = values[3]
+                    if (values[4] == "gone"):
+                        branch.upstream_gone = True
+                    else:
+                        m = self._RE_TRACK.match(values[4])
+                        if (m is not None):
+                            branch.ahead = int(m.group(1) or 0)
+                            branch.behind = int(m.group(2) or 0)
+                if (aheadbehind):
+                    counts = values[5].split()
+                    branch.base_ahead = int(counts[0])
+                    branch.base_behind = int(counts[1])
+                branches.append(branch)
+        except subprocess.CalledProcessError as ex:
+            raise GitError(ex, errors=ex)
+
+        if (base is not None and not aheadbehind):
+            for branch in branches:
+                counts = self.get_count_ahead_behind(branch.hash, base)
+                if (counts is not None):
+                    (branch.base_ahead, branch.base_behind) = counts
+        return branches
+
+    def _run(self, args):
+        try:
+            GitExe.run(args, cwd=self.top_level())
+        except subprocess.CalledProcessError as ex:
+            raise GitError(ex, errors=ex)
+
+    async def _run_async(self, args):
+        try:
+            await GitExe.run_async(args, cwd=self.top_level())
+        except subprocess.CalledProcessError as ex:
+            raise GitError(ex, errors=ex)
+
+    @ staticmethod
+    def _pull_args(ffonly=False, force=False, recurse=True):
+        args = ["pull"]
+        if (ffonly):
+            args.append("--ff-only")
+        if (force):
+            args.append("--force")
+        if (recurse):
+            args.append("--recurse-submodules")
+        else:
+            args.append("--no-recurse-submodules")
+        return args
+
+    def pull(self, ffonly=False, force=False, recurse=True):
+        self._run(self._pull_args(ffonly, force, recurse))
+
+    async def pull_async(self, ffonly=False, force=False, recurse=True):
+        await self._run_async(self._pull_args(ffonly, force, recurse))
+
+    @ staticmethod
+    def _fetch_args(force=False, recurse=True):
+        args = ["fetch", "--all", "--prune"]
+        if (force):
+            args.append("--force")
+        if (recurse):
+            args.append("--recurse-submodules")
+        else:
+            args.append("--no-recurse-submodules")
+        return args
+
+    def fetch(self, force=False, recurse=True):
+        self._run(self._fetch_args(force, recurse))
+
+    async def fetch_async(self, force=False, recurse=True):
+        await self._run_async(self._fetch_args(force, recurse))
+
+    # The options given to 'git rj init' for shallow, partial and sparse
+    # clones, kept in the configuration of each module.
+    CONFIG_DEPTH = "gitrj.depth"
+    CONFIG_FILTER = "gitrj.filter"
+    CONFIG_SPARSE = "gitrj.sparse"
+
+    def set_partial_clone(self, spec):
+        """Only fetch objects matching the filter spec (e.g. 'blob:none') from now on.
+
+        A clone made with the filter is already set up. Otherwise the first
+        fetch with a filter sets up the remote to be used for missing objects.
+        """
+        try:
+            if (self.config().get(f"remote.{DEFAULT_REMOTE}.partialclonefilter") == spec):
+                return
+        except GitError:
+            pass
+        self._run(["fetch", f"--filter={spec}", DEFAULT_REMOTE])
+
+    def unshallow(self):
+        """Fetch the complete history, if only part of the history was fetched"""
+        refstore = self.refstore()
+        if (refstore is None or not os.path.exists(os.path.join(refstore.commondir(), "shallow"))):
+            return
+        self._run(["fetch", "--unshallow", DEFAULT_REMOTE])
+
+    def set_sparse_checkout(self, paths):
+        """Only check out the directories given (in cone mode), or all files if None"""
+        if (paths is None):
+            # Sparse checkouts are usually set in config.worktree
+            git = GitExe.run(
+                ["config", "--bool", "core.sparseCheckout"],
+                cwd=self.top_level(), check=False
+            )
+            if (git.returncode == 0 and len(git.stdout) > 0 and git.stdout[0] == "true"):
+                self._run(["sparse-checkout", "disable"])
+            return
+
+        self._run(["sparse-checkout", "init", "--cone"])
+        self._run(["sparse-checkout", "set"] + list(paths))
+
+    def reset_hard(self, reference):
+        self._run(["reset", "--hard", reference])
+
+    async def reset_hard_async(self, reference):
+        await self._run_async(["reset", "--hard", reference])
+
+    def clean(self):
+        try:
+            GitExe.run(
+                ["clean", "-xfd"],
+                cwd=self.top_level()
+            )
+        except subprocess.CalledProcessError as ex:
+            raise GitError(ex, errors=ex)
+
+    def get_untracked(self):
+        """Get the untracked and ignored files, which 'git clean -xfd' removes.
+
+        Directories that are completely untracked are given once, ending with
+        '/'. The paths are relative to the top level of the module.
+        """
+        try:
+            return [path for path in GitExe.stream(
+                ["ls-files", "--others", "--directory", "-z"],
+                cwd=self.top_level(), separator="\0") if path != ""]
+        except subprocess.CalledProcessError as ex:
+            raise GitError(ex, errors=ex)
+
+    def delete_branch(self, branch, remote=None):
+        if (branch is None):
+            return
+        self.delete_branches([branch], remote)
+
+    def delete_branches(self, branches, remote=None):
+        """Delete the local branches, or the branches on the remote.
+
+        Local branches are deleted with a single 'git branch -D', which deletes
+        the branches it can. Remote branches are deleted with a single atomic
+        'git push', so either all or none are deleted. If the remote doesn't
+        support atomic pushes, a normal push is done.
+        """
+        if (len(branches) == 0):
+            return
+
+        try:
+            if (remote is None):
+                GitExe.run(
+                    ["branch", "-D"] + list(branches),
+                    cwd=self.top_level()
+                )
+            else:
+                refspecs = [f":{branch}" for branch in branches]
+                try:
+                    GitExe.run(
+                        ["push", "--atomic", remote] + refspecs,
+                        cwd=self.top_level()
+                    )
+                except subprocess.CalledProcessError as ex:
+                    if ("does not support --atomic" not in (ex.stderr or "")):
+                        raise
+                    GitExe.run(
+                        ["push", remote] + refspecs,
+                        cwd=self.top_level()
+                    )
+        except subprocess.CalledProcessError as ex:
+            raise GitError(ex, errors=ex)
+
+
+class GitStatus:
+    """Record for the state of a repository, as given by 'git status'"""
+
+    def __init__(self):
+        self.hash = None
+        self.branch = None
+        self.upstream = None
+        self.ahead = None
+        self.behind = None
+        self.dirty = False
+
+
+class GitBranchStatus:
+    """Record for the state of a local branch, compared to its upstream and a base"""
+
+    def __init__(self):
+        self.branch = None
+        self.hash = None
+        self.current = False
+        self.upstream = None
+        self.upstream_gone = False
+        self.ahead = None
+        self.behind = None
+        self.base_ahead = None
+        self.base_behind = None
+
+
+class GitIndex:
+    """Read the entries of the index file of a repository (versions 2 to 4).
+
+    Only the mode and path of each entry are read. Returns None for index files
+    that aren't understood, e.g. a split index, so the caller can ask git.
+    """
+
+    GITLINK = 0o160000
+
+    _HEADER = struct.Struct(">4sLL")
+    _ENTRY = struct.Struct(">24xL")
+
+    @ staticmethod
+    def hash_size(config):
+        """Get the size of an object hash in bytes, from the repository configuration"""
+        return 32 if config.get("extensions.objectformat") == "sha256" else 20
+
+    @ staticmethod
+    def entries(path, hashsize=20):
+        """Get a list of tuples (mode, path) for the index file, or None"""
+        try:
+            with open(path, "rb") as indexfile:
+                data = indexfile.read()
+        except OSError:
+            return None
+        if (len(data) < GitIndex._HEADER.size):
+            return None
+
+        (signature, version, count) = GitIndex._HEADER.unpack_from(data, 0)
+        if (signature != b"DIRC" or version not in [2, 3, 4]):
+            return None
+
+        entries = []
+        offset = GitIndex._HEADER.size
+        previous = b""
+        try:
+            for _ in range(count):
+                start = offset
+                (mode,) = GitIndex._ENTRY.unpack_from(data, offset)
+                offset += 40 + hashsize
+                flags = int.from_bytes(data[offset:offset + 2], "big")
+                offset += 2
+                if (flags & 0x4000):
+                    # Extended flags (version 3 or later)
+                    offset += 2
+                if (version == 4):
+                    # The path removes N bytes from the previous path and
+                    # appends a NUL terminated suffix.
+                    (strip, offset) = GitIndex._varint(data, offset)
+                    end = data.index(b"\0", offset)
+                    name = previous[:len(previous) - strip] + data[offset:end]
+                    offset = end + 1
+                else:
+                    end = data.index(b"\0", offset)
+                    name = data[offset:end]
+                    # Entries are padded with 1 to 8 NUL bytes to a multiple of 8.
+                    offset = start + ((end - start + 8) & ~7)
+                previous = name
+                entries.append((mode, os.fsdecode(name)))
+
+            # A split index stores entries in another file.
+            while (offset + 8 <= len(data) - hashsize):
+                extension = data[offset:offset + 4]
+                if (extension == b"link"):
+                    return None
+                offset += 8 + int.from_bytes(data[offset + 4:offset + 8], "big")
+        except (ValueError, struct.error):
+            return None
+        return entries
+
+    @ staticmethod
+    def _varint(data, offset):
+        value = data[offset] & 0x7f
+        while (data[offset] & 0x80):
+            offset += 1
+            value = ((value + 1) << 7) | (data[offset] & 0x7f)
+        return (value, offset + 1)
+
+
+class StatusCache:
+    """Cache the status of modules in their git directory.
+
+    The status is stored in the file 'gitrj/status.json' of the git directory,
+    with a signature of the files it depends on: HEAD, the index, the
+    configuration, the references and packed-refs, and every file in the index
+    (or the signature of a submodule, for a submodule entry). If nothing
+    changed, the status is read back instead of asking git.
+
+    Files changed within the last two seconds may have the same time stamp
+    after another change, so a signature isn't given for them.
+    """
+
+    FILE = os.path.join("gitrj", "status.json")
+    RACY_NS = 2000000000
+
+    def __init__(self):
+        self._signatures = {}
+        self._lock = threading.Lock()
+
+    def signature(self, worktree):
+        """Get the signature of the working tree, or None if it can't be cached"""
+        worktree = os.path.abspath(worktree)
+        with self._lock:
+            if (worktree in self._signatures):
+                return self._signatures[worktree]
+        signature = self._signature(worktree)
+        with self._lock:
+            self._signatures[worktree] = signature
+        return signature
+
+    def _signature(self, worktree):
+        import hashlib
+        refstore = GitRefStore(worktree)
+        if (not refstore.supported()):
+            return None
+        gitdir = refstore.gitdir()
+        commondir = refstore.commondir()
+
+        start = int(time.time() * 1000000000)
+        newest = 0
+        items = []
+
+        def _stat(path):
+            nonlocal newest
+            try:
+                st = os.lstat(path)
+            except OSError:
+                items.append((path, None))
+                return
+            newest = max(newest, st.st_mtime_ns, st.st_ctime_ns)
+            items.append((path, st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino, st.st_mode))
+
+        for name in ["HEAD", "index", "config.worktree"]:
+            _stat(os.path.join(gitdir, name))
+        for name in ["config", "packed-refs"]:
+            _stat(os.path.join(commondir, name))
+        for namespace in GitModule.REF_NAMESPACES:
+            for (dirpath, dirnames, filenames) in os.walk(os.path.join(commondir, namespace)):
+                _stat(dirpath)
+                for filename in filenames:
+                    _stat(os.path.join(dirpath, filename))
+
+        try:
+            config = GitConfig(os.path.join(commondir, "config"))
+            hashsize = GitIndex.hash_size(config)
+        except GitError:
+            return None
+        entries = GitIndex.entries(os.path.join(gitdir, "index"), hashsize)
+        if (entries is None):
+            return None
+        for (mode, name) in entries:
+            path = os.path.join(worktree, name)
+            if (mode & 0o170000 == GitIndex.GITLINK):
+                # A submodule is modified by its own changes.
+                submodule = self.signature(path) if os.path.exists(os.path.join(path, ".git")) else ""
+                if (submodule is None):
+                    return None
+                items.append((name, submodule))
+            else:
+                _stat(path)
+
+        if (newest > start - self.RACY_NS):
+            return None
+        return hashlib.sha1(repr(items).encode()).hexdigest()
+
+    @ staticmethod
+    def _file(module):
+        refstore = module.refstore()
+        if (refstore is None or refstore.gitdir() is None):
+            return None
+        return os.path.join(refstore.gitdir(), StatusCache.FILE)
+
+    def lookup(self, module, key):
+        """Get the cached result and the token for storing a new result.
+
+        The result is None if it isn't cached, or the module changed. A result
+        is only used for the same hash of HEAD and the same default branch, which
+        gives the destination branch.
+        """
+        signature = self.signature(module.top_level())
+        refstore = module.refstore()
+        if (signature is None or refstore is None):
+            return (None, None)
+        token = {
+            "signature": signature,
+            "head": refstore.head()[0],
+            "branch": module.default_branch,
+        }
+        try:
+            with open(self._file(module)) as cacheFile:
+                cache = json.load(cacheFile)
+            result = cache.get(key)
+        except (OSError, TypeError, ValueError, AttributeError):
+            return (None, token)
+        if (isinstance(result, dict) and all(result.get(field) == token[field] for field in token)):
+            return (result.get("status"), token)
+        return (None, token)
+
+    def store(self, module, key, value, token):
+        """Store the result computed when the token was given by lookup()"""
+        if (token is None):
+            return
+        path = self._file(module)
+        if (path is None):
+            return
+        try:
+            with open(path) as cacheFile:
+                cache = json.load(cacheFile)
+            if (not isinstance(cache, dict)):
+                cache = {}
+        except (OSError, ValueError):
+            cache = {}
+        cache[key] = dict(token, status=value)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.{os.getpid()}", "w") as cacheFile:
+                json.dump(cache, cacheFile)
+            os.replace(f"{path}.{os.getpid()}", path)
+        except OSError:
+            pass
+
+
+class GitSubModule:
+    """Record for keeping information about a submodule"""
+
+    def __init__(self):
+        self.path = None
+        self.uri = None
+        self.branch = None
+
+
+class GitModules:
+    """maintain a list of git submodules"""
+
+    def __init__(self):
+        self._path = os.getcwd()
+        self._toplevel = None
+        self._modules = None
+
+    def top_level(self):
+        """Get the top level directory for the super project"""
+
+        top_super = None
+        if (self._toplevel is None):
+            try:
+                git_super = GitExe.run(
+                    ["rev-parse", "--show-superproject-working-tree"],
+                    cwd=self._path
+                )
+                if (len(git_super.stdout) > 0):
+                    top_super = git_super.stdout[0]
+            except subprocess.CalledProcessError:
+                # Either the command isn't supported, or we're not in a GIT
+                # repo.
+                pass
+
+            if (top_super is None):
+                try:
+                    git_top = GitExe.run(
+                        ["rev-parse", "--show-toplevel"],
+                        cwd=self._path
+                    )
+                    self._toplevel = os.path.realpath(git_top.stdout[0])
+                except subprocess.CalledProcessError:
+                    self._toplevel = None
+            else:
+                self._toplevel = \
+                    os.path.realpath(top_super) if top_super is not None else None
+
+        return self._toplevel
+
+    def at_base(self):
+        """Check if we're at the top level git repository, and not in some submodule"""
+        git_toplevel = self.top_level()
+        if (git_toplevel is None):
+            return False
+
+        git_cwd = os.getcwd()
+        return (git_toplevel == git_cwd)
+
+    _RE_SUBMODULE_KEY = re.compile(r'submodule\.(\S+)\.(\S+)=(.+)')
+
+    def _read_submodules(self, parent=None):
+        """Return a list of GitModule objects for the .gitmodules file of the parent.
+
+        The superproject is read if parent is None. Paths are relative to the
+        top level of the superproject.
+        """
+
+        top = self.top_level()
+        base = top if parent is None else os.path.join(top, parent.path())
+        configfile = os.path.join(base, ".gitmodules")
+        if (not os.path.isfile(configfile)):
+            return []
+
+        module_configs = {}
+        try:
+            config = GitConfig(configfile)
+        except GitError:
+            config = None
+
+        if (config is not None):
+            for (mk, keys) in config.subsections("submodule").items():
+                module_config = GitSubModule()
+                module_config.path = keys.get("path")
+                module_config.branch = keys.get("branch")
+                module_config.uri = keys.get("url")
+                module_configs[mk] = module_config
+            git_modules_lines = []
+        else:
+            git_modules = GitExe.run(
+                ["config", "--file", ".gitmodules", "--list"],
+                cwd=base
+            )
+            git_modules_lines = git_modules.stdout
+
+        for line in git_modules_lines:
+            m = self._RE_SUBMODULE_KEY.match(line)
+            if (m is not None):
+                mk = m.group(1)
+                if (mk in module_configs):
+                    module_config = module_configs[mk]
+                else:
+                    module_config = GitSubModule()
+                    module_configs[mk] = module_config
+                mp = m.group(2)
+                mv = m.group(3)
+                if (mp == "path"):
+                    module_configs[mk].path = mv
+                elif (mp == "branch"):
+                    module_configs[mk].branch = mv
+                elif (mp == "url"):
+                    module_configs[mk].uri = mv
+
+        modules = []
+        for module in sorted(module_configs):
+            relpath = module_configs[module].path
+            if (relpath is None):
+                continue
+            if (parent is not None):
+                relpath = f"{parent.path()}/{relpath}"
+            git_module = GitModule(relpath, cwd=top)
+            git_module.default_branch = module_configs[module].branch
+            git_module.url = module_configs[module].uri
+            git_module.parent = parent
+            modules.append(git_module)
+        return modules
+
+    def get_submodules(self):
+        """Return a list of GitModule objects for each submodule at the current superproject.
+
+        Nested submodules of initialized submodules are discovered too, one
+        level at a time with the .gitmodules files of a level read in parallel.
+        The result is the flattened tree, each module followed by its nested
+        submodules, which refer to the module containing them by 'parent'.
+        """
+        import concurrent.futures
+        if (self.top_level() is None):
+            return []
+
+        if (self._modules is None):
+            children = {}
+            level = self._read_submodules()
+            toplevel = level
+            with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+                while (len(level) > 0):
+                    initialized = [
+                        module for module in level
+                        if os.path.exists(os.path.join(self.top_level(), module.path(), ".git"))
+                    ]
+                    level = []
+                    nested = pool.map(self._read_submodules, initialized)
+                    for (module, submodules) in zip(initialized, nested):
+                        children[module.path()] = submodules
+                        level.extend(submodules)
+
+            modules = []
+            pending = list(reversed(toplevel))
+            while (len(pending) > 0):
+                module = pending.pop()
+                modules.append(module)
+                pending.extend(reversed(children.get(module.path(), [])))
+            self._modules = modules
+
+        return self._modules
+
+    def get_levels(self):
+        """Return the submodules grouped by how deep they are nested.
+
+        Commands that change the working tree run one level after the other, so
+        that a nested submodule isn't used while its parent checks out or
+        rebases the commit it's at.
+        """
+        levels = []
+        for module in self.get_submodules():
+            depth = 0
+            parent = module.parent
+            while (parent is not None):
+                depth += 1
+                parent = parent.parent
+            while (len(levels) <= depth):
+                levels.append([])
+            levels[depth].append(module)
+        return levels
+
+    def get_children(self, module):
+        """Return the submodules nested directly in the module"""
+        return [submodule for submodule in self.get_submodules() if submodule.parent is module]
+
+    def git_submodules_init(self, force=False, jobs=MAX_WORKERS, depth=None, filter=None):
+        cmd = ["submodule", "update", "--init", "--recursive", "--jobs", str(jobs)]
+        if (force):
+            cmd.append("--force")
+        if (depth is not None):
+            cmd.append(f"--depth={depth}")
+        if (filter is not None):
+            cmd.append(f"--filter={filter}")
+        try:
+            GitExe.run(cmd, cwd=self.top_level())
+        except subprocess.CalledProcessError as ex:
+            raise GitError(ex, errors=ex)
+
+
+class ModuleTimings:
+    """The time each module took for each command on previous runs.
+
+    The timings are stored in the file 'gitrj/timings.json' of the git directory
+    of the super project, as a dictionary of commands to a dictionary of module
+    paths to the time in seconds. New times are averaged with the previous.
+    """
+
+    FILE = os.path.join("gitrj", "timings.json")
+
+    def __init__(self, path):
+        self._file = None
+        self._timings = {}
+        self._changed = False
+        self._lock = threading.Lock()
+
+        commondir = GitRefStore(path).commondir()
+        if (commondir is None):
+            return
+        self._file = os.path.join(commondir, self.FILE)
+        try:
+            with open(self._file) as timingsFile:
+                timings = json.load(timingsFile)
+            if (isinstance(timings, dict)):
+                self._timings = timings
+        except (OSError, ValueError):
+            pass
+
+    def get(self, command, module):
+        """Get the time for the module, or None if it isn't known"""
+        timing = self._timings.get(command, {}).get(module)
+        return timing if isinstance(timing, (int, float)) else None
+
+    def update(self, command, module, seconds):
+        """Record the time for the module"""
+        with self._lock:
+            timings = self._timings.setdefault(command, {})
+            previous = timings.get(module)
+            if (isinstance(previous, (int, float))):
+                seconds = (previous + seconds) / 2
+            timings[module] = round(seconds, 3)
+            self._changed = True
+
+    def save(self):
+        """Write the timings, if they changed"""
+        if (self._file is None or not self._changed):
+            return
+        try:
+            os.makedirs(os.path.dirname(self._file), exist_ok=True)
+            with open(self._file + ".tmp", "w") as timingsFile:
+                json.dump(self._timings, timingsFile, indent=1, sort_keys=True)
+            os.replace(self._file + ".tmp", self._file)
+            self._changed = False
+        except OSError:
+            pass
+
+
+class WorkerLimit:
+    """Limit the number of modules being run at the same time.
+
+    With a fixed limit, at most that number of modules run at once. In the
+    automatic mode, the limit starts low and is raised each time a window of
+    modules completes faster than the previous window, until the throughput
+    stops improving or the maximum is reached. The limit then goes back to the
+    last value that improved the throughput.
+    """
+
+    RAMP_IMPROVEMENT = 1.1
+
+    def __init__(self, workers, maximum=None):
+        self.workers = workers
+        self.maximum = workers if maximum is None else max(workers, maximum)
+        self._ramping = self.maximum > self.workers
+        self._running = 0
+        self._window = 0
+        self._window_start = None
+        self._best_rate = 0.0
+        self._previous = workers
+        self._condition = threading.Condition()
+
+    def try_acquire(self):
+        """Start a module if the limit allows it, returning False otherwise"""
+        with self._condition:
+            if (self._running >= self.workers):
+                return False
+            self._running += 1
+            if (self._window_start is None):
+                self._window_start = time.monotonic()
+            return True
+
+    def acquire(self):
+        """Wait until a module can be started"""
+        with self._condition:
+            while (not self.try_acquire()):
+                self._condition.wait()
+
+    def release(self):
+        """Record that a module has finished"""
+        with self._condition:
+            self._running -= 1
+            if (self._ramping):
+                self._ramp()
+            self._condition.notify_all()
+
+    def _ramp(self):
+        self._window += 1
+        if (self._window < max(self.workers, 2)):
+            return
+
+        elapsed = time.monotonic() - self._window_start
+        rate = self._window / elapsed if elapsed > 0 else float("inf")
+        self._window = 0
+        self._window_start = time.monotonic()
+
+        if (rate > self._best_rate * self.RAMP_IMPROVEMENT):
+            self._best_rate = rate
+            self._previous = self.workers
+            self.workers = min(self.maximum, self.workers + max(1, self.workers // 2))
+            self._ramping = self.workers > self._previous
+        else:
+            self.workers = self._previous
+            self._ramping = False
+        if (GITDEBUGLEVEL >= 1):
+            print(f"WORKERS: {self.workers} ({rate:.1f}/s)", flush=True)
+
+
+class ModuleExecutor:
+    """Run a function for each module in parallel.
+
+    The "thread" engine calls the function for each module from a pool of
+    threads. The "async" engine awaits a coroutine function for each module on
+    an asyncio event loop, so that more git processes can be running than there
+    are threads. If there is no coroutine function, the function is called from
+    a thread pool of the event loop.
+
+    The number of modules run at the same time is given by the option --jobs,
+    the environment variable GITRJ_JOBS_<COMMAND> or GITRJ_JOBS, the "jobs"
+    section of .gitrjbuild, else it is automatic. Network operations (fetch,
+    pull) are sized independently of disk operations (status, clean).
+    """
+
+    ENGINES = ["thread", "async"]
+    AUTO = "auto"
+
+    # The estimate of a run is only printed if it takes at least this many
+    # seconds.
+    ETA_MINIMUM = 1.0
+
+    def __init__(self, engine="thread", jobs=AUTO, network=False, command=None):
+        self.engine = engine
+        self.command = command
+        self.quiet = False
+        cpus = os.cpu_count() or 1
+        if (jobs != ModuleExecutor.AUTO):
+            self.limit = WorkerLimit(jobs)
+        elif (network):
+            # Network operations spend most of their time waiting, so start
+            # with a larger pool and ramp up while the throughput increases.
+            self.limit = WorkerLimit(
+                min(max(MAX_WORKERS, cpus), MAX_NETWORK_WORKERS), MAX_NETWORK_WORKERS)
+        else:
+            # Disk bound operations thrash the disk with too many workers.
+            # Start small and ramp up to the number of CPUs.
+            self.limit = WorkerLimit(min(2, cpus), cpus)
+
+    @ property
+    def workers(self):
+        """The number of modules currently allowed to run at the same time"""
+        return self.limit.workers
+
+    @ staticmethod
+    def _module_name(module):
+        path = module.path()
+        if (os.path.isabs(path)):
+            path = os.path.relpath(path)
+        return "base" if path == "." else path.replace(os.sep, "/")
+
+    def _schedule(self, modules, timings):
+        """Sort the modules with the longest first, and print the estimated time.
+
+        Modules without a previous time are started first, so they don't end
+        up last.
+        """
+        times = [timings.get(self.command, self._module_name(module)) for module in modules]
+        order = sorted(range(len(modules)),
+                       key=lambda index: -times[index] if times[index] is not None else float("-inf"))
+
+        if (any(timing is not None for timing in times)):
+            # Assign each module to the first worker that is free.
+            workers = [0.0] * min(self.limit.workers, len(modules))
+            for index in order:
+                heapq.heappush(workers, heapq.heappop(workers) + (times[index] or 0.0))
+            estimate = max(workers)
+            if (estimate >= self.ETA_MINIMUM and not self.quiet):
+                print(f"\033[35;1mEstimated:\033[0;35m {estimate:.1f}s for {len(modules)} modules\033[0m",
+                      flush=True)
+        return [modules[index] for index in order]
+
+    @ staticmethod
+    def _closing(func):
+        def _run(module, **kwargs):
+            try:
+                return func(module, **kwargs)
+            finally:
+                module.close()
+        return _run
+
+    @ staticmethod
+    def _closing_async(afunc):
+        async def _run(module, **kwargs):
+            try:
+                return await afunc(module, **kwargs)
+            finally:
+                module.close()
+        return _run
+
+    def _timed(self, timings, func):
+        def _run(module, **kwargs):
+            start = time.monotonic()
+            try:
+                return func(module, **kwargs)
+            finally:
+                timings.update(self.command, self._module_name(module), time.monotonic() - start)
+        return _run
+
+    def _timed_async(self, timings, afunc):
+        async def _run(module, **kwargs):
+            start = time.monotonic()
+            try:
+                return await afunc(module, **kwargs)
+            finally:
+                timings.update(self.command, self._module_name(module), time.monotonic() - start)
+        return _run
+
+    def run(self, modules, func, afunc=None, **kwargs):
+        """Call func(module, **kwargs) or await afunc(module, **kwargs) for each module
+
+        If the executor is for a command, the modules are started in order of
+        the longest time they took on previous runs, and the times are updated.
+        The git sessions of each module are closed when it's finished.
+        """
+        modules = list(modules)
+        func = self._closing(func)
+        if (afunc is not None):
+            afunc = self._closing_async(afunc)
+        timings = None
+        if (self.command is not None and len(modules) > 0):
+            timings = ModuleTimings(os.getcwd())
+            modules = self._schedule(modules, timings)
+            func = self._timed(timings, func)
+            if (afunc is not None):
+                afunc = self._timed_async(timings, afunc)
+
+        try:
+            if (self.engine == "async"):
+                self._run_async(modules, func, afunc, kwargs)
+            else:
+                self._run_threads(modules, func, kwargs)
+        finally:
+            if (timings is not None):
+                timings.save()
+
+    def _run_threads(self, modules, func, kwargs):
+        import concurrent.futures
+        limit = self.limit
+        futures = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=limit.maximum) as executor:
+            for module in modules:
+                limit.acquire()
+                future = executor.submit(func, module, **kwargs)
+                future.add_done_callback(lambda f: limit.release())
+                futures.append(future)
+
+        # The functions report errors of git themselves. Anything else is a
+        # bug, raised once all modules are finished.
+        for future in futures:
+            future.result()
+
+    def _run_async(self, modules, func, afunc, kwargs):
+        import asyncio
+        import concurrent.futures
+        if (platform.system() == "Windows"):
+            # Needed for subprocesses before Python 3.8
+            loop = asyncio.ProactorEventLoop()
+        else:
+            loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        limit = self.limit
+        threadpool = None
+        if (afunc is None):
+            threadpool = concurrent.futures.ThreadPoolExecutor(max_workers=limit.maximum)
+
+        async def _module(module):
+            if (afunc is not None):
+                await afunc(module, **kwargs)
+            else:
+                await loop.run_in_executor(
+                    threadpool, functools.partial(func, module, **kwargs))
+
+        async def _main():
+            released = asyncio.Event()
+
+            def _release(task):
+                limit.release()
+                released.set()
+
+            tasks = []
+            for module in modules:
+                while (not limit.try_acquire()):
+                    await released.wait()
+                    released.clear()
+                task = loop.create_task(_module(module))
+                task.add_done_callback(_release)
+                tasks.append(task)
+
+            # The functions report errors of git themselves. Anything else is
+            # a bug, raised once all modules are finished.
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for result in results:
+                if (isinstance(result, BaseException)):
+                    raise result
+
+        try:
+            loop.run_until_complete(_main())
+        finally:
+            if (threadpool is not None):
+                threadpool.shutdown()
+            loop.close()
+            asyncio.set_event_loop(None)
+
+    @ staticmethod
+    def parse_jobs(value):
+        """Convert the number of jobs to an integer, or "auto"."""
+        value = str(value).strip().lower()
+        if (value == ModuleExecutor.AUTO):
+            return ModuleExecutor.AUTO
+        try:
+            jobs = int(value)
+        except ValueError:
+            jobs = 0
+        if (jobs < 1):
+            raise ValueError(f"Invalid number of jobs '{value}'")
+        return jobs
+
+    @ staticmethod
+    def _config_jobs(command):
+        if (not os.path.isfile(".gitrjbuild")):
+            return None
+
+        try:
+            with open(".gitrjbuild") as configFile:
+                config = json.load(configFile)
+        except json.decoder.JSONDecodeError as ex:
+            raise CommandError(f"Error loading .gitrjbuild - {ex.msg} (Line:{ex.lineno}, Col:{ex.colno})")
+
+        # The platform specific section overrides the global section.
+        jobs = None
+        for cplatform in ["", platform.system()]:
+            if (cplatform in config and "jobs" in config[cplatform]):
+                jobsconfig = config[cplatform]["jobs"]
+                if (command in jobsconfig):
+                    jobs = jobsconfig[command]
+                elif ("default" in jobsconfig):
+                    jobs = jobsconfig["default"]
+        return jobs
+
+    @ staticmethod
+    def get_jobs(command, jobs=None):
+        """Get the number of jobs for the command
+
+        The command line option takes precedence, then the environment variables
+        GITRJ_JOBS_<COMMAND> and GITRJ_JOBS, then the .gitrjbuild file.
+        """
+        if (jobs is not None):
+            return jobs
+
+        for env in [f"GITRJ_JOBS_{command.upper()}", "GITRJ_JOBS"]:
+            if (env in os.environ):
+                source = f"environment variable {env}"
+                jobs = os.environ[env]
+                break
+        else:
+            source = ".gitrjbuild"
+            jobs = ModuleExecutor._config_jobs(command)
+            if (jobs is None):
+                return ModuleExecutor.AUTO
+
+        try:
+            return ModuleExecutor.parse_jobs(jobs)
+        except ValueError as ex:
+            raise CommandError(f"{str(ex)} in {source}")
+
+    @ staticmethod
+    def add_arguments(argparser, engine=False):
+        """Add the command line options for the executor to the command
+
+        The option --engine is only added for commands with coroutines for the
+        "async" engine.
+        """
+        if (engine):
+            default = os.environ.get("GITRJ_ENGINE", "thread")
+            if (default not in ModuleExecutor.ENGINES):
+                default = "thread"
+            argparser.add_argument(
+                "--engine", choices=ModuleExecutor.ENGINES, default=default,
+                help="How modules are run in parallel: 'thread' uses a pool of threads, "
+                "'async' runs git processes from an asyncio event loop. The default can "
+                "be set with the environment variable GITRJ_ENGINE.")
+        argparser.add_argument(
+            "-j", "--jobs", type=ModuleExecutor._jobs_argument, metavar="JOBS",
+            help="The number of modules to run in parallel, or 'auto' to size from "
+            "the number of CPUs and the observed throughput. The default can be set "
+            "with the environment variables GITRJ_JOBS_<COMMAND> or GITRJ_JOBS, or "
+            "in the 'jobs' section of .gitrjbuild.")
+
+    @ staticmethod
+    def _jobs_argument(value):
+        try:
+            return ModuleExecutor.parse_jobs(value)
+        except ValueError as ex:
+            raise argparse.ArgumentTypeError(str(ex))
+
+    @ staticmethod
+    def from_arguments(arguments, command, network=False):
+        """Get the executor for the parsed command line options"""
+        jobs = ModuleExecutor.get_jobs(command, arguments.jobs)
+        engine = getattr(arguments, "engine", "thread")
+        executor = ModuleExecutor(engine=engine, jobs=jobs, network=network, command=command)
+        # Only records may be printed for machine readable output.
+        executor.quiet = getattr(arguments, "format", ModuleReport.TEXT) != ModuleReport.TEXT
+        return executor
+
+
+class ModuleReport:
+    """Print the result of a command for each module as soon as it's done.
+
+    The "text" format prints the lines given by the command. The "json" and
+    "ndjson" formats print a record for each module without colours, followed
+    by a summary record with the time taken by each module. The "ndjson" format
+    prints one record per line, the "json" format prints an array of records
+    (one record per line, so it can be read as it's printed).
+    """
+
+    TEXT = "text"
+    FORMATS = [TEXT, "json", "ndjson"]
+
+    _instance = None
+
+    def __init__(self, command, format=TEXT):
+        self.command = command
+        self.format = format
+        self.timings = {}
+        self.modules = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._printed = False
+        self._closed = False
+
+    @ property
+    def text(self):
+        """If the output is for the console"""
+        return self.format == ModuleReport.TEXT
+
+    def _print(self, record):
+        if (self.format == "json" and not self._printed):
+            print("[")
+        self._printed = True
+        if (self.format == "json" and record.get("type") != "summary"):
+            print(json.dumps(record) + ",", flush=True)
+        else:
+            print(json.dumps(record), flush=True)
+
+    def print(self, lines):
+        """Print lines to the console. Nothing is printed for the other formats."""
+        if (self.text and lines):
+            with self._lock:
+                print("\n".join(lines), flush=True)
+
+    def record(self, module, status, lines=None, **fields):
+        """Print the result for a module.
+
+        The lines are printed for the "text" format, else a record of the
+        status and fields for the module is printed. The status is "done" or
+        "failed".
+        """
+        with self._lock:
+            self.modules += 1
+            if (status == "failed"):
+                self.failed += 1
+            if (self.text):
+                if (lines):
+                    print("\n".join(lines), flush=True)
+                return
+            record = {"type": "module", "module": ModuleExecutor._module_name(module), "status": status}
+            record.update(fields)
+            self._print(record)
+
+    def _time(self, module, start):
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self.timings[ModuleExecutor._module_name(module)] = round(elapsed, 3)
+
+    def timed(self, func):
+        """Wrap func(module, **kwargs) to measure the time taken for each module"""
+        def _run(module, **kwargs):
+            start = time.monotonic()
+            try:
+                return func(module, **kwargs)
+            finally:
+                self._time(module, start)
+        return _run
+
+    def timed_async(self, afunc):
+        """Wrap the coroutine function afunc(module, **kwargs) to measure the time"""
+        async def _run(module, **kwargs):
+            start = time.monotonic()
+            try:
+                return await afunc(module, **kwargs)
+            finally:
+                self._time(module, start)
+        return _run
+
+    def summary(self, **fields):
+        """Print the summary record with the timings of all modules"""
+        if (self.text):
+            return
+        record = {
+            "type": "summary",
+            "command": self.command,
+            "modules": self.modules,
+            "failed": self.failed,
+            "seconds": round(time.monotonic() - self._start, 3),
+            "timings": self.timings
+        }
+        record.update(fields)
+        with self._lock:
+            self._print(record)
+            if (self.format == "json"):
+                print("]", flush=True)
+            self._closed = True
+
+    @ staticmethod
+    def close(error=None):
+        """Complete the output of the last report, if the command didn't.
+
+        If the command failed before printing the summary, it's printed now
+        with 'complete' false, so that the "json" array is always closed.
+        Returns True if the output is machine readable, so that the caller
+        doesn't print the error to stdout.
+        """
+        report = ModuleReport._instance
+        ModuleReport._instance = None
+        if (report is None or report.text):
+            return False
+        if (not report._closed):
+            fields = {"complete": False}
+            if (error is not None):
+                fields["error"] = error
+            report.summary(**fields)
+        return True
+
+    @ staticmethod
+    def add_arguments(argparser):
+        """Add the command line option for the output format to the command"""
+        argparser.add_argument(
+            "--format", choices=ModuleReport.FORMATS, default=ModuleReport.TEXT,
+            help="The output format. 'json' and 'ndjson' print a record for each module "
+            "as soon as it's done, followed by a summary with the time for each module.")
+
+    @ staticmethod
+    def from_arguments(arguments, command):
+        """Get the report for the parsed command line options"""
+        report = ModuleReport(command, arguments.format)
+        ModuleReport._instance = report
+        return report
+
+
+class TreeCleaner:
+    """Remove files and directory trees with a pool of threads.
 
-    def get_is_dirty(self):
-        git_dirty = GitExe.run(
-            ["diff-index", "--quiet", "HEAD", "--", "."],
-            cwd=self.top_level(), check=False
-        )
-        if (git_dirty.returncode != 0):
-            return True
-        return False
+    Each directory is read with os.scandir() by a thread of the pool, which
+    removes its files and queues its subdirectories for the other threads. The
+    directories are removed last, the deepest first. Like 'git clean -d',
+    nested git repositories are kept. With dry_run, the files are only counted.
+    """
 
-    def get_merge_base(self, current, base):
-        if (current is None or base is None):
-            return None
+    def __init__(self, workers=None, dry_run=False):
+        import concurrent.futures
+        if (workers is None):
+            # Removing files waits mostly on the file system.
+            workers = min(32, (os.cpu_count() or 1) * 4)
+        self.dry_run = dry_run
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
 
-        try:
-            git = GitExe.run(
-                ["merge-base", current, base],
-                cwd=self.top_level()
-            )
-            return git.stdout[0]
-        except subprocess.CalledProcessError:
-            return None
+    def close(self):
+        self._pool.shutdown()
 
-    def get_count_commits(self, current, base):
-        if (current is None or base is None):
-            return None
+    @ staticmethod
+    def _nested(path):
+        return os.path.lexists(os.path.join(path, ".git"))
 
+    def _unlink(self, path):
+        if (self.dry_run):
+            return
         try:
-            git = GitExe.run(
-                ["rev-list", "--count", current, f"^{base}"],
-                cwd=self.top_level()
-            )
-            return int(git.stdout[0])
-        except subprocess.CalledProcessError:
-            return None
+            os.unlink(path)
+        except PermissionError:
+            # Read-only files can't be removed on Windows.
+            os.chmod(path, S_IWRITE)
+            os.unlink(path)
 
-    def pull(self, ffonly=False, force=False, recurse=True):
-        args = ["pull"]
-        if (ffonly):
-            args.append("--ff-only")
-        if (force):
-            args.append("--force")
-        if (recurse):
-            args.append("--recurse-submodules")
-        else:
-            args.append("--no-recurse-submodules")
+    def remove(self, paths):
+        """Remove the files and directories.
 
-        try:
-            GitExe.run(args, cwd=self.top_level())
-        except subprocess.CalledProcessError as ex:
-            raise GitError(ex, errors=ex)
+        Returns a tuple of the number of files, the number of directories, the
+        size of the files in bytes, and a list of errors.
+        """
+        condition = threading.Condition()
+        pending = 0
+        directories = []
+        totals = [0, 0]
+        errors = []
+
+        def _add(files, size, error=None):
+            with condition:
+                totals[0] += files
+                totals[1] += size
+                if (error is not None):
+                    errors.append(error)
+
+        def _submit(path):
+            nonlocal pending
+            with condition:
+                pending += 1
+            self._pool.submit(_scan, path)
+
+        def _scan(path):
+            nonlocal pending
+            try:
+                files = 0
+                size = 0
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        try:
+                            if (entry.is_dir(follow_symlinks=False)):
+                                if (not self._nested(entry.path)):
+                                    _submit(entry.path)
+                                continue
+                            size += entry.stat(follow_symlinks=False).st_size
+                            self._unlink(entry.path)
+                            files += 1
+                        except OSError as ex:
+                            _add(0, 0, ex)
+                with condition:
+                    directories.append(path)
+                _add(files, size)
+            except OSError as ex:
+                _add(0, 0, ex)
+            finally:
+                with condition:
+                    pending -= 1
+                    if (pending == 0):
+                        condition.notify_all()
+
+        for path in paths:
+            try:
+                if (os.path.isdir(path) and not os.path.islink(path)):
+                    if (not self._nested(path)):
+                        _submit(path)
+                    continue
+                size = os.lstat(path).st_size
+                self._unlink(path)
+                _add(1, size)
+            except OSError as ex:
+                _add(0, 0, ex)
+
+        with condition:
+            while (pending > 0):
+                condition.wait()
+
+        if (not self.dry_run):
+            for path in sorted(directories, key=lambda path: -path.count(os.sep)):
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    # It still has a nested repository, or a file that
+                    # couldn't be removed.
+                    pass
+        return (totals[0], len(directories), totals[1], errors)
 
-    def fetch(self, force=False, recurse=True):
-        args = ["fetch", "--all", "--prune"]
-        if (force):
-            args.append("--force")
-        if (recurse):
-            args.append("--recurse-submodules")
-        else:
-            args.append("--no-recurse-submodules")
 
-        try:
-            GitExe.run(args, cwd=self.top_level())
-        except subprocess.CalledProcessError as ex:
-            raise GitError(ex, errors=ex)
+class InotifyWatcher:
+    """Watch the git directories and working trees of modules with inotify.
 
-    def reset_hard(self, reference):
-        args = ["reset", "--hard", reference]
+    Each module has a generation for its git directory (HEAD, index, config,
+    refs, packed-refs, FETCH_HEAD) and one for its working tree, which are
+    incremented when a file changes. A result computed for a module is still
+    valid if the generations haven't changed. If a module can't be watched
+    (e.g. there are not enough inotify watches), it has no generation and must
+    always be recomputed.
 
-        try:
-            GitExe.run(args, cwd=self.top_level())
-        except subprocess.CalledProcessError as ex:
-            raise GitError(ex, errors=ex)
+    This is only available on Linux.
+    """
 
-    def clean(self):
-        try:
-            GitExe.run(
-                ["clean", "-xfd"],
-                cwd=self.top_level()
-            )
-        except subprocess.CalledProcessError as ex:
-            raise GitError(ex, errors=ex)
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0x00000800
+    IN_CLOEXEC = 0x00080000
+
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+        IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+    GIT = 0
+    TREE = 1
+
+    _EVENT = struct.Struct("iIII")
 
-    def delete_branch(self, branch, remote=None):
-        if (branch is None):
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if (self._fd < 0):
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        # Watch descriptor to (module, kind, directory)
+        self._watches = {}
+        self._modules = {}
+        self._generations = {}
+        self._unwatched = set()
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        os.close(self._fd)
+
+    # The files in the git directory that change the state of the module
+    GITFILES = ["HEAD", "index", "config", "packed-refs", "FETCH_HEAD", "ORIG_HEAD",
+                "MERGE_HEAD", "refs"]
+
+    def _watch(self, module, kind, path, gitroot=False):
+        import ctypes
+        wd = self._add_watch(self._fd, os.fsencode(path), self.MASK)
+        if (wd < 0):
+            errno = ctypes.get_errno()
+            if (errno in [2, 20]):
+                # ENOENT, ENOTDIR: it was removed while walking
+                return
+            raise OSError(errno, f"Can't watch {path}")
+        self._watches[wd] = (module, kind, path, gitroot)
+
+    def _watch_tree(self, module, kind, path, exclude):
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            self._watch(module, kind, dirpath)
+            if (kind == self.TREE):
+                # Don't descend into the git directory, nested repositories
+                # or other modules, which are watched on their own.
+                dirnames[:] = [dirname for dirname in dirnames
+                               if (dirname != ".git" and
+                                   os.path.join(dirpath, dirname) not in exclude and
+                                   not os.path.exists(os.path.join(dirpath, dirname, ".git")))]
+
+    def watch_module(self, module, worktree, exclude=None):
+        """Watch the module with the working tree path, if not already watched.
+
+        The exclude list contains directories of the working tree that belong
+        to other modules.
+        """
+        if (module in self._modules or module in self._unwatched):
             return
 
+        exclude = set(exclude) if exclude is not None else set()
+        refstore = GitRefStore(worktree)
+        gitdir = refstore.gitdir()
+        commondir = refstore.commondir()
+        self._generations[module] = [0, 0]
         try:
-            if (remote is None):
-                GitExe.run(
-                    ["branch", "-D", branch],
-                    cwd=self.top_level()
-                )
-            else:
-                GitExe.run(
-                    ["push", remote, f":{branch}"],
-                    cwd=self.top_level()
-                )
-        except subprocess.CalledProcessError as ex:
-            raise GitError(ex, errors=ex)
+            if (gitdir is None or not refstore.supported()):
+                raise OSError(f"Can't find the git directory for {worktree}")
+            self._watch(module, self.GIT, gitdir, gitroot=True)
+            if (commondir != gitdir):
+                self._watch(module, self.GIT, commondir, gitroot=True)
+            self._watch_tree(module, self.GIT, os.path.join(commondir, "refs"), exclude)
+            self._watch_tree(module, self.TREE, worktree, exclude)
+        except OSError as ex:
+            if (GITDEBUGLEVEL > 0):
+                print(f"DAEMON: Not watching {module}: {str(ex)}", flush=True)
+            self._unwatched.add(module)
+            del self._generations[module]
+            return
+        self._modules[module] = exclude
 
+    def process(self):
+        """Read all pending events, updating the generations of the modules"""
+        while (True):
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while (offset < len(data)):
+                (wd, mask, cookie, length) = self._EVENT.unpack_from(data, offset)
+                name = data[offset + self._EVENT.size:offset + self._EVENT.size + length]
+                name = os.fsdecode(name.rstrip(b"\0"))
+                offset += self._EVENT.size + length
+                self._event(wd, mask, name)
+
+    def _event(self, wd, mask, name):
+        if (mask & self.IN_Q_OVERFLOW):
+            # Events were lost, so nothing can be trusted.
+            for generation in self._generations.values():
+                generation[self.GIT] += 1
+                generation[self.TREE] += 1
+            return
 
-class GitSubModule:
-    """Record for keeping information about a submodule"""
+        watch = self._watches.get(wd)
+        if (watch is None):
+            return
+        (module, kind, path, gitroot) = watch
+        if (mask & self.IN_IGNORED):
+            del self._watches[wd]
+            return
+        if (module not in self._generations):
+            return
+        if (name.endswith(".lock")):
+            # The lock file is renamed when it's committed, which we'll see.
+            return
+        if (gitroot and name not in self.GITFILES):
+            # e.g. objects, logs, or the files of this script.
+            return
 
-    def __init__(self):
-        self.path = None
-        self.uri = None
-        self.branch = None
+        self._generations[module][kind] += 1
+        if (not gitroot and mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO)):
+            # Watch new directories in the working tree and the references.
+            try:
+                self._watch_tree(module, kind, os.path.join(path, name), self._modules[module])
+            except OSError:
+                self._unwatched.add(module)
+                self._modules.pop(module, None)
+                self._generations.pop(module, None)
 
+    def generation(self, module):
+        """Get the generations (git, tree) for the module, or None if it isn't watched"""
+        generation = self._generations.get(module)
+        return tuple(generation) if generation is not None else None
 
-class GitModules:
-    """maintain a list of git submodules"""
 
-    def __init__(self):
-        self._path = os.getcwd()
-        self._toplevel = None
-        self._modules = None
+class DaemonCache:
+    """Results for modules cached by the daemon, checked against the watcher.
 
-    def top_level(self):
-        """Get the top level directory for the super project"""
+    The base module includes the state of all submodules (e.g. modified
+    submodules), so it's only valid if no module changed. A submodule also
+    depends on the .gitmodules file giving its default branch.
+    """
 
-        top_super = None
-        if (self._toplevel is None):
+    def __init__(self, watcher, top):
+        self._watcher = watcher
+        self._top = top
+        self._results = {}
+        self.modules = []
+        self.hits = 0
+        self.misses = 0
+
+    def token(self, module):
+        """Get the token identifying the current state of the module, or None"""
+        if (module != "base"):
+            generation = self._watcher.generation(module)
+            if (generation is None):
+                return None
+            return (generation, self._gitmodules(module))
+
+        tokens = []
+        for name in ["base"] + self.modules:
+            generation = self._watcher.generation(name)
+            if (generation is None):
+                return None
+            tokens.append(generation)
+        return tuple(tokens)
+
+    def _gitmodules(self, module):
+        """Get the state of the .gitmodules files of the base and the parents of the module"""
+        state = []
+        parents = [name for name in self.modules if module.startswith(name + "/")]
+        for parent in [self._top] + [os.path.join(self._top, name) for name in parents]:
             try:
-                git_super = GitExe.run(
-                    ["rev-parse", "--show-superproject-working-tree"],
-                    cwd=self._path
-                )
-                if (len(git_super.stdout) > 0):
-                    top_super = git_super.stdout[0]
-            except subprocess.CalledProcessError:
-                # Either the command isn't supported, or we're not in a GIT
-                # repo.
-                pass
+                st = os.stat(os.path.join(parent, ".gitmodules"))
+                state.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                state.append(None)
+        return tuple(state)
 
-            if (top_super is None):
-                try:
-                    git_top = GitExe.run(
-                        ["rev-parse", "--show-toplevel"],
-                        cwd=self._path
-                    )
-                    self._toplevel = os.path.realpath(git_top.stdout[0])
-                except subprocess.CalledProcessError:
-                    self._toplevel = None
-            else:
-                self._toplevel = \
-                    os.path.realpath(top_super) if top_super is not None else None
+    def lookup(self, module, name, key):
+        """Get the cached result and the token for storing a new result.
 
-        return self._toplevel
+        The result is None if it isn't cached, or the module changed.
+        """
+        token = self.token(name)
+        result = self._results.get((name, key))
+        if (token is not None and result is not None and result[0] == token):
+            self.hits += 1
+            return (result[1], token)
+        self.misses += 1
+        return (None, token)
+
+    def store(self, module, name, key, value, token):
+        """Store the result computed when the token was given by lookup()"""
+        if (token is not None):
+            self._results[(name, key)] = (token, value)
+
+
+class Daemon:
+    """A resident process that keeps the state of the workspace for commands.
+
+    The daemon listens on the Unix socket 'gitrj/daemon.sock' in the git
+    directory of the super project. Commands that can be answered by the
+    daemon send their arguments as a JSON line, and get back the output and
+    exit code. If the daemon isn't running, the command runs directly.
+
+    The 'status' of each module, and the output of 'shbr', are cached until
+    the watcher sees a change to the module.
+    """
 
-    def at_base(self):
-        """Check if we're at the top level git repository, and not in some submodule"""
-        git_toplevel = self.top_level()
-        if (git_toplevel is None):
-            return False
+    COMMANDS = ["status", "shbr", "show-branch"]
+    SOCKET = os.path.join("gitrj", "daemon.sock")
+    LOG = os.path.join("gitrj", "daemon.log")
+    IDLE_TIMEOUT = 3600
 
-        git_cwd = os.getcwd()
-        return (git_toplevel == git_cwd)
+    # A daemon that is busy, or doesn't answer, is given up on after this many
+    # seconds, and the command runs directly.
+    REQUEST_TIMEOUT = 5
 
-    _RE_SUBMODULE_KEY = re.compile(r'submodule\.(\S+)\.(\S+)=(.+)')
+    @ staticmethod
+    def path(top, name):
+        """Get the path of a daemon file for the super project, or None"""
+        commondir = GitRefStore(top).commondir()
+        if (commondir is None):
+            return None
+        return os.path.join(commondir, name)
 
-    def get_submodules(self):
-        """Return a list of GitModule objects for each submodule at the current superproject."""
+    @ staticmethod
+    def _script():
+        # The daemon only answers the same version of the script as the client.
+        script = os.path.realpath(__file__)
+        return f"{script}:{os.stat(script).st_mtime_ns}"
 
-        configfile = os.path.join(self.top_level(), ".gitmodules")
-        if (not os.path.isfile(configfile)):
-            return []
+    @ staticmethod
+    def request(top, request, timeout=None):
+        """Send the request to the daemon, returning the response, or None"""
+        sockpath = Daemon.path(top, Daemon.SOCKET)
+        if (sockpath is None or not os.path.exists(sockpath)):
+            return None
 
-        if (self._modules is None):
-            git_modules = GitExe.run(
-                ["config", "--file", ".gitmodules", "--list"],
-                cwd=self.top_level()
-            )
-            module_configs = {}
-            for line in git_modules.stdout:
-                m = self._RE_SUBMODULE_KEY.match(line)
-                if (m is not None):
-                    mk = m.group(1)
-                    if (mk in module_configs):
-                        module_config = module_configs[mk]
-                    else:
-                        module_config = GitSubModule()
-                        module_configs[mk] = module_config
-                    mp = m.group(2)
-                    mv = m.group(3)
-                    if (mp == "path"):
-                        module_configs[mk].path = mv
-                    elif (mp == "branch"):
-                        module_configs[mk].branch = mv
-                    elif (mp == "url"):
-                        module_configs[mk].uri = mv
+        import socket
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.settimeout(timeout)
+                client.connect(sockpath)
+                client.sendall(json.dumps(request).encode() + b"\n")
+                client.shutdown(socket.SHUT_WR)
+                data = []
+                for chunk in iter(lambda: client.recv(65536), b""):
+                    data.append(chunk)
+            return json.loads(b"".join(data).decode())
+        except (OSError, ValueError):
+            return None
 
-            modules = []
-            for module in sorted(module_configs):
-                git_module = GitModule(
-                    module_configs[module].path, cwd=self.top_level())
-                git_module.default_branch = module_configs[module].branch
-                git_module.url = module_configs[module].uri
-                modules.append(git_module)
-            self._modules = modules
+    @ staticmethod
+    def execute(command, arguments):
+        """Execute the command by the daemon, returning False if it should run directly"""
+        if (platform.system() != "Linux" or command not in Daemon.COMMANDS):
+            return False
+        if (os.environ.get("GITRJ_DAEMON", "1") == "0" or Profiler._instance is not None):
+            return False
 
-        return self._modules
+        response = Daemon.request(os.getcwd(), {
+            "argv": [command] + arguments,
+            "cwd": os.getcwd(),
+            "script": Daemon._script(),
+        }, timeout=Daemon.REQUEST_TIMEOUT)
+        if (response is None or "output" not in response):
+            return False
 
-    def git_submodules_init(self, force=False):
-        cmd = ["submodule", "update", "--init", "--jobs", "8"]
-        if (force):
-            cmd.append("--force")
+        print(response["output"], end="", flush=True)
+        if (response["exitcode"] != 0):
+            sys.exit(response["exitcode"])
+        return True
+
+    def __init__(self, top):
+        self.top = top
+        self.watcher = InotifyWatcher()
+        self.cache = DaemonCache(self.watcher, self.top)
+        self._shbr = {}
+        self._requests = 0
+        self._started = time.time()
+
+    def _watch_modules(self):
+        modules = GitModules()
+        submodules = modules.get_submodules()
+        self.cache.modules = [module.path() for module in submodules]
+        self.watcher.watch_module(
+            "base", self.top,
+            exclude=[os.path.join(self.top, module.path()) for module in submodules])
+        for module in submodules:
+            self.watcher.watch_module(
+                module.path(), os.path.join(self.top, module.path()),
+                exclude=[os.path.join(self.top, child.path())
+                         for child in modules.get_children(module)])
+
+    def _run(self, argv):
+        """Run the command, returning the output and the exit code"""
+        self._watch_modules()
+
+        buffer = io.StringIO()
+        exitcode = 0
+        with contextlib.redirect_stdout(buffer):
+            try:
+                if (argv[0] == "status"):
+                    command = StatusCommand(argv[1:])
+                    if (not command.arguments.no_cache):
+                        command.cache = self.cache
+                    command.execute()
+                else:
+                    # The branches only change with the references.
+                    command = ShbrCommand(argv[1:])
+                    tokens = [self.watcher.generation(module)
+                              for module in ["base"] + self.cache.modules]
+                    token = None
+                    if (None not in tokens and command.cacheable()):
+                        token = tuple(generation[InotifyWatcher.GIT] for generation in tokens)
+                    key = tuple(argv[1:])
+                    if (token is not None and key in self._shbr and self._shbr[key][0] == token):
+                        print(self._shbr[key][1], end="")
+                    else:
+                        command.execute()
+                        if (token is not None):
+                            self._shbr[key] = (token, buffer.getvalue())
+            except CommandError as ex:
+                # Machine readable output has the error in the summary.
+                if (not ModuleReport.close(str(ex))):
+                    print(f"Error: 'git rj {argv[0]}':")
+                    print("", str(ex))
+                exitcode = ex.exitcode
+            except SystemExit as ex:
+                exitcode = ex.code if isinstance(ex.code, int) else 1
+            finally:
+                ModuleReport.close()
+        return (buffer.getvalue(), exitcode)
+
+    def _handle(self, connection):
+        data = []
+        connection.settimeout(10)
+        for chunk in iter(lambda: connection.recv(65536), b""):
+            data.append(chunk)
+        request = json.loads(b"".join(data).decode())
+
+        if ("stop" in request):
+            return ({"stopped": os.getpid()}, True)
+        if ("ping" in request):
+            return ({
+                "pid": os.getpid(),
+                "uptime": time.time() - self._started,
+                "requests": self._requests,
+                "modules": len(self.cache.modules) + 1,
+                "hits": self.cache.hits,
+                "misses": self.cache.misses,
+            }, False)
+
+        if (request.get("script") != Daemon._script()):
+            return ({"error": "The daemon is running a different version"}, False)
+        if (os.path.realpath(request.get("cwd", "")) != os.path.realpath(self.top)):
+            return ({"error": "Not at the top level repository"}, False)
+        argv = request.get("argv", [])
+        if (len(argv) == 0 or argv[0] not in Daemon.COMMANDS):
+            return ({"error": "Command not supported by the daemon"}, False)
+
+        self._requests += 1
+        (output, exitcode) = self._run(["shbr" if argv[0] == "show-branch" else argv[0]] + argv[1:])
+        return ({"output": output, "exitcode": exitcode}, False)
+
+    def serve(self, sockpath):
+        """Answer requests on the socket until stopped, or idle for IDLE_TIMEOUT"""
+        import socket
+        # Only report, don't refresh the index, else our own 'git status'
+        # would invalidate the result.
+        os.environ["GIT_OPTIONAL_LOCKS"] = "0"
+        self._watch_modules()
+
+        if (os.path.exists(sockpath)):
+            os.unlink(sockpath)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        oldmask = os.umask(0o077)
         try:
-            GitExe.run(cmd, cwd=self.top_level())
-        except subprocess.CalledProcessError as ex:
-            raise GitError(ex, errors=ex)
+            server.bind(sockpath)
+        finally:
+            os.umask(oldmask)
+        server.listen(16)
+
+        selector = selectors.DefaultSelector()
+        selector.register(server, selectors.EVENT_READ)
+        selector.register(self.watcher, selectors.EVENT_READ)
+        stop = False
+        last = time.monotonic()
+        try:
+            while (not stop):
+                events = selector.select(timeout=60)
+                if (time.monotonic() - last > self.IDLE_TIMEOUT):
+                    break
+
+                # Changes are always read before answering, so a request made
+                # after a change never sees the old result.
+                self.watcher.process()
+                for (key, mask) in events:
+                    if (key.fileobj is not server):
+                        continue
+                    (connection, address) = server.accept()
+                    with connection:
+                        try:
+                            self.watcher.process()
+                            (response, stop) = self._handle(connection)
+                            connection.sendall(json.dumps(response).encode())
+                        except Exception as ex:
+                            # The client runs the command itself if there's no
+                            # answer, and the daemon keeps running.
+                            print(f"DAEMON: Request failed: {str(ex)}", flush=True)
+                    last = time.monotonic()
+        finally:
+            selector.close()
+            server.close()
+            try:
+                os.unlink(sockpath)
+            except OSError:
+                pass
+            self.watcher.close()
 
 
 class EnvironmentError(Exception):
@@ -986,9 +4197,19 @@ class VersionCommand:
         self.argparser = argparse.ArgumentParser(
             prog="git rj version",
             description="Print the version of this script, and the Python interpreter in use")
+        self.argparser.add_argument(
+            "--benchmark", nargs="?", type=int, const=20, default=None, metavar="RUNS",
+            help="Measure the startup time, by running 'git rj version' RUNS times "
+            "(default 20) with the interpreter, the script and the bootstrapper.")
         self.arguments = self.argparser.parse_args(arguments)
+        if (self.arguments.benchmark is not None and self.arguments.benchmark < 1):
+            raise ArgumentError("The number of runs must be at least 1")
 
     def execute(self):
+        if (self.arguments.benchmark is not None):
+            self._benchmark(self.arguments.benchmark)
+            return
+
         print("git rj")
         print("  Version: {}".format(VERSION))
         print(
@@ -1000,6 +4221,38 @@ class VersionCommand:
         )
         print("  GIT: {}".format(GitExe.version()))
 
+    @ staticmethod
+    def _benchmark(runs):
+        """Print the minimum, median and 95th percentile time to start.
+
+        The interpreter alone is the lower bound. The script is run directly,
+        so it's compiled each time, and through the bootstrapper next to it
+        (if there is one), which loads it from the cached bytecode.
+        """
+        import shutil
+        script = os.path.abspath(__file__)
+        commands = [
+            ("python", [sys.executable, "-c", "pass"]),
+            ("git-rj.py", [sys.executable, script, "version"]),
+        ]
+        bootstrapper = os.path.splitext(script)[0]
+        bash = shutil.which("bash")
+        if (os.path.isfile(bootstrapper) and bash is not None):
+            commands.append(("git-rj", [bash, bootstrapper, "version"]))
+
+        print(f"\033[35;1mStartup:\033[0;35m {runs} runs\033[0m")
+        width = max(len(name) for (name, _) in commands)
+        print(f"{'Command':<{width}}  {'Min':>8}  {'Median':>8}  {'P95':>8}")
+        for (name, cmd) in commands:
+            durations = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                durations.append(time.perf_counter() - start)
+            durations.sort()
+            median = durations[len(durations) // 2]
+            print(f"{name:<{width}}  {durations[0]:>7.3f}s  {median:>7.3f}s  {Profiler._p95(durations):>7.3f}s")
+
 
 class HelpCommand:
     """Provides some very basic help information"""
@@ -1023,11 +4276,17 @@ class HelpCommand:
         print("  git rj cobr - Check out a branch")
         print("  git rj shbr - Show branches")
         print("  git rj rmbr - Remove branches")
+        print("  git rj maintenance - Optimize the object stores of all modules")
+        print("  git rj daemon - Watch the modules to speed up status and shbr")
+        print("  git rj worktree - Add or remove working trees of all modules")
         print("  git rj build - Build from .gitrjbuild description")
         print("  git rj perf - Run performance tests with BenchmarkDotNet")
         print()
         print("Get information about the command with the -h option, e.g.")
         print("  git rj status -h")
+        print()
+        print("Profile the git commands run, writing a trace to gitrj-trace.json, with")
+        print("  git rj --profile[=TRACE] status")
 
 
 class InitCommand:
@@ -1064,9 +4323,31 @@ class InitCommand:
             "-f", "--force", action="store_true",
             help="Applies the force option, which at this time causes a forced checkout, "
             "overwriting changes when checking out the branch.")
+        argparser.add_argument(
+            "-k", "--check", action="store_true",
+            help="Check the git configuration for the base module and all submodules, "
+            "reporting differences without making changes.")
+        argparser.add_argument(
+            "--depth", type=int, metavar="N",
+            help="Only fetch the last N commits of the history when cloning the submodules. "
+            "Use 0 for the complete history again.")
+        argparser.add_argument(
+            "--filter", metavar="SPEC",
+            help="Make partial clones, which fetch objects when needed, e.g. 'blob:none'.")
+        argparser.add_argument(
+            "--sparse", metavar="PROFILE",
+            help="Only check out the directories given for each module by the profile in "
+            "the 'sparse' section of .gitrjbuild.")
+        ModuleExecutor.add_arguments(argparser, engine=True)
 
         self.arguments = argparser.parse_args(arguments)
 
+        if (self.arguments.check):
+            if (self.arguments.init or self.arguments.config
+                    or self.arguments.checkout or self.arguments.pull):
+                raise ArgumentError("The option --check can't be used with other options")
+            return
+
         # If no options are given, then we do all actions
         if (not (self.arguments.init or self.arguments.config
                  or self.arguments.checkout or self.arguments.pull)):
@@ -1075,13 +4356,59 @@ class InitCommand:
             self.arguments.checkout = True
             self.arguments.pull = True
 
+    @ staticmethod
+    def _sparse_profile(profile):
+        """Get the directories of the sparse profile in .gitrjbuild for each module"""
+        config = {}
+        if (os.path.isfile(".gitrjbuild")):
+            try:
+                with open(".gitrjbuild") as configFile:
+                    config = json.load(configFile)
+            except json.decoder.JSONDecodeError as ex:
+                raise CommandError(f"Error loading .gitrjbuild - {ex.msg} (Line:{ex.lineno}, Col:{ex.colno})")
+
+        # The platform specific section overrides the global section.
+        paths = None
+        for cplatform in ["", platform.system()]:
+            if (cplatform in config and "sparse" in config[cplatform]):
+                if (profile in config[cplatform]["sparse"]):
+                    paths = config[cplatform]["sparse"][profile]
+        if (paths is None):
+            raise CommandError(f"Sparse profile '{profile}' not present in the 'sparse' section of '.gitrjbuild'.")
+        return paths
+
+    def _clone_options(self, base_module):
+        """Get the depth, filter and sparse profile, from the options or the last init"""
+        try:
+            config = base_module.config()
+        except GitError:
+            config = None
+
+        def _option(value, name):
+            if (value is not None):
+                return value
+            return config.get(name) if config is not None else None
+
+        depth = _option(self.arguments.depth, GitModule.CONFIG_DEPTH)
+        depth = int(depth) if depth is not None and str(depth).isdigit() else None
+        spec = _option(self.arguments.filter, GitModule.CONFIG_FILTER)
+        profile = _option(self.arguments.sparse, GitModule.CONFIG_SPARSE)
+
+        version = GitExe.version_info()
+        if (spec is not None and self.arguments.init and version < (2, 36)):
+            raise CommandError("Partial clones of submodules require git 2.36 or later.")
+        if (profile is not None and version < (2, 25)):
+            raise CommandError("Sparse checkouts require git 2.25 or later.")
+        return (depth, spec, profile)
+
     def execute(self):
         modules = GitModules()
         if (not modules.at_base()):
             raise CommandError("Not at the top level repository.")
 
+        executor = ModuleExecutor.from_arguments(self.arguments, "init", network=True)
         base_module = GitModule(modules.top_level())
-        if (self.arguments.config):
+        if (self.arguments.config or self.arguments.check):
             git_username = base_module.get_git_user_name()
             git_email = base_module.get_git_user_email()
             if (git_username == "" or git_email == ""):
@@ -1089,51 +4416,142 @@ class InitCommand:
                     "Please set the user name and email in the super project top level repository."
                 )
 
+        if (self.arguments.check):
+            self._check(modules, base_module, git_username, git_email)
+            return
+
+        # The depth, filter and sparse profile are kept in the configuration
+        # of all modules, so that they're used by the next init, e.g. for
+        # submodules added later.
+        (depth, spec, profile) = self._clone_options(base_module)
+        clone_config = {}
+        if (depth is not None):
+            clone_config[GitModule.CONFIG_DEPTH] = str(depth)
+        if (spec is not None):
+            clone_config[GitModule.CONFIG_FILTER] = spec
+        if (profile is not None):
+            clone_config[GitModule.CONFIG_SPARSE] = profile
+        sparse = self._sparse_profile(profile) if profile is not None else None
+
+        def _clone(module, name):
+            if (len(clone_config) > 0):
+                module.apply_config(clone_config)
+            if (depth == 0):
+                module.unshallow()
+            if (spec is not None):
+                module.set_partial_clone(spec)
+            if (sparse is not None):
+                # The default "*" is only for submodules
+                module.set_sparse_checkout(sparse.get(name, sparse.get("*") if name != "base" else None))
+
         print("\033[35;1mInitialising:\033[0;35m base\033[0m")
         if (self.arguments.config):
             print("  Using {} <{}>".format(git_username, git_email))
             print("  Setting Config... ", end="", flush=True)
-            base_module.set_config(False)
+            base_module.apply_config(GitModule.init_config(False))
             print("DONE.", flush=True)
+        if (len(clone_config) > 0):
+            print("  Clone Options... ", end="", flush=True)
+            try:
+                _clone(base_module, "base")
+                print("DONE.", flush=True)
+            except GitError as ex:
+                print("FAILED.\n{}".format(str(ex)), flush=True)
+                return
         if (self.arguments.init):
             print("  Submodule Init... ", end="", flush=True)
             try:
-                modules.git_submodules_init(force=self.arguments.force)
+                modules.git_submodules_init(force=self.arguments.force, jobs=executor.workers,
+                                            depth=depth if depth != 0 else None, filter=spec)
                 print("DONE.", flush=True)
             except GitError as ex:
-                print("FAILED.\n{}".format(str(ex)), flush=True)
+                print("FAILED.\n{}".format(str(ex)), flush=True)
+                return
+
+        execute_lock = threading.Lock()
+
+        def _failed(module, ex):
+            with execute_lock:
+                print("\033[35;1mModule:\033[0;35m {}...\033[0m FAILED.\n{}"
+                      .format(module.path(), str(ex)), flush=True)
+
+        def _done(module):
+            with execute_lock:
+                print("\033[35;1mModule:\033[0;35m {}...\033[0m DONE."
+                      .format(module.path()), flush=True)
+
+        def _execute(module):
+            try:
+                if (self.arguments.config):
+                    module.apply_config(
+                        GitModule.init_config(True, git_username, git_email))
+                _clone(module, ModuleExecutor._module_name(module))
+                if (self.arguments.checkout):
+                    module.checkout_branch(force=self.arguments.force)
+                if (self.arguments.pull):
+                    module.pull(ffonly=True, force=True, recurse=False)
+            except GitError as ex:
+                _failed(module, ex)
+                return
+            _done(module)
+
+        async def _execute_async(module):
+            try:
+                if (self.arguments.config):
+                    await GitExe.to_thread(
+                        module.apply_config, GitModule.init_config(True, git_username, git_email))
+                await GitExe.to_thread(_clone, module, ModuleExecutor._module_name(module))
+                if (self.arguments.checkout):
+                    await module.checkout_branch_async(force=self.arguments.force)
+                if (self.arguments.pull):
+                    await module.pull_async(ffonly=True, force=True, recurse=False)
+            except GitError as ex:
+                _failed(module, ex)
                 return
+            _done(module)
+
+        # Run the initialization on submodules in parallel, a nested submodule
+        # after its parent.
+        for level in modules.get_levels():
+            executor.run(level, _execute, _execute_async)
 
+    def _check(self, modules, base_module, git_username, git_email):
         execute_lock = threading.Lock()
+        drifted = False
 
-        def _execute(module):
-            op = False
+        def _execute(module, values, name=None):
+            nonlocal drifted
+            if (name is None):
+                name = module.path()
             try:
-                if (self.arguments.config):
-                    module.set_git_user_name(git_username)
-                    module.set_git_user_email(git_email)
-                    module.set_config(True)
-                op = True
-                if (self.arguments.checkout):
-                    module.checkout_branch(force=self.arguments.force)
-                    op = True
-                if (self.arguments.pull):
-                    module.pull(ffonly=True, force=True)
-                    op = True
+                drift = module.check_config(values)
             except GitError as ex:
                 with execute_lock:
+                    drifted = True
                     print("\033[35;1mModule:\033[0;35m {}...\033[0m FAILED.\n{}"
-                          .format(module.path(), str(ex)), flush=True)
+                          .format(name, str(ex)), flush=True)
                 return
-            if (op):
-                with execute_lock:
-                    print("\033[35;1mModule:\033[0;35m {}...\033[0m DONE."
-                          .format(module.path()), flush=True)
 
-        # Run the initialization on submodules in parallel
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            for module in modules.get_submodules():
-                executor.submit(_execute, module)
+            with execute_lock:
+                if (len(drift) == 0):
+                    print(f"\033[35;1mModule:\033[0;35m {name}...\033[0m OK.", flush=True)
+                    return
+                drifted = True
+                print(f"\033[35;1mModule:\033[0;35m {name}...\033[0m DIFFERS.", flush=True)
+                for (key, (current, expected)) in drift.items():
+                    print("  {}: {} (expected {})".format(
+                        key, current if current is not None else "(not set)", expected))
+
+        _execute(base_module, GitModule.init_config(False), name="base")
+        values = GitModule.init_config(True, git_username, git_email)
+        executor = ModuleExecutor.from_arguments(self.arguments, "init")
+        # The check only reads the configuration, so its times are kept apart
+        # from those of the clones that order a real 'init'.
+        executor.command = "init-check"
+        executor.run(modules.get_submodules(), _execute, values=values)
+
+        if (drifted):
+            raise CommandError("The configuration differs, run 'git rj init --config' to update.", exitcode=1)
 
 
 class PullCommand:
@@ -1146,6 +4564,8 @@ class PullCommand:
         argparser.add_argument(
             "-f", "--force", action="store_true",
             help="Discards local changes before pulling.")
+        ModuleExecutor.add_arguments(argparser, engine=True)
+        ModuleReport.add_arguments(argparser)
 
         self.arguments = argparser.parse_args(arguments)
 
@@ -1154,19 +4574,34 @@ class PullCommand:
         if (not modules.at_base()):
             raise CommandError("Not at the top level repository.")
 
-        execute_lock = threading.Lock()
+        report = ModuleReport.from_arguments(self.arguments, "pull")
+
+        def _tracking(module):
+            remote = module.get_tracking_branch_from_head()
+            if (remote is None):
+                raise GitError("Not on a tracking branch, can't pull")
+            branch = module.get_current_branch()
+            if (branch is None):
+                raise GitError("No branch to pull / reset to")
+            return (branch, remote)
+
+        def _done(module, name, branch, remote):
+            report.record(
+                module, "done",
+                [f"\033[35;1mModule:\033[0;35m {name}...\033[0m {branch} ({remote})... DONE."],
+                branch=branch, remote=remote)
+
+        def _failed(module, name, ex):
+            report.record(
+                module, "failed",
+                ["\033[35;1mModule:\033[0;35m {}...\033[0m FAILED.\n{}".format(name, str(ex))],
+                error=str(ex))
 
         def _execute(module, name=None, recurse=True, force=False):
             if (name is None):
                 name = module.path()
             try:
-                remote = module.get_tracking_branch_from_head()
-                if (remote is None):
-                    raise GitError("Not on a tracking branch, can't pull")
-                branch = module.get_current_branch()
-                if (branch is None):
-                    raise GitError("No branch to pull / reset to")
-
+                (branch, remote) = _tracking(module)
                 if (not force):
                     # Just do a normal pull. If the command fails, we'll
                     # report the error.
@@ -1174,23 +4609,37 @@ class PullCommand:
                 else:
                     module.fetch(force=True, recurse=recurse)
                     module.reset_hard(remote)
+                _done(module, name, branch, remote)
+            except GitError as ex:
+                _failed(module, name, ex)
 
-                with execute_lock:
-                    print(f"\033[35;1mModule:\033[0;35m {name}...\033[0m {branch} ({remote})... DONE.",
-                          flush=True)
+        async def _execute_async(module, name=None, recurse=True, force=False):
+            if (name is None):
+                name = module.path()
+            try:
+                (branch, remote) = await GitExe.to_thread(_tracking, module)
+                if (not force):
+                    await module.pull_async(recurse=recurse)
+                else:
+                    await module.fetch_async(force=True, recurse=recurse)
+                    await module.reset_hard_async(remote)
+                _done(module, name, branch, remote)
             except GitError as ex:
-                with execute_lock:
-                    print("\033[35;1mModule:\033[0;35m {}...\033[0m FAILED.\n{}"
-                          .format(name, str(ex)), flush=True)
+                _failed(module, name, ex)
+
+        _execute = report.timed(_execute)
+        _execute_async = report.timed_async(_execute_async)
 
         base_module = GitModule(modules.top_level())
         _execute(base_module, name="base", recurse=False,
                  force=self.arguments.force)
 
-        # Run the initialization on submodules in parallel
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            for module in modules.get_submodules():
-                executor.submit(_execute, module, force=self.arguments.force)
+        # Pull the submodules in parallel, a nested submodule after its parent.
+        executor = ModuleExecutor.from_arguments(self.arguments, "pull", network=True)
+        for level in modules.get_levels():
+            executor.run(level, _execute, _execute_async,
+                         force=self.arguments.force, recurse=False)
+        report.summary()
 
 
 class FetchCommand:
@@ -1203,6 +4652,8 @@ class FetchCommand:
         argparser.add_argument(
             "-f", "--force", action="store_true",
             help="Forces the fetch update by passing --force to git fetch.")
+        ModuleExecutor.add_arguments(argparser, engine=True)
+        ModuleReport.add_arguments(argparser)
 
         self.arguments = argparser.parse_args(arguments)
 
@@ -1211,29 +4662,47 @@ class FetchCommand:
         if (not modules.at_base()):
             raise CommandError("Not at the top level repository.")
 
-        execute_lock = threading.Lock()
+        report = ModuleReport.from_arguments(self.arguments, "fetch")
+
+        def _done(module, name):
+            report.record(module, "done", [f"\033[35;1mModule:\033[0;35m {name}...\033[0m DONE."])
+
+        def _failed(module, name, ex):
+            report.record(
+                module, "failed",
+                ["\033[35;1mModule:\033[0;35m {}...\033[0m FAILED.\n{}".format(name, str(ex))],
+                error=str(ex))
 
         def _execute(module, name=None, force=False, recurse=True):
             if (name is None):
                 name = module.path()
             try:
                 module.fetch(force=force, recurse=recurse)
-                with execute_lock:
-                    print(f"\033[35;1mModule:\033[0;35m {name}...\033[0m DONE.",
-                          flush=True)
+                _done(module, name)
             except GitError as ex:
-                with execute_lock:
-                    print("\033[35;1mModule:\033[0;35m {}...\033[0m FAILED.\n{}"
-                          .format(name, str(ex)), flush=True)
+                _failed(module, name, ex)
+
+        async def _execute_async(module, name=None, force=False, recurse=True):
+            if (name is None):
+                name = module.path()
+            try:
+                await module.fetch_async(force=force, recurse=recurse)
+                _done(module, name)
+            except GitError as ex:
+                _failed(module, name, ex)
+
+        _execute = report.timed(_execute)
+        _execute_async = report.timed_async(_execute_async)
 
         base_module = GitModule(modules.top_level())
         _execute(base_module, name="base",
                  force=self.arguments.force, recurse=False)
 
         # Run the initialization on submodules in parallel
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            for module in modules.get_submodules():
-                executor.submit(_execute, module, force=self.arguments.force)
+        executor = ModuleExecutor.from_arguments(self.arguments, "fetch", network=True)
+        executor.run(modules.get_submodules(), _execute, _execute_async,
+                     force=self.arguments.force, recurse=False)
+        report.summary()
 
 
 class CleanCommand:
@@ -1246,8 +4715,23 @@ class CleanCommand:
         argparser.add_argument(
             "-a", "--all", action="store_true",
             help="Also cleans the base repository, by default it cleans only submodules.")
+        argparser.add_argument(
+            "--fast", action="store_true",
+            help="Get the untracked and ignored files from git, and remove them with a "
+            "pool of threads instead of with 'git clean'.")
+        argparser.add_argument(
+            "-n", "--dry-run", action="store_true",
+            help="Show how many files would be removed, without removing them. "
+            "Requires --fast.")
+        argparser.add_argument(
+            "--size", action="store_true",
+            help="Show the size of the files removed (or that would be removed) for "
+            "each module. Requires --fast.")
+        ModuleExecutor.add_arguments(argparser)
 
         self.arguments = argparser.parse_args(arguments)
+        if ((self.arguments.dry_run or self.arguments.size) and not self.arguments.fast):
+            raise ArgumentError("The options --dry-run and --size require --fast")
 
     def execute(self):
         modules = GitModules()
@@ -1255,11 +4739,48 @@ class CleanCommand:
             raise CommandError("Not at the top level repository.")
 
         execute_lock = threading.Lock()
+        total_files = 0
+        total_size = 0
+        cleaner = None
+        if (self.arguments.fast):
+            cleaner = TreeCleaner(dry_run=self.arguments.dry_run)
+
+        def _format_size(size):
+            if (size < 1024):
+                return f"{size} bytes"
+            return MaintenanceCommand._format_size(size // 1024)
+
+        def _fast(module, name):
+            nonlocal total_files, total_size
+            top = module.top_level()
+            paths = [os.path.join(top, path.rstrip("/")) for path in module.get_untracked()]
+            (files, directories, size, errors) = cleaner.remove(paths)
+
+            details = f"{files} files, {directories} directories"
+            if (self.arguments.size):
+                details += f", {_format_size(size)}"
+            with execute_lock:
+                total_files += files
+                total_size += size
+                if (len(errors) > 0):
+                    print("\033[35;1mModule:\033[0;35m {}...\033[0m FAILED. {}"
+                          .format(name, details), flush=True)
+                    for error in errors[:10]:
+                        print(f"  {str(error)}", flush=True)
+                    if (len(errors) > 10):
+                        print(f"  ... {len(errors) - 10} more errors", flush=True)
+                else:
+                    print("\033[35;1mModule:\033[0;35m {}...\033[0m {}. {}"
+                          .format(name, "DRY RUN" if self.arguments.dry_run else "DONE", details),
+                          flush=True)
 
         def _execute(module, name=None):
             if (name is None):
                 name = module.path()
             try:
+                if (cleaner is not None):
+                    _fast(module, name)
+                    return
                 module.clean()
                 with execute_lock:
                     print(f"\033[35;1mModule:\033[0;35m {name}...\033[0m DONE.",
@@ -1270,13 +4791,23 @@ class CleanCommand:
                           .format(name, str(ex)), flush=True)
 
         base_module = GitModule(modules.top_level())
+        clean_modules = []
         if (self.arguments.all):
-            _execute(base_module, name="base")
+            clean_modules.append(base_module)
+        clean_modules.extend(modules.get_submodules())
 
-        # Run the initialization on submodules in parallel
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            for module in modules.get_submodules():
-                executor.submit(_execute, module)
+        # The base module is cleaned in parallel with the submodules
+        executor = ModuleExecutor.from_arguments(self.arguments, "clean")
+        try:
+            executor.run(clean_modules,
+                         lambda module: _execute(module, name="base" if module is base_module else None))
+        finally:
+            if (cleaner is not None):
+                cleaner.close()
+
+        if (self.arguments.size):
+            print("\033[35;1mTotal:\033[0;35m {} files, {}\033[0m"
+                  .format(total_files, _format_size(total_size)))
 
 
 class StatusCommand:
@@ -1289,26 +4820,28 @@ class StatusCommand:
         argparser.add_argument(
             "-l", "--long", action="store_true",
             help="Shows long output for more clarity.")
+        argparser.add_argument(
+            "-a", "--all-branches", action="store_true",
+            help="Shows a table of all local branches for each module, with the commits "
+            "ahead and behind the upstream branch and the destination branch.")
+        argparser.add_argument(
+            "--no-cache", action="store_true",
+            help="Query git for every module, instead of using the status from the "
+            "last run for modules that haven't changed.")
+        ModuleExecutor.add_arguments(argparser)
+        ModuleReport.add_arguments(argparser)
 
         self.arguments = argparser.parse_args(arguments)
 
+        # The output for each module is cached by 'git rj daemon', else in the
+        # git directory of each module.
+        self.cache = None
+
     def execute(self):
         modules = GitModules()
         if (not modules.at_base()):
             raise CommandError("Not at the top level repository.")
 
-        execute_lock = threading.Lock()
-
-        def _get_current_branch(module):
-            current_branch = module.get_current_branch()
-            current_hash = module.get_current_hash()
-            if (current_branch is None and current_hash is None):
-                return None
-
-            if (current_hash is None):
-                current_hash = "0000000000000000000000000000000000000000"
-            return (current_hash, current_branch)
-
         def _get_destination_branch(module):
             if (module.default_branch is None):
                 return None
@@ -1363,90 +4896,174 @@ class StatusCommand:
                 return local
             return remote
 
-        def _execute(module, name=None):
+        def _status(module):
+            """Get the record of the status of the module"""
+            # The HEAD, branch, upstream and dirty state come from a single
+            # 'git status' call. The hash is only None if we're in an empty
+            # repository.
+            status = module.get_status()
+            remote = _get_destination_branch(module)
+            if (remote is None):
+                commits = None
+                behind = None
+                rebase = False
+            else:
+                counts = module.get_count_ahead_behind(
+                    status.hash if status.hash is not None else "0" * 40, remote[0])
+                commits = counts[0] if counts is not None else None
+                behind = counts[1] if counts is not None else None
+                rebase = behind != 0
+
+            return {
+                "hash": status.hash if status.hash is not None else "0" * 40,
+                "branch": status.branch,
+                "dirty": status.dirty,
+                "upstream": status.upstream,
+                "upstream_ahead": status.ahead if status.upstream else None,
+                "upstream_behind": status.behind if status.upstream else None,
+                "destination": remote[1] if remote is not None else module.default_branch,
+                "ahead": commits,
+                "behind": behind,
+                "rebase": rebase
+            }
+
+        def _status_lines(module, name, status):
+            """Get the lines to print for the status of the module"""
             hash_len = 0 if self.arguments.long else 11
             module_len = 40 if self.arguments.long else 30
 
-            try:
-                # The current branch is only None if we're in an empty
-                # repository
-                current = _get_current_branch(module)
-                isdirty = module.get_is_dirty() \
-                    if current is not None else None
-                remote = _get_destination_branch(module)
-                tracking = module.get_tracking_branch_from_head()
-                if (remote is None):
-                    mergebase = None
-                    commits = None
-                    behind = None
-                    rebase = False
+            out_name = name \
+                if name is not None \
+                else module.printable_path(module_len)
+            out_hash = status["hash"] \
+                if self.arguments.long \
+                else status["hash"][:hash_len]
+
+            push_required = False
+            trackcode = "-"
+            if (status["upstream"]):
+                if (status["upstream_ahead"] is None):
+                    # Current branch is being tracked, but remote doesn't exist
+                    trackcode = "t"
                 else:
-                    mergebase = module.get_merge_base(current[0], remote[0])
-                    commits = module.get_count_commits(current[0], mergebase)
-                    behind = module.get_count_commits(remote[0], mergebase)
-                    rebase = not (mergebase == remote[0])
-
-                out_name = name \
-                    if name is not None \
-                    else module.printable_path(module_len)
-                out_hash = current[0] \
-                    if self.arguments.long \
-                    else current[0][:hash_len]
-
-                push_required = False
-                trackcode = "-"
-                if (tracking):
-                    tracking_hash = module.get_ref_hash(tracking)
-                    if (tracking_hash is None):
-                        # Current branch is being tracked, but remote doesn't exist
-                        trackcode = "t"
-                    else:
-                        # Current branch is being tracked
-                        trackcode = "T"
-                        if (tracking_hash != current[0]):
-                            push_required = True
-
-                if (push_required):
-                    localmergebase = \
-                        module.get_merge_base(current[0], tracking_hash)
-                    localcommits = \
-                        module.get_count_commits(current[0], localmergebase)
-                    localbehind = \
-                        module.get_count_commits(tracking_hash, localmergebase)
+                    # Current branch is being tracked
+                    trackcode = "T"
+                    if (status["upstream_ahead"] > 0 or status["upstream_behind"] > 0):
+                        push_required = True
+
+            lines = ["[{}{}{}{}] {:<{}} {} (commits: {} / {}) [{} -> {}]"
+                     .format(
+                         "M" if status["dirty"] else "-",
+                         trackcode,
+                         "P" if push_required else "-",
+                         "R" if status["rebase"] else "-",
+                         out_name, module_len,
+                         out_hash,
+                         status["ahead"] if status["ahead"] is not None else "-",
+                         status["behind"] if status["behind"] is not None else "-",
+                         status["branch"],
+                         status["destination"]
+                     )]
+            if (push_required):
+                localcommits = status["upstream_ahead"]
+                localbehind = status["upstream_behind"]
+                lines.append("   Local Branch: {} (by {} commit{})".format(
+                    status["branch"], localcommits, "s" if localcommits > 0 else ""
+                ))
+                lines.append("   Tracking Branch: {} (by {} commit{})".format(
+                    status["upstream"], localbehind, "s" if localbehind > 0 else ""
+                ))
+            return lines
+
+        def _counts(ahead, behind):
+            if (ahead is None or behind is None):
+                return "-"
+            return f"{ahead} / {behind}"
+
+        def _branches(module):
+            """Get the record of all local branches of the module"""
+            remote = _get_destination_branch(module)
+            branches = module.get_branches_status(remote[0] if remote is not None else None)
+            return {
+                "destination": remote[1] if remote is not None else module.default_branch,
+                "branches": [{
+                    "branch": branch.branch,
+                    "hash": branch.hash,
+                    "current": branch.current,
+                    "upstream": branch.upstream,
+                    "upstream_gone": branch.upstream_gone,
+                    "upstream_ahead": branch.ahead,
+                    "upstream_behind": branch.behind,
+                    "ahead": branch.base_ahead,
+                    "behind": branch.base_behind
+                } for branch in branches]
+            }
+
+        def _branches_lines(module, name, status):
+            """Get the lines to print for all branches of the module"""
+            hash_len = 40 if self.arguments.long else 11
+
+            lines = ["\033[35;1mModule:\033[0;35m {}\033[0m ({})".format(
+                name if name is not None else module.path(), status["destination"])]
+            if (len(status["branches"]) == 0):
+                lines.append("    (no local branches)")
+                return lines
+
+            rows = [("", "Branch", "Hash", "Upstream", "Ahead/Behind", "Destination")]
+            for branch in status["branches"]:
+                upstream = "-"
+                if (branch["upstream"] is not None):
+                    upstream = branch["upstream"] \
+                        if not branch["upstream_gone"] \
+                        else "{} (gone)".format(branch["upstream"])
+                rows.append((
+                    "*" if branch["current"] else "",
+                    branch["branch"],
+                    branch["hash"][:hash_len],
+                    upstream,
+                    _counts(branch["upstream_ahead"], branch["upstream_behind"]),
+                    _counts(branch["ahead"], branch["behind"])))
+            widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+            for row in rows:
+                lines.append("  {:<1} {:<{}}  {:<{}}  {:<{}}  {:<{}}  {}".format(
+                    row[0], row[1], widths[1], row[2], widths[2], row[3], widths[3],
+                    row[4], widths[4], row[5]).rstrip())
+            return lines
 
-                with execute_lock:
-                    print("[{}{}{}{}] {:<{}} {} (commits: {} / {}) [{} -> {}]"
-                          .format(
-                              "M" if isdirty else "-",
-                              trackcode,
-                              "P" if push_required else "-",
-                              "R" if rebase else "-",
-                              out_name, module_len,
-                              out_hash,
-                              commits if commits is not None else "-",
-                              behind if behind is not None else "-",
-                              current[1] if current is not None else "-",
-                              remote[1] if remote is not None else module.default_branch
-                          ), flush=True)
-                    if (push_required):
-                        print("   Local Branch: {} (by {} commit{})".format(
-                            current[1], localcommits, "s" if localcommits > 0 else ""
-                        ))
-                        print("   Tracking Branch: {} (by {} commit{})".format(
-                            tracking, localbehind, "s" if localbehind > 0 else ""
-                        ))
+        def _execute(module, name=None):
+            try:
+                if (self.arguments.all_branches):
+                    status = _branches(module)
+                    lines = _branches_lines(module, name, status)
+                else:
+                    status = None
+                    if (cache is not None):
+                        (status, token) = cache.lookup(module, "status")
+                    if (status is None):
+                        status = _status(module)
+                        if (cache is not None):
+                            cache.store(module, "status", status, token)
+                    lines = _status_lines(module, name, status)
+                report.record(module, "done", lines, **status)
             except GitError as ex:
-                with execute_lock:
-                    print("\033[35;1mModule:\033[0;35m {}...\033[0m FAILED.\n{}"
-                          .format(name, str(ex)), flush=True)
+                report.record(
+                    module, "failed",
+                    ["\033[35;1mModule:\033[0;35m {}...\033[0m FAILED.\n{}".format(name, str(ex))],
+                    error=str(ex))
+
+        cache = self.cache
+        if (cache is None and not self.arguments.no_cache):
+            cache = StatusCache()
+        report = ModuleReport.from_arguments(self.arguments, "status")
+        _execute = report.timed(_execute)
 
         base_module = GitModule(modules.top_level())
         _execute(base_module, name="base")
 
         # Run the initialization on submodules in parallel
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            for module in modules.get_submodules():
-                executor.submit(_execute, module)
+        executor = ModuleExecutor.from_arguments(self.arguments, "status")
+        executor.run(modules.get_submodules(), _execute)
+        report.summary()
 
 
 class CobrCommand:
@@ -1466,6 +5083,7 @@ class CobrCommand:
             "-p", "--pull", action="store_true",
             help="Pull the local branch once checked out."
         )
+        ModuleExecutor.add_arguments(argparser)
 
         self.arguments = argparser.parse_args(arguments)
 
@@ -1476,46 +5094,29 @@ class CobrCommand:
 
         execute_lock = threading.Lock()
 
-        def _execute(module, name=None, default=None, recurse=True):
+        def _execute(module, name=None, default=None, recurse=True, workers=None):
             if (name is None):
                 name = module.path()
 
-            # No force:
-            #   Check out branch (force) if not None and it exists, else
-            #   Check out default (force) if not None and it exists, else
-            #   do nothing.
-            actual = None
+            # Check out the branch if given and it exists, else the default
+            # branch of the module, else DEFAULT_BRANCH. Which exists is known
+            # from the references, so only one checkout is run.
+            branches = [self.arguments.branch]
+            if (default is not None):
+                branches.extend([default, DEFAULT_BRANCH])
 
             current_branch = module.get_current_branch()
-            if (self.arguments.branch is not None):
-                try:
-                    if (self.arguments.force or current_branch != self.arguments.branch):
-                        module.checkout_branch(
-                            branch=self.arguments.branch,
-                            force=self.arguments.force)
-                    actual = self.arguments.branch
-                except GitError:
-                    pass
-
-            if (actual is None and default is not None):
-                try:
-                    if (self.arguments.force or current_branch != default):
-                        module.checkout_branch(
-                            branch=default,
-                            force=self.arguments.force)
-                    actual = default
-                except GitError:
-                    pass
-
-                if (actual is None and DEFAULT_BRANCH is not None):
-                    try:
-                        if (self.arguments.force or current_branch != DEFAULT_BRANCH):
-                            module.checkout_branch(
-                                branch=DEFAULT_BRANCH,
-                                force=self.arguments.force)
-                        actual = DEFAULT_BRANCH
-                    except GitError:
-                        pass
+            try:
+                (actual, track) = module.resolve_branch(branches)
+                unchanged = actual is not None and actual == current_branch and not self.arguments.force
+                if (actual is not None and not unchanged):
+                    module.checkout_branch(
+                        branch=actual, force=self.arguments.force, track=track, workers=workers)
+            except GitError as ex:
+                with execute_lock:
+                    print("\033[35;1mModule:\033[0;35m {}...\033[0m FAILED.\n{}"
+                          .format(name, str(ex)), flush=True)
+                return
 
             try:
                 if (self.arguments.pull):
@@ -1531,6 +5132,9 @@ class CobrCommand:
                 if (actual is None):
                     print(f"\033[35;1mModule:\033[0;35m {name}...\033[0m NONE.",
                           flush=True)
+                elif (unchanged):
+                    print(f"\033[35;1mModule:\033[0;35m {name}...\033[0m UNCHANGED. {actual}",
+                          flush=True)
                 else:
                     print(f"\033[35;1mModule:\033[0;35m {name}...\033[0m DONE. {actual}",
                           flush=True)
@@ -1541,12 +5145,24 @@ class CobrCommand:
         # given, then use the current branch, and check out all submodules
         # dependend on the default branch for each submodule
         if (self.arguments.branch is not None):
-            _execute(base_module, name="base", default=None, recurse=False)
+            try:
+                _execute(base_module, name="base", default=None, recurse=False, workers=0)
+            finally:
+                base_module.close()
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            for module in modules.get_submodules():
-                executor.submit(_execute, module,
-                                default=module.default_branch)
+        # Large working trees are checked out with parallel workers, sharing
+        # the CPUs with the modules checked out at the same time. Git only
+        # uses them if enough files change.
+        executor = ModuleExecutor.from_arguments(self.arguments, "cobr")
+        cpus = os.cpu_count() or 1
+
+        def _execute_default(module):
+            _execute(module, default=module.default_branch, recurse=False,
+                     workers=max(1, cpus // executor.workers))
+
+        # A nested submodule is checked out after its parent.
+        for level in modules.get_levels():
+            executor.run(level, _execute_default)
 
 
 class ShbrCommand:
@@ -1557,70 +5173,145 @@ class ShbrCommand:
             prog="git rj shbr",
             description="Lists all the branches locally and those fetched from remotes. "
             "Additonally, for the local branches, if the same branch exists on a remote, "
-            "it is printed again."
+            "it is printed again. With a filter, each branch is listed with the modules "
+            "that have it."
         )
         argparser.add_argument(
             "-r", "--show-release", action="store_true",
             help=f"Show in addition branches beginning with '{RELEASE_BRANCH}'.")
+        argparser.add_argument(
+            "-p", "--pattern", action="append", metavar="PATTERN",
+            help="Only show branches matching the wildcard pattern, e.g. 'feature/*'. "
+            "May be given more than once.")
+        argparser.add_argument(
+            "-m", "--module", action="append", metavar="PATTERN",
+            help="Only look at modules whose path matches the wildcard pattern, 'base' "
+            "for the base module. May be given more than once.")
+        argparser.add_argument(
+            "--stale", type=int, metavar="DAYS",
+            help="Only show branches without commits in the last DAYS days.")
+        ModuleExecutor.add_arguments(argparser)
+        ModuleReport.add_arguments(argparser)
 
         self.arguments = argparser.parse_args(arguments)
 
+    @ staticmethod
+    def _matches(name, patterns):
+        if (patterns is None):
+            return True
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+    def _filtered(self):
+        return self.arguments.pattern is not None \
+            or self.arguments.module is not None \
+            or self.arguments.stale is not None
+
+    def cacheable(self):
+        """Check if the output only depends on the references.
+
+        The view by branch of --pattern, --module and --stale shows the age of
+        the branches, which depends on the current time.
+        """
+        return not self._filtered()
+
     def execute(self):
         modules = GitModules()
         if (not modules.at_base()):
             raise CommandError("Not at the top level repository.")
 
-        # A dictionary of remotes, where the key is the remote (None for local),
-        # whose value is a set of the branches that are present. Also the
-        # equivalent of a dictionary of branches which exist on remotes (not
-        # including the local repository).
+        # The index of branches, where the key is the branch name, whose value
+        # is a dictionary of the modules that have the branch. For each module
+        # it has the hash of the local branch, the hashes on the remotes, and
+        # the newest committer date of them.
         execute_lock = threading.Lock()
-        remotes = {}
-        branches = {}
+        index = {}
         error = False
+        report = ModuleReport.from_arguments(self.arguments, "shbr")
+        filtered = self._filtered()
+        cutoff = time.time() - self.arguments.stale * 86400 \
+            if self.arguments.stale is not None else None
 
         def _get_remotes(module):
             nonlocal error
+            if (filtered):
+                # The dates come from the same 'git for-each-ref'.
+                refs = module.iter_ref_dates()
+            else:
+                refs = ((ref[0], ref[1], None) for ref in module.iter_ref_hashes())
+
+            # Take the hashes as they're read, the tuple element 1 is the ref.
+            # Check the ref against strings to get the remotes.
+            entries = {}
             try:
-                refs = module.get_ref_hashes()
-            except GitError:
+                for ref in refs:
+                    if (ref[1].startswith("refs/heads/")):
+                        remote = None
+                        branch = ref[1][11:]
+                    elif (ref[1].startswith("refs/remotes/")):
+                        # split the remote from the branch
+                        remoteref = ref[1][13:].split("/", 1)
+                        if (len(remoteref) != 2):
+                            continue
+                        remote = remoteref[0]
+                        branch = remoteref[1]
+                        if (filtered and branch == "HEAD"):
+                            # The default branch of the remote isn't a branch
+                            continue
+                    else:
+                        continue
+
+                    if (self.arguments.pattern is not None):
+                        if (not self._matches(branch, self.arguments.pattern)):
+                            continue
+                    elif (not self.arguments.show_release and branch.startswith(RELEASE_BRANCH)):
+                        continue
+
+                    entry = entries.get(branch)
+                    if (entry is None):
+                        entry = {"local": None, "remotes": {}, "time": None}
+                        entries[branch] = entry
+                    if (remote is None):
+                        entry["local"] = ref[0]
+                    else:
+                        entry["remotes"][remote] = ref[0]
+                    if (ref[2] is not None and (entry["time"] is None or ref[2] > entry["time"])):
+                        entry["time"] = ref[2]
+            except GitError as ex:
                 error = True
+                report.record(module, "failed", error=str(ex))
                 return
 
-            # Take the list of hashes, the tuple element 1 is the ref. Check the
-            # ref against strings to get the remotes.
-            for ref in refs:
-                if (ref[1].startswith("refs/heads/")):
-                    remote = None
-                    branch = ref[1][11:]
-                elif (ref[1].startswith("refs/remotes/")):
-                    # split the remote from the branch
-                    remoteref = ref[1][13:].split("/", 1)
-                    remote = remoteref[0]
-                    branch = remoteref[1]
-                else:
-                    remote = None
-                    branch = None
-
-                if (not self.arguments.show_release):
-                    if (branch is not None and branch.startswith(RELEASE_BRANCH)):
-                        remote = None
-                        branch = None
-
-                with execute_lock:
-                    if (branch is not None):
-                        if (not remote in remotes):
-                            remotes[remote] = {branch}
-                        else:
-                            remotes[remote].add(branch)
-
-                        if (remote is not None):
-                            if (not branch in branches):
-                                branches[branch] = {remote}
-                            else:
-                                branches[branch].add(remote)
+            if (cutoff is not None):
+                entries = {branch: entry for (branch, entry) in entries.items()
+                           if entry["time"] is not None and entry["time"] < cutoff}
 
-        def _print_remotes(remote):
+            name = ModuleExecutor._module_name(module)
+            with execute_lock:
+                for branch in entries:
+                    index.setdefault(branch, {})[name] = entries[branch]
+
+            report.record(module, "done",
+                          local=sorted(branch for branch in entries
+                                       if entries[branch]["local"] is not None),
+                          remotes={remote: sorted(branch for branch in entries
+                                                  if remote in entries[branch]["remotes"])
+                                   for remote in sorted({remote for entry in entries.values()
+                                                         for remote in entry["remotes"]})})
+
+        def _summary():
+            """Get the branches of each remote, and the remotes of each branch"""
+            remotes = {}
+            branches = {}
+            for branch in index:
+                for entry in index[branch].values():
+                    if (entry["local"] is not None):
+                        remotes.setdefault(None, set()).add(branch)
+                    for remote in entry["remotes"]:
+                        remotes.setdefault(remote, set()).add(branch)
+                        branches.setdefault(branch, set()).add(remote)
+            return (remotes, branches)
+
+        def _print_remotes(remotes, branches, remote):
             if (not remote in remotes):
                 return
 
@@ -1637,27 +5328,65 @@ class ShbrCommand:
                 for branch in sorted(remotes[remote]):
                     print(f"  {branch}")
 
+        def _print_index():
+            now = time.time()
+            for branch in sorted(index):
+                names = sorted(index[branch], key=lambda name: (name != "base", name))
+                print("\033[35;1mBranch:\033[0;35m {}\033[0m ({} module{})".format(
+                    branch, len(names), "s" if len(names) != 1 else ""))
+                rows = []
+                for name in names:
+                    entry = index[branch][name]
+                    remotes = ", ".join(f"{remote} {entry['remotes'][remote][:11]}"
+                                        for remote in sorted(entry["remotes"]))
+                    age = "{} days".format(int((now - entry["time"]) // 86400)) \
+                        if entry["time"] is not None else "-"
+                    rows.append((name,
+                                 entry["local"][:11] if entry["local"] is not None else "-",
+                                 remotes if remotes != "" else "-",
+                                 age))
+                widths = [max(len(row[column]) for row in rows) for column in range(3)]
+                for row in rows:
+                    print("  {:<{}}  {:<11}  {:<{}}  ({})".format(
+                        row[0], widths[0], row[1], row[2], widths[2], row[3]))
+
         base_module = GitModule(modules.top_level())
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            check_modules = [base_module]
-            check_modules.extend(modules.get_submodules())
-            for module in check_modules:
-                executor.submit(_get_remotes, module)
+        check_modules = [base_module]
+        check_modules.extend(modules.get_submodules())
+        if (self.arguments.module is not None):
+            check_modules = [module for module in check_modules
+                             if self._matches(ModuleExecutor._module_name(module), self.arguments.module)]
+        executor = ModuleExecutor.from_arguments(self.arguments, "shbr")
+        executor.run(check_modules, report.timed(_get_remotes))
+
+        (remotes, branches) = _summary()
+        if (not report.text):
+            report.summary(
+                local={branch: sorted(branches.get(branch, []))
+                       for branch in sorted(remotes.get(None, []))},
+                remotes={remote: sorted(remotes[remote])
+                         for remote in sorted(r for r in remotes if r is not None)},
+                branches={branch: index[branch] for branch in sorted(index)})
+            return
 
         if (error):
             print("An error was seen getting remotes...")
 
+        if (filtered):
+            _print_index()
+            return
+
         print_remotes = []
-        _print_remotes(None)
+        _print_remotes(remotes, branches, None)
         for remote in remotes:
             if (remote is not None):
                 if (remote == DEFAULT_REMOTE):
-                    _print_remotes(DEFAULT_REMOTE)
+                    _print_remotes(remotes, branches, DEFAULT_REMOTE)
                 else:
                     print_remotes.append(remote)
         for remote in sorted(print_remotes):
-            _print_remotes(remote)
+            _print_remotes(remotes, branches, remote)
 
 
 class RmbrCommand:
@@ -1682,15 +5411,26 @@ class RmbrCommand:
             "-r", "--remote", action="store_true",
             help="Remove remote branches. Also specify --local to remove "
             "all branches. At least one branch must be given on the command line.")
+        argparser.add_argument(
+            "-m", "--merged", action="store_true",
+            help="Remove the branches merged into the default branch of each module, "
+            "locally, or with --remote on the remotes. If branches are given, only "
+            "those are removed if they're merged.")
+        argparser.add_argument(
+            "-n", "--dry-run", action="store_true",
+            help="Show the branches that would be removed, without removing them.")
         argparser.add_argument(
             "branch", nargs="*",
             help="The name of the branches to remove.")
+        ModuleExecutor.add_arguments(argparser)
+        ModuleReport.add_arguments(argparser)
 
         self.arguments = argparser.parse_args(arguments)
-        if (not self.arguments.local and not self.arguments.remote and not self.arguments.prune):
+        if (not self.arguments.local and not self.arguments.remote
+                and (not self.arguments.prune or self.arguments.merged)):
             self.arguments.local = True
 
-        if ((self.arguments.local or self.arguments.remote)
+        if ((self.arguments.local or self.arguments.remote) and not self.arguments.merged
                 and (self.arguments.branch is None or len(self.arguments.branch) == 0)):
             raise ArgumentError("Must specify at least one branch when "
                                 "using option --local or --remote")
@@ -1703,9 +5443,24 @@ class RmbrCommand:
         # TODO: Combine prune and remove into a single method, so that we print
         # fewer lines.
 
-        execute_lock = threading.Lock()
+        report = ModuleReport.from_arguments(self.arguments, "rmbr")
+
+        def _get_merged_target(module, remote_refs):
+            """Get the default branch to check for merged branches, preferring the remote"""
+            default_branch = module.default_branch
+            if (default_branch is None):
+                return None
+            default_remote = module.get_branch_default_remote(default_branch)
+            if (default_remote is None):
+                default_remote = DEFAULT_REMOTE
+            if (default_branch in remote_refs.get(default_remote, set())):
+                return f"refs/remotes/{default_remote}/{default_branch}"
+            if (default_branch in remote_refs.get(None, set())):
+                return f"refs/heads/{default_branch}"
+            return None
 
-        def _execute(module, local, remote, prune, name=None, branches=None):
+        def _execute(module, local, remote, prune, merged=False, dry_run=False,
+                     name=None, branches=None):
             if (name is None):
                 name = module.path()
 
@@ -1741,9 +5496,22 @@ class RmbrCommand:
                 else:
                     to_delete[remote].add(branch)
 
+            if (merged):
+                # All branches merged into the default branch are found with a
+                # single 'git for-each-ref --merged'.
+                target = _get_merged_target(module, remote_refs)
+                merged_refs = module.get_branches_remote_map(merged=target) \
+                    if target is not None else {}
+                for remote_ref in merged_refs:
+                    if ((remote_ref is None and not local) or (remote_ref is not None and not remote)):
+                        continue
+                    for branch in merged_refs[remote_ref]:
+                        if (branches is None or branch in branches):
+                            _add_to_delete_check(remote_ref, branch)
+
             for remote_ref in remote_refs:
                 if (remote_ref is None):
-                    if (local):
+                    if (local and not merged):
                         for branch in branches:
                             _add_to_delete_check(remote_ref, branch)
                     if (prune):
@@ -1758,61 +5526,404 @@ class RmbrCommand:
                                     if (prune_branches is None or branch in prune_branches):
                                         _add_to_delete(remote_ref, branch)
                 else:
-                    if (remote):
+                    if (remote and not merged):
                         for branch in branches:
                             _add_to_delete_check(remote_ref, branch)
                             if (prune):
                                 # Allow -rp to remove the now orphaned branch
                                 _add_to_delete_check(None, branch)
 
+            # The branches are deleted with one command for the local branches
+            # and one push for each remote.
             deleted_failed = {}
             deleted_success = {}
-            if (len(to_delete) > 0):
-                for remote in to_delete:
-                    for branch in to_delete[remote]:
+            for remote in to_delete:
+                delete = sorted(to_delete[remote])
+                if (dry_run):
+                    deleted_success[remote] = set(delete)
+                    continue
+                try:
+                    module.delete_branches(delete, remote)
+                except GitError as ex:
+                    # Local branches that could be deleted are gone. The push
+                    # to a remote is atomic, so none are deleted.
+                    remaining = set(delete)
+                    if (remote is None):
                         try:
-                            module.delete_branch(branch, remote)
-                        except GitError as ex:
-                            if (not remote in deleted_failed):
-                                deleted_failed[remote] = {branch: ex}
-                            else:
-                                deleted_failed[remote].add((branch, ex))
+                            remaining &= module.get_branches_remote_map().get(None, set())
+                        except GitError:
+                            pass
+                    for branch in delete:
+                        if (branch in remaining):
+                            deleted_failed.setdefault(remote, {})[branch] = ex
                         else:
-                            if (not remote in deleted_success):
-                                deleted_success[remote] = {branch}
-                            else:
-                                deleted_success[remote].add(branch)
+                            deleted_success.setdefault(remote, set()).add(branch)
+                else:
+                    deleted_success[remote] = set(delete)
+
+            lines = []
+            if (len(deleted_failed) > 0):
+                lines.append("\033[35;1mModule:\033[0;35m {}...\033[0m FAILED:".format(name))
+                for remote in deleted_failed:
+                    for branch in deleted_failed[remote]:
+                        lines.append("  {}: {}"
+                                     .format(branch, str(deleted_failed[remote][branch])))
+            if (len(deleted_success) > 0):
+                lines.append("\033[35;1mModule:\033[0;35m {}...\033[0m {}:".format(
+                    name, "Would delete" if dry_run else "Deleted"))
+                for remote in deleted_success:
+                    branches = " ".join(sorted(deleted_success[remote]))
+                    if (remote is None):
+                        lines.append(f"  (local) => {branches}")
+                    else:
+                        lines.append(f"  {remote} => {branches}")
+
+            report.record(
+                module, "failed" if len(deleted_failed) > 0 else "done", lines,
+                deleted={
+                    "local": sorted(deleted_success.get(None, [])),
+                    "remotes": {remote: sorted(deleted_success[remote])
+                                for remote in deleted_success if remote is not None}
+                },
+                errors=[{"branch": branch, "remote": remote, "error": str(deleted_failed[remote][branch])}
+                        for remote in deleted_failed for branch in deleted_failed[remote]])
 
-            with execute_lock:
-                if (len(deleted_failed) > 0):
-                    print("\033[35;1mModule:\033[0;35m {}...\033[0m FAILED:"
-                          .format(name), flush=True)
-                    for remote in deleted_failed:
-                        for branch in deleted_failed[remote]:
-                            print("  {}: {}"
-                                  .format(branch, str(deleted_failed[remote][branch])))
-                if (len(deleted_success) > 0):
-                    print("\033[35;1mModule:\033[0;35m {}...\033[0m Deleted:"
-                          .format(name), flush=True)
-                    for remote in deleted_success:
-                        branches = " ".join(deleted_success[remote])
-                        if (remote is None):
-                            print(f"  (local) => {branches}")
-                        else:
-                            print(f"  {remote} => {branches}")
+        base_module = GitModule(modules.top_level())
+        check_modules = [base_module]
+        check_modules.extend(modules.get_submodules())
+
+        branches = self.arguments.branch \
+            if len(self.arguments.branch) > 0 else None
+
+        def _execute_module(module):
+            _execute(module,
+                     self.arguments.local, self.arguments.remote, self.arguments.prune,
+                     merged=self.arguments.merged, dry_run=self.arguments.dry_run,
+                     name="base" if module is base_module else None, branches=branches)
+
+        # Only deleting branches on the remotes waits on the network, pruning
+        # deletes local branches.
+        executor = ModuleExecutor.from_arguments(self.arguments, "rmbr",
+                                                  network=self.arguments.remote)
+        executor.run(check_modules, report.timed(_execute_module))
+        report.summary(dry_run=self.arguments.dry_run)
+
+
+class MaintenanceCommand:
+    """Optimize the object stores of all modules"""
+
+    LARGE_MODULE = 10000
+
+    def __init__(self, arguments):
+        argparser = argparse.ArgumentParser(
+            prog="git rj maintenance",
+            description="Runs incremental maintenance on the base module and all submodules "
+            "in parallel: writes the commit-graph and multi-pack-index, packs loose objects "
+            "and incrementally repacks. The size of the object store is shown before and "
+            "after for each module.")
+        argparser.add_argument(
+            "-c", "--config", action="store_true",
+            help="Also configure modules with many files for a faster status, with "
+            "feature.manyFiles, core.untrackedCache and (if supported) core.fsmonitor.")
+        argparser.add_argument(
+            "--large", type=int, default=self.LARGE_MODULE, metavar="FILES",
+            help="The number of files in the index for a module to be configured "
+            f"with --config (default {self.LARGE_MODULE}).")
+        ModuleExecutor.add_arguments(argparser)
+
+        self.arguments = argparser.parse_args(arguments)
+
+    @ staticmethod
+    def large_config():
+        """Get the configuration for modules with many files, for this version of git"""
+        values = {}
+        version = GitExe.version_info()
+        if (version >= (2, 24)):
+            values["feature.manyFiles"] = "true"
+        values["core.untrackedCache"] = "true"
+        if (version >= (2, 36) and platform.system() in ["Windows", "Darwin"]):
+            # The builtin file system monitor isn't available on Linux.
+            values["core.fsmonitor"] = "true"
+        return values
+
+    @ staticmethod
+    def _size(counts):
+        return counts.get("size", 0) + counts.get("size-pack", 0) + counts.get("size-garbage", 0)
+
+    @ staticmethod
+    def _format_size(kib):
+        if (kib >= 1024 * 1024):
+            return f"{kib / (1024 * 1024):.2f} GiB"
+        if (kib >= 1024):
+            return f"{kib / 1024:.1f} MiB"
+        return f"{kib} KiB"
+
+    def execute(self):
+        modules = GitModules()
+        if (not modules.at_base()):
+            raise CommandError("Not at the top level repository.")
+
+        execute_lock = threading.Lock()
+        total_before = 0
+        total_after = 0
+        large_config = self.large_config()
+
+        def _execute(module):
+            nonlocal total_before, total_after
+            name = "base" if module is base_module else module.path()
+            try:
+                before = module.get_object_counts()
+                module.maintenance()
+                after = module.get_object_counts()
+
+                configured = []
+                files = None
+                if (self.arguments.config):
+                    files = module.get_index_size()
+                    if (files is not None and files >= self.arguments.large):
+                        changed = module.apply_config(large_config)
+                        configured = [key for key in large_config if key.lower() in changed]
+
+                size_before = self._size(before)
+                size_after = self._size(after)
+                with execute_lock:
+                    total_before += size_before
+                    total_after += size_after
+                    print("\033[35;1mModule:\033[0;35m {}...\033[0m DONE. {} -> {} "
+                          "(packs: {} -> {}, loose objects: {} -> {})"
+                          .format(name,
+                                  self._format_size(size_before), self._format_size(size_after),
+                                  before.get("packs", 0), after.get("packs", 0),
+                                  before.get("count", 0), after.get("count", 0)), flush=True)
+                    if (len(configured) > 0):
+                        print("  Configured for {} files: {}".format(files, ", ".join(configured)),
+                              flush=True)
+            except GitError as ex:
+                with execute_lock:
+                    print("\033[35;1mModule:\033[0;35m {}...\033[0m FAILED.\n{}"
+                          .format(name, str(ex)), flush=True)
+
+        base_module = GitModule(modules.top_level())
+        check_modules = [base_module]
+        check_modules.extend(modules.get_submodules())
+
+        executor = ModuleExecutor.from_arguments(self.arguments, "maintenance")
+        executor.run(check_modules, _execute)
+
+        print("\033[35;1mTotal:\033[0;35m {} -> {}\033[0m"
+              .format(self._format_size(total_before), self._format_size(total_after)))
+
+
+class DaemonCommand:
+    """Run a background process that keeps the state of the workspace"""
+
+    def __init__(self, arguments):
+        argparser = argparse.ArgumentParser(
+            prog="git rj daemon",
+            description="Manage a background process for the workspace, that watches all "
+            "modules for changes, so that 'git rj status' and 'git rj shbr' only query the "
+            "modules that changed. Only supported on Linux.")
+        argparser.add_argument(
+            "action", nargs="?", default="status",
+            choices=["start", "stop", "status", "run"],
+            help="Start the daemon in the background, stop it, show if it's running "
+            "(the default), or run it in the foreground.")
 
+        self.arguments = argparser.parse_args(arguments)
+
+    START_TIMEOUT = 30
+
+    def execute(self):
+        if (platform.system() != "Linux"):
+            raise CommandError("The daemon is only supported on Linux.")
+
+        modules = GitModules()
+        if (not modules.at_base()):
+            raise CommandError("Not at the top level repository.")
+        top = modules.top_level()
+        sockpath = Daemon.path(top, Daemon.SOCKET)
+        if (sockpath is None):
+            raise CommandError("Can't find the git directory.")
+
+        if (self.arguments.action == "status"):
+            response = Daemon.request(top, {"ping": True}, timeout=10)
+            if (response is None):
+                print("\033[35;1mDaemon:\033[0;35m not running\033[0m")
+                return
+            print(f"\033[35;1mDaemon:\033[0;35m running (pid {response['pid']})\033[0m")
+            print(f"  Uptime: {response['uptime']:.0f}s")
+            print(f"  Modules: {response['modules']}")
+            print(f"  Requests: {response['requests']} (cached: {response['hits']}, "
+                  f"queried: {response['misses']})")
+        elif (self.arguments.action == "stop"):
+            response = Daemon.request(top, {"stop": True}, timeout=10)
+            if (response is None):
+                print("\033[35;1mDaemon:\033[0;35m not running\033[0m")
+            else:
+                print(f"\033[35;1mDaemon:\033[0;35m stopped (pid {response['stopped']})\033[0m")
+        elif (self.arguments.action == "run"):
+            os.makedirs(os.path.dirname(sockpath), exist_ok=True)
+            Daemon(top).serve(sockpath)
+        else:
+            self._start(top, sockpath)
+
+    def _start(self, top, sockpath):
+        response = Daemon.request(top, {"ping": True}, timeout=10)
+        if (response is not None):
+            print(f"\033[35;1mDaemon:\033[0;35m already running (pid {response['pid']})\033[0m")
+            return
+        if (len(os.fsencode(sockpath)) >= 108):
+            raise CommandError(f"The path to the socket '{sockpath}' is too long.")
+
+        os.makedirs(os.path.dirname(sockpath), exist_ok=True)
+        logpath = Daemon.path(top, Daemon.LOG)
+        with open(logpath, "w") as logfile:
+            process = subprocess.Popen(
+                [sys.executable, os.path.realpath(__file__), "daemon", "run"],
+                cwd=top, stdin=subprocess.DEVNULL, stdout=logfile, stderr=subprocess.STDOUT,
+                start_new_session=True)
+
+        # Watching all the modules takes some time on large workspaces.
+        start = time.monotonic()
+        while (time.monotonic() - start < self.START_TIMEOUT):
+            if (process.poll() is not None):
+                raise CommandError(f"The daemon didn't start, see '{logpath}'.")
+            response = Daemon.request(top, {"ping": True}, timeout=10)
+            if (response is not None):
+                print(f"\033[35;1mDaemon:\033[0;35m started (pid {response['pid']})\033[0m")
+                return
+            time.sleep(0.1)
+        raise CommandError(f"The daemon didn't respond, see '{logpath}'.")
+
+
+class WorktreeCommand:
+    """Add or remove working trees of the base repository and all submodules"""
+
+    def __init__(self, arguments):
+        argparser = argparse.ArgumentParser(
+            prog="git rj worktree",
+            description="Adds a working tree of the base repository, with working trees of "
+            "all submodules, sharing the object store of each module. The branch is checked "
+            "out like 'git rj cobr'. Or removes the working trees again.")
+        argparser.add_argument(
+            "action", choices=["add", "remove"],
+            help="Add or remove the working trees.")
+        argparser.add_argument(
+            "path",
+            help="The path of the working tree of the base repository.")
+        argparser.add_argument(
+            "branch", nargs="?", default=None,
+            help="The branch to check out. If not given, the current commit of the base "
+            "repository and the default branches of the submodules are checked out.")
+        argparser.add_argument(
+            "-f", "--force", action="store_true",
+            help="Remove working trees with local changes.")
+        ModuleExecutor.add_arguments(argparser)
+
+        self.arguments = argparser.parse_args(arguments)
+        if (self.arguments.action == "remove" and self.arguments.branch is not None):
+            raise ArgumentError("A branch can't be given when removing working trees")
+
+    def execute(self):
+        modules = GitModules()
+        if (not modules.at_base()):
+            raise CommandError("Not at the top level repository.")
+
+        path = os.path.abspath(self.arguments.path)
         base_module = GitModule(modules.top_level())
-        check_modules = [(base_module, "base")]
-        for module in modules.get_submodules():
-            check_modules.extend([(module, None)])
+        if (self.arguments.action == "add"):
+            self._add(modules, base_module, path)
+        else:
+            self._remove(modules, base_module, path)
+
+    def _add(self, modules, base_module, path):
+        execute_lock = threading.Lock()
+
+        def _checkout(module, worktree, branches):
+            """Add the working tree for the first branch that exists.
+
+            A branch can only be checked out in one working tree, so if it's
+            already checked out, the HEAD is detached at the branch.
+            """
+            (branch, track) = module.resolve_branch(branches)
+            detach = False
+            if (branch is not None and track is None):
+                detach = any(checkedout == branch for (_, checkedout) in module.get_worktrees())
+            module.add_worktree(worktree, branch, track=track, detach=detach)
+            if (branch is None):
+                return "HEAD (detached)"
+            return f"{branch} (detached)" if detach else branch
+
+        def _execute(module):
+            name = module.path()
+            try:
+                actual = _checkout(module, os.path.join(path, name),
+                                   [self.arguments.branch, module.default_branch, DEFAULT_BRANCH])
+            except GitError as ex:
+                with execute_lock:
+                    print("\033[35;1mModule:\033[0;35m {}...\033[0m FAILED.\n{}"
+                          .format(name, str(ex)), flush=True)
+                return
+            with execute_lock:
+                print(f"\033[35;1mModule:\033[0;35m {name}...\033[0m DONE. {actual}", flush=True)
+
+        # The base module is checked out first, which creates the directories
+        # of the submodules.
+        try:
+            actual = _checkout(base_module, path, [self.arguments.branch])
+        except GitError as ex:
+            print("\033[35;1mModule:\033[0;35m base...\033[0m FAILED.\n{}".format(str(ex)), flush=True)
+            return
+        print(f"\033[35;1mModule:\033[0;35m base...\033[0m DONE. {actual}", flush=True)
+
+        # A nested submodule is added once the working tree of its parent is.
+        executor = ModuleExecutor.from_arguments(self.arguments, "worktree")
+        for level in modules.get_levels():
+            executor.run(level, _execute)
+
+    def _remove(self, modules, base_module, path):
+        execute_lock = threading.Lock()
+        failed = False
+
+        def _execute(module):
+            nonlocal failed
+            name = module.path()
+            worktree = os.path.join(path, name)
+            try:
+                worktrees = [os.path.normcase(os.path.abspath(entry[0])) for entry in module.get_worktrees()]
+                if (os.path.normcase(worktree) not in worktrees):
+                    with execute_lock:
+                        print(f"\033[35;1mModule:\033[0;35m {name}...\033[0m NONE.", flush=True)
+                    return
+                module.remove_worktree(worktree, force=self.arguments.force)
+                # An empty directory is an uninitialized submodule, else the
+                # submodule is deleted in the working tree of the base module.
+                os.makedirs(worktree, exist_ok=True)
+            except GitError as ex:
+                with execute_lock:
+                    failed = True
+                    print("\033[35;1mModule:\033[0;35m {}...\033[0m FAILED.\n{}"
+                          .format(name, str(ex)), flush=True)
+                return
+            with execute_lock:
+                print(f"\033[35;1mModule:\033[0;35m {name}...\033[0m DONE.", flush=True)
+
+        # The working trees of the submodules are removed first, the most
+        # nested first, as git doesn't remove a working tree with submodules.
+        executor = ModuleExecutor.from_arguments(self.arguments, "worktree")
+        for level in reversed(modules.get_levels()):
+            executor.run(level, _execute)
+            if (failed):
+                break
+        if (failed):
+            raise CommandError("Not all working trees of the submodules could be removed.")
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            for module in check_modules:
-                branches = self.arguments.branch \
-                    if len(self.arguments.branch) > 0 else None
-                executor.submit(_execute, module[0],
-                                self.arguments.local, self.arguments.remote, self.arguments.prune,
-                                name=module[1], branches=branches)
+        try:
+            base_module.remove_worktree(path, force=self.arguments.force)
+        except GitError as ex:
+            print("\033[35;1mModule:\033[0;35m base...\033[0m FAILED.\n{}".format(str(ex)), flush=True)
+            return
+        print("\033[35;1mModule:\033[0;35m base...\033[0m DONE.", flush=True)
 
 
 class BuildCommand:
@@ -2033,7 +6144,7 @@ class PerfCommand:
                     for file in files:
                         if file.endswith(".xml"):
                             name = run["target"]
-                            self._parseperf(name, str(Path(root).joinpath(file)), perfresults, perfsummary)
+                            self._parseperf(name, os.path.join(root, file), perfresults, perfsummary)
             if (len(perfresults) > 0):
                 self._printperf(prj, perfresults, perfsummary)
 
@@ -2044,6 +6155,8 @@ class PerfCommand:
             self._runperfbinary(prj, target, config[target])
 
     def _runperfbinary(self, prj, target, executable):
+        import shutil
+        from pathlib import Path
         runfolder = str(Path("perf").joinpath(prj).joinpath(target))
         cwd = Path(os.getcwd())
         fullpath = cwd.joinpath(runfolder)
@@ -2079,6 +6192,7 @@ class PerfCommand:
         )
 
     def _parseperf(self, name, perfxml, results, summary):
+        import xml.etree.ElementTree as ET
         root = ET.parse(perfxml).getroot()
         for c in root.findall("./Benchmarks/BenchmarkCase"):
             type = c.find("./Type").text
@@ -2250,33 +6364,48 @@ class Command:
     """Parse the arguments on the command line."""
 
     def __init__(self):
-        if (len(sys.argv) < 2):
+        argv = sys.argv[1:]
+        profile = os.environ.get("GITRJ_PROFILE")
+        if (len(argv) > 0 and (argv[0] == "--profile" or argv[0].startswith("--profile="))):
+            profile = argv[0][10:] if "=" in argv[0] else ""
+            argv = argv[1:]
+        if (profile is not None):
+            Profiler.enable(profile if profile != "" else Profiler.DEFAULT_TRACE)
+
+        if (len(argv) < 1):
             raise ArgumentError("Must provide a basic command")
-        self.command = sys.argv[1].lower()
+        self.command = argv[0].lower()
+        self.arguments = argv[1:]
         if (self.command == "version"):
-            self.argument = VersionCommand(sys.argv[2:])
+            self.argument = VersionCommand(argv[1:])
         elif (self.command == "help"):
-            self.argument = HelpCommand(sys.argv[2:])
+            self.argument = HelpCommand(argv[1:])
         elif (self.command == "init"):
-            self.argument = InitCommand(sys.argv[2:])
+            self.argument = InitCommand(argv[1:])
         elif (self.command == "pull"):
-            self.argument = PullCommand(sys.argv[2:])
+            self.argument = PullCommand(argv[1:])
         elif (self.command == "fetch"):
-            self.argument = FetchCommand(sys.argv[2:])
+            self.argument = FetchCommand(argv[1:])
         elif (self.command == "clean"):
-            self.argument = CleanCommand(sys.argv[2:])
+            self.argument = CleanCommand(argv[1:])
         elif (self.command == "status"):
-            self.argument = StatusCommand(sys.argv[2:])
+            self.argument = StatusCommand(argv[1:])
         elif (self.command == "checkout-branch" or self.command == "cobr"):
-            self.argument = CobrCommand(sys.argv[2:])
+            self.argument = CobrCommand(argv[1:])
         elif (self.command == "show-branch" or self.command == "shbr"):
-            self.argument = ShbrCommand(sys.argv[2:])
+            self.argument = ShbrCommand(argv[1:])
         elif (self.command == "remove-branch" or self.command == "rmbr"):
-            self.argument = RmbrCommand(sys.argv[2:])
+            self.argument = RmbrCommand(argv[1:])
+        elif (self.command == "maintenance"):
+            self.argument = MaintenanceCommand(argv[1:])
+        elif (self.command == "daemon"):
+            self.argument = DaemonCommand(argv[1:])
+        elif (self.command == "worktree"):
+            self.argument = WorktreeCommand(argv[1:])
         elif (self.command == "build"):
-            self.argument = BuildCommand(sys.argv[2:])
+            self.argument = BuildCommand(argv[1:])
         elif (self.command == "perf"):
-            self.argument = PerfCommand(sys.argv[2:])
+            self.argument = PerfCommand(argv[1:])
         else:
             raise ArgumentError(
                 f"Unknown command {self.command} given on the command line")
@@ -2285,6 +6414,8 @@ class Command:
 def execute_command(command):
     """Execute the argument given"""
 
+    if (Daemon.execute(command.command, command.arguments)):
+        return
     command.argument.execute()
 
 
@@ -2305,7 +6436,10 @@ def check_preconditions():
 
 
 def main():
-    os.system("")
+    if (platform.system() == "Windows" and sys.stdout.isatty()):
+        # Enables the escape sequences for colours in the Windows console.
+        # Elsewhere it would only start a shell for nothing.
+        os.system("")
 
     try:
         check_preconditions()
@@ -2320,9 +6454,14 @@ def main():
     try:
         execute_command(command)
     except CommandError as ex:
-        print(f"Error: 'git rj {command.command}':")
-        print("", str(ex))
+        # The error isn't mixed into machine readable output.
+        output = sys.stderr if ModuleReport.close(str(ex)) else sys.stdout
+        print(f"Error: 'git rj {command.command}':", file=output)
+        print("", str(ex), file=output)
         sys.exit(ex.exitcode)
+    finally:
+        ModuleReport.close()
+        Profiler.report()
 
 
 if __name__ == "__main__":